@@ -1,5 +1,9 @@
 from django.contrib import admin
-from .models import Thread, Message
+from .models import ArchivedMessage, Thread, Message, Conversation, ConversationTurn, InboxEntry
 
 admin.site.register(Thread)
-admin.site.register(Message)
\ No newline at end of file
+admin.site.register(Message)
+admin.site.register(ArchivedMessage)
+admin.site.register(Conversation)
+admin.site.register(ConversationTurn)
+admin.site.register(InboxEntry)
\ No newline at end of file
@@ -0,0 +1,65 @@
+"""
+Hot and cold storage of private messages.
+
+`Message` holds recent messages only: `manage.py archive_messages` moves
+messages older than CHAT_ARCHIVE_AFTER_DAYS into `ArchivedMessage`, in
+short transactions of CHAT_ARCHIVE_BATCH_SIZE rows, so the table written by
+every chat message, and its indexes, stay small. Nothing on the hot path
+(saving messages, the inbox) reads the archive.
+
+Messages keep their ids, and every run archives all messages up to one
+cutoff id, so all archived messages are older than all recent ones.
+`history_page` pages through a thread's recent messages and carries on in
+the archive where they end. Archived messages stay searchable: the
+archive's triggers put them back in the full-text index (migration 0007).
+"""
+from django.conf import settings
+from django.db import transaction
+
+from .models import ArchivedMessage, Message
+
+def history_page(thread_id, before=None, limit=None):
+    """
+    Returns `(messages, next_cursor)`: up to `limit` messages of the thread
+    with ids below `before` (the newest ones if None), oldest first, and the
+    cursor for the page before them (None on the first page of the thread).
+    Archived messages are returned as unsaved `Message` objects.
+    """
+    limit = limit or settings.CHAT_HISTORY_PAGE_SIZE
+    hot = Message.objects.filter(thread_id=thread_id)
+    if before is not None:
+        hot = hot.filter(id__lt=before)
+    messages = list(hot.select_related('sender').order_by('-id')[:limit + 1])
+    if len(messages) <= limit:
+        # The recent messages end on this page; the older ones are archived.
+        cold = ArchivedMessage.objects.filter(thread_id=thread_id)
+        if before is not None:
+            cold = cold.filter(id__lt=before)
+        archived = cold.select_related('sender').order_by('-id')[:limit + 1 - len(messages)]
+        messages += [message.as_message() for message in archived]
+    next_cursor = messages[limit - 1].id if len(messages) > limit else None
+    return list(reversed(messages[:limit])), next_cursor
+
+def archive_messages(older_than, batch_size=None) -> int:
+    """
+    Moves messages created before `older_than` (a datetime) to the archive.
+    Returns the number of messages moved.
+    """
+    batch_size = batch_size or settings.CHAT_ARCHIVE_BATCH_SIZE
+    # Archive by id, so the archive never holds a message newer than a recent one.
+    cutoff = Message.objects.filter(created_at__lt=older_than).order_by('-id').values_list('id', flat=True).first()
+    if cutoff is None:
+        return 0
+
+    moved = 0
+    fields = ['id', 'thread_id', 'sender_id', 'text', 'created_at']
+    while True:
+        with transaction.atomic():
+            rows = list(Message.objects.filter(id__lte=cutoff).order_by('id').values(*fields)[:batch_size])
+            if not rows:
+                return moved
+            # Deleting first drops the rows from the search index; the
+            # archive's insert trigger adds them back.
+            Message.objects.filter(id__in=[row['id'] for row in rows]).delete()
+            ArchivedMessage.objects.bulk_create([ArchivedMessage(**row) for row in rows])
+        moved += len(rows)
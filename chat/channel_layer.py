@@ -0,0 +1,389 @@
+"""
+A Redis channel layer for running the chat across several processes.
+
+It speaks plain Redis commands (no Lua scripts), so it works against Redis,
+Redis-protocol compatible servers and the local stand-in in
+`chat.fake_redis`. Each process opens at most `max_connections` connections
+per host; commands wait for a free one rather than failing under bursts.
+Replies are awaited for up to `socket_timeout` seconds (by default as long
+as they take): blocking pops and large group sends can outlast redis-py's
+five-second default.
+
+- Groups are sorted sets of channel names scored by the time they were
+  added; members older than `group_expiry` are dropped.
+- Each channel is a Redis list. All process-specific channels of one
+  process (`new_channel()`, used by every consumer) share a single list that
+  one background task per process reads and dispatches locally, so a
+  worker holds one blocking connection however many clients it serves.
+- Keys are sharded over `hosts` by a CRC32 of the group name or channel
+  list. `group_send` serializes the message once and pushes it with one
+  pipeline per shard, sent concurrently. Members sharing a process list
+  get a single list entry naming all of them, which the process decodes
+  once and hands to each of its consumers.
+- A channel holds at most `capacity` messages (`channel_capacity` per
+  pattern) and messages expire after `expiry` seconds. Process lists hold
+  at most `process_capacity` messages; each local channel is then capped
+  at its own capacity.
+- The `presence` extension keeps per-group connection counts in a hash, so
+  the public chat's online list is shared by all workers (see
+  `chat.presence`). Each process counts its own connections under its own
+  fields, and a member's last disconnect removes its field with a
+  WATCH/MULTI transaction, so a concurrent connect is never lost. Processes
+  record a heartbeat every `presence_ttl / 3` seconds; the counts of a
+  process that has not done so for `presence_ttl` seconds (e.g. one that
+  crashed) are left out.
+
+Requires the optional `redis` and `msgpack` packages.
+"""
+import asyncio
+import logging
+import random
+import string
+import time
+import weakref
+import zlib
+from collections import defaultdict
+
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer, get_channel_layer
+from django.core.exceptions import ImproperlyConfigured
+
+try:
+    import msgpack
+    from redis import asyncio as aioredis
+    from redis.exceptions import WatchError
+except ImportError:
+    msgpack = aioredis = WatchError = None
+
+logger = logging.getLogger(__name__)
+
+class RedisChannelLayer(BaseChannelLayer):
+    extensions = ['groups', 'flush', 'presence']
+
+    def __init__(
+        self,
+        hosts=None,
+        prefix='asgi',
+        expiry=60,
+        group_expiry=86400,
+        capacity=100,
+        channel_capacity=None,
+        process_capacity=10000,
+        receive_timeout=5,
+        max_connections=50,
+        socket_timeout=None,
+        presence_ttl=30,
+    ):
+        if aioredis is None:
+            raise ImproperlyConfigured("RedisChannelLayer requires the redis and msgpack packages.")
+        super().__init__(expiry=expiry, capacity=capacity)
+        self.channel_capacity = self.compile_capacities(channel_capacity or {})
+        self.hosts = list(hosts or ['redis://127.0.0.1:6379'])
+        self.prefix = prefix
+        self.group_expiry = group_expiry
+        self.process_capacity = process_capacity
+        self.receive_timeout = receive_timeout
+        self.max_connections = max_connections
+        self.socket_timeout = socket_timeout
+        self.presence_ttl = presence_ttl
+        self.client_prefix = ''.join(random.choices(string.ascii_letters, k=12))
+        # event loop -> one client per host.
+        self._clients = weakref.WeakKeyDictionary()
+        # Local queues of this process's specific channels, by channel name.
+        self._local = {}
+        # Non-local channel name -> task reading its list into `_local`.
+        self._receivers = {}
+        # Task recording that this process is alive, once it counts presence.
+        self._heartbeat = None
+
+    # Keys and connections
+
+    def _channel_key(self, channel):
+        return f'{self.prefix}:channel:{self.non_local_name(channel)}'
+
+    def _group_key(self, group):
+        return f'{self.prefix}:group:{group}'
+
+    def _presence_key(self, group):
+        return f'{self.prefix}:presence:{group}'
+
+    def _processes_key(self):
+        return f'{self.prefix}:processes'
+
+    def _presence_field(self, member):
+        return f'{self.client_prefix}:{member}'
+
+    def _shard(self, key):
+        return zlib.crc32(key.encode('utf-8')) % len(self.hosts)
+
+    def _all_clients(self):
+        """Returns the running event loop's clients, one per host."""
+        loop = asyncio.get_running_loop()
+        clients = self._clients.get(loop)
+        if clients is None:
+            clients = self._clients[loop] = [
+                # RESP2 works with any Redis-protocol server.
+                aioredis.Redis.from_pool(aioredis.BlockingConnectionPool.from_url(
+                    host, protocol=2, max_connections=self.max_connections, timeout=None,
+                    socket_timeout=self.socket_timeout,
+                ))
+                for host in self.hosts
+            ]
+        return clients
+
+    def _client(self, key):
+        return self._all_clients()[self._shard(key)]
+
+    def _channel_capacity(self, channel):
+        return self.process_capacity if '!' in channel else self.get_capacity(channel)
+
+    def _pack(self, channels, packed_message):
+        return msgpack.packb([channels, time.time() + self.expiry, packed_message])
+
+    # Channels
+
+    async def new_channel(self, prefix='specific'):
+        channel = f"{prefix}.{self.client_prefix}!{''.join(random.choices(string.ascii_letters, k=12))}"
+        self._local[channel] = asyncio.Queue(maxsize=self.get_capacity(channel))
+        return channel
+
+    def _queue_push(self, pipe, key, payload, capacity):
+        pipe.rpush(key, payload)
+        # Keep the oldest `capacity` messages: a push to a full list is dropped.
+        pipe.ltrim(key, 0, capacity - 1)
+        pipe.expire(key, self.expiry)
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), "message is not a dict"
+        self.require_valid_channel_name(channel)
+        key = self._channel_key(channel)
+        capacity = self._channel_capacity(channel)
+        async with self._client(key).pipeline(transaction=False) as pipe:
+            self._queue_push(pipe, key, self._pack([channel], msgpack.packb(message)), capacity)
+            length, _, _ = await pipe.execute()
+        if length > capacity:
+            raise ChannelFull(channel)
+
+    async def receive(self, channel):
+        self.require_valid_channel_name(channel)
+        if '!' not in channel:
+            return await self._receive_direct(channel)
+
+        queue = self._local.get(channel)
+        if queue is None:
+            queue = self._local[channel] = asyncio.Queue(maxsize=self.get_capacity(channel))
+        self._ensure_receiver(self.non_local_name(channel))
+        try:
+            while True:
+                expires_at, message = await queue.get()
+                if expires_at >= time.time():
+                    return message
+        except asyncio.CancelledError:
+            # The consumer has gone; stop buffering messages for it.
+            self._local.pop(channel, None)
+            raise
+
+    def _decode(self, payload):
+        """Returns `(channels, expires_at, packed_message)`."""
+        return msgpack.unpackb(payload)
+
+    async def _receive_direct(self, channel):
+        key = self._channel_key(channel)
+        client = self._client(key)
+        while True:
+            result = await client.blpop([key], timeout=self.receive_timeout)
+            if result is None:
+                continue
+            _, expires_at, packed_message = self._decode(result[1])
+            if expires_at >= time.time():
+                return msgpack.unpackb(packed_message)
+
+    def _ensure_receiver(self, non_local_name):
+        receiver = self._receivers.get(non_local_name)
+        if receiver is None or receiver.done() or receiver.get_loop() is not asyncio.get_running_loop():
+            self._receivers[non_local_name] = asyncio.ensure_future(self._receive_loop(non_local_name))
+
+    def _has_local_channels(self, non_local_name):
+        return any(channel.startswith(non_local_name) for channel in self._local)
+
+    async def _receive_loop(self, non_local_name):
+        """Moves messages from this process's shared list to the local channel queues."""
+        key = self._channel_key(non_local_name)
+        client = self._client(key)
+        while True:
+            try:
+                result = await client.blpop([key], timeout=self.receive_timeout)
+            except (aioredis.ConnectionError, aioredis.TimeoutError) as e:
+                logger.warning(f"Channel layer receive failed: {e}")
+                await asyncio.sleep(1)
+                continue
+            if result is None:
+                # Idle; stop once every local consumer has gone.
+                if not self._has_local_channels(non_local_name):
+                    return
+                continue
+            channels, expires_at, packed_message = self._decode(result[1])
+            queues = [(channel, self._local.get(channel)) for channel in channels]
+            queues = [(channel, queue) for channel, queue in queues if queue is not None]
+            if not queues or expires_at < time.time():
+                continue
+            # Consumers only read messages, so they can share one copy.
+            message = msgpack.unpackb(packed_message)
+            for channel, queue in queues:
+                try:
+                    queue.put_nowait((expires_at, message))
+                except asyncio.QueueFull:
+                    logger.debug(f"Dropping a message for full channel {channel}")
+
+    # Groups
+
+    async def group_add(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        key = self._group_key(group)
+        async with self._client(key).pipeline(transaction=False) as pipe:
+            pipe.zadd(key, {channel: time.time()})
+            pipe.expire(key, self.group_expiry)
+            await pipe.execute()
+
+    async def group_discard(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        key = self._group_key(group)
+        await self._client(key).zrem(key, channel)
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), "message is not a dict"
+        self.require_valid_group_name(group)
+        key = self._group_key(group)
+        async with self._client(key).pipeline(transaction=False) as pipe:
+            pipe.zremrangebyscore(key, 0, time.time() - self.group_expiry)
+            pipe.zrange(key, 0, -1)
+            _, members = await pipe.execute()
+        if not members:
+            return
+
+        packed_message = msgpack.packb(message)
+        # shard -> channel list key -> (capacity, channels)
+        by_shard = defaultdict(dict)
+        for member in members:
+            channel = member.decode('utf-8')
+            channel_key = self._channel_key(channel)
+            _, channels = by_shard[self._shard(channel_key)].setdefault(
+                channel_key, (self._channel_capacity(channel), []),
+            )
+            channels.append(channel)
+
+        async def push(lists):
+            async with self._client(next(iter(lists))).pipeline(transaction=False) as pipe:
+                for channel_key, (capacity, channels) in lists.items():
+                    self._queue_push(pipe, channel_key, self._pack(channels, packed_message), capacity)
+                # Full channels are skipped silently, as with the in-memory layer.
+                await pipe.execute()
+
+        await asyncio.gather(*(push(lists) for lists in by_shard.values()))
+
+    # Presence
+
+    async def _beat(self):
+        key = self._processes_key()
+        await self._client(key).zadd(key, {self.client_prefix: time.time()})
+
+    async def _heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(self.presence_ttl / 3)
+            try:
+                await self._beat()
+            except (aioredis.ConnectionError, aioredis.TimeoutError) as e:
+                logger.warning(f"Channel layer heartbeat failed: {e}")
+
+    async def _ensure_heartbeat(self):
+        heartbeat = self._heartbeat
+        if heartbeat is None or heartbeat.done() or heartbeat.get_loop() is not asyncio.get_running_loop():
+            # Alive before counting anything, so the first read includes this process.
+            await self._beat()
+            self._heartbeat = asyncio.ensure_future(self._heartbeat_loop())
+
+    async def _live_processes(self) -> set:
+        key = self._processes_key()
+        async with self._client(key).pipeline(transaction=False) as pipe:
+            pipe.zremrangebyscore(key, 0, time.time() - self.presence_ttl)
+            pipe.zrange(key, 0, -1)
+            _, processes = await pipe.execute()
+        return {process.decode('utf-8') for process in processes}
+
+    async def presence_add(self, group, member: str) -> dict:
+        """Counts a connection of `member` in `group`; returns members -> connection counts."""
+        await self._ensure_heartbeat()
+        key = self._presence_key(group)
+        async with self._client(key).pipeline(transaction=False) as pipe:
+            pipe.hincrby(key, self._presence_field(member), 1)
+            pipe.expire(key, self.group_expiry)
+            pipe.hgetall(key)
+            _, _, members = await pipe.execute()
+        return await self._decode_presence(members)
+
+    async def presence_discard(self, group, member: str) -> dict:
+        """Uncounts a connection of `member` in `group`; returns members -> connection counts."""
+        key = self._presence_key(group)
+        field = self._presence_field(member)
+        async with self._client(key).pipeline(transaction=True) as pipe:
+            while True:
+                try:
+                    await pipe.watch(key)
+                    count = int(await pipe.hget(key, field) or 0)
+                    pipe.multi()
+                    if count <= 1:
+                        pipe.hdel(key, field)
+                    else:
+                        pipe.hincrby(key, field, -1)
+                    pipe.hgetall(key)
+                    _, members = await pipe.execute()
+                    break
+                except WatchError:
+                    # Another connection of the group came or went; try again.
+                    continue
+        return await self._decode_presence(members)
+
+    async def _decode_presence(self, fields):
+        """Sums the counts of live processes by member."""
+        live = await self._live_processes()
+        members = defaultdict(int)
+        for field, count in fields.items():
+            process, _, member = field.decode('utf-8').partition(':')
+            # Fields of dead processes are left for the key's expiry: a
+            # process that was only slow to beat keeps its counts.
+            if process in live and int(count) > 0:
+                members[member] += int(count)
+        return dict(members)
+
+    # Maintenance
+
+    def queue_depths(self) -> list:
+        """Lengths of this process's local channel queues (see `media_sharing_project.metrics`)."""
+        return [queue.qsize() for queue in list(self._local.values())]
+
+    async def flush(self):
+        for client in self._all_clients():
+            keys = [key async for key in client.scan_iter(match=f'{self.prefix}:*')]
+            if keys:
+                await client.delete(*keys)
+        self._local.clear()
+
+    async def close(self):
+        """Stops the receivers and closes this event loop's connections."""
+        for receiver in self._receivers.values():
+            receiver.cancel()
+        self._receivers.clear()
+        if self._heartbeat is not None:
+            self._heartbeat.cancel()
+            self._heartbeat = None
+        clients = self._clients.pop(asyncio.get_running_loop(), [])
+        for client in clients:
+            await client.aclose()
+
+async def close_channel_layer():
+    """Lifespan shutdown hook: closes the default channel layer's connections, if it has any."""
+    layer = get_channel_layer()
+    if isinstance(layer, RedisChannelLayer):
+        await layer.close()
@@ -0,0 +1,125 @@
+"""
+Encoding of chat WebSocket frames.
+
+Group broadcasts are encoded once by the sender with `group_event`; the
+consumers forward the pre-encoded frame to their sockets as-is, so a message
+to a room of N members is serialized once instead of N times.
+
+`settings.CHAT_JSON_CODEC` selects the JSON implementation: "json" (the
+standard library) or "orjson" (faster, optional dependency). If orjson is
+requested but not installed, the standard library is used.
+
+Clients that offer the `BINARY_SUBPROTOCOL` WebSocket subprotocol get
+MessagePack binary frames instead (requires the optional `msgpack`
+package). A binary frame is an array whose first item is a short type code
+followed by that type's fields in a fixed order, and chat messages carry the
+sender's user ID instead of the username:
+
+    chat_message      [1, user_id, message]
+    user_list         [2, [user_id, ...], [username, ...]]
+    bot_stream_start  [3, stream_id, username]
+    bot_queue         [4, stream_id, position]
+    bot_stream_chunk  [5, stream_id, message]
+    bot_stream_end    [6, stream_id, message]
+    rate_limited      [7, retry_after]
+    history           [9, [{id, user_id, username, message}, ...], before]
+
+Clients send `[1, message]` or `[1, message, cache]`, `[8]` as a read
+receipt in private chats and `[9, before]` to ask for the private chat
+history before a message id. Clients that do not
+ask for the subprotocol keep using JSON text frames.
+"""
+import json
+import logging
+
+from django.conf import settings
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+logger = logging.getLogger(__name__)
+
+BINARY_SUBPROTOCOL = 'chat.msgpack.v1'
+
+# Frame type -> (type code, fields in wire order).
+BINARY_FRAMES = {
+    'chat_message': (1, ('user_id', 'message')),
+    'user_list': (2, ('user_ids', 'users')),
+    'bot_stream_start': (3, ('stream_id', 'username')),
+    'bot_queue': (4, ('stream_id', 'position')),
+    'bot_stream_chunk': (5, ('stream_id', 'message')),
+    'bot_stream_end': (6, ('stream_id', 'message')),
+    'rate_limited': (7, ('retry_after',)),
+    'read': (8, ()),
+    'history': (9, ('messages', 'before')),
+}
+BINARY_TYPES = {code: (frame_type, fields) for frame_type, (code, fields) in BINARY_FRAMES.items()}
+
+class FrameError(ValueError):
+    """Raised for binary frames that cannot be decoded."""
+
+def _load_codec(name):
+    if name == 'orjson':
+        try:
+            import orjson
+        except ImportError:
+            logger.warning("CHAT_JSON_CODEC is 'orjson' but orjson is not installed; using json.")
+        else:
+            return (lambda data: orjson.dumps(data).decode('utf-8')), orjson.loads
+    return (lambda data: json.dumps(data)), json.loads
+
+_encode, _decode = _load_codec(getattr(settings, 'CHAT_JSON_CODEC', 'json'))
+
+def encode_frame(data) -> str:
+    """Encodes `data` as a JSON text frame."""
+    return _encode(data)
+
+def decode_frame(text):
+    """Decodes a JSON text frame; raises `json.JSONDecodeError` on bad input."""
+    return _decode(text)
+
+def binary_available() -> bool:
+    return msgpack is not None
+
+def encode_binary_frame(data) -> bytes:
+    """Encodes a frame dict as a compact MessagePack array."""
+    code, fields = BINARY_FRAMES[data['type']]
+    return msgpack.packb([code, *(data[field] for field in fields)])
+
+def decode_binary_frame(payload: bytes) -> dict:
+    """Decodes a client's binary frame into the same dict a JSON frame would give."""
+    try:
+        items = msgpack.unpackb(payload)
+    except Exception as e:
+        raise FrameError(f"Invalid binary frame: {e}") from None
+    if not isinstance(items, list) or not items or items[0] not in BINARY_TYPES:
+        raise FrameError("Unknown binary frame type")
+    frame_type, _ = BINARY_TYPES[items[0]]
+    if frame_type == 'read':
+        return {'type': 'read'}
+    if frame_type == 'history':
+        return {'type': 'history', 'before': items[1] if len(items) > 1 else None}
+    if frame_type != 'chat_message' or len(items) < 2 or not isinstance(items[1], str):
+        raise FrameError(f"Unexpected binary frame from client: {frame_type}")
+    data = {'type': frame_type, 'message': items[1]}
+    if len(items) > 2:
+        data['cache'] = bool(items[2])
+    return data
+
+def group_event(handler: str, payload, coalesce: str = None) -> dict:
+    """
+    Builds a channel-layer event for `group_send` that carries `payload`
+    already encoded, as JSON and, if available and the payload type has a
+    binary layout, as a binary frame.
+    `handler` is the consumer method that forwards it. Events with the same
+    `coalesce` key supersede each other while waiting to be sent to a slow
+    client.
+    """
+    event = {'type': handler, 'frame': encode_frame(payload)}
+    if coalesce is not None:
+        event['coalesce'] = coalesce
+    if msgpack is not None and payload['type'] in BINARY_FRAMES:
+        event['binary'] = encode_binary_frame(payload)
+    return event
@@ -0,0 +1,86 @@
+"""
+In-process cache of LLM completions.
+
+Completions are keyed on a hash of the model, system prompt, normalized
+conversation history and user input, so identical prompts (greetings, FAQs)
+are answered without running inference again. The cache is bounded in size
+with least-recently-used eviction, and every entry expires after a TTL.
+"""
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+def normalize_text(text: str) -> str:
+    """Collapses runs of whitespace so trivially different prompts share an entry."""
+    return ' '.join((text or '').split())
+
+def make_key(model: str, system_prompt: str, history, message: str) -> str:
+    """
+    Builds the cache key for a completion.
+
+    `history` is a sequence of `(role, content)` pairs for the earlier turns
+    of the conversation.
+    """
+    payload = json.dumps([
+        model,
+        normalize_text(system_prompt),
+        [[role, normalize_text(content)] for role, content in history],
+        normalize_text(message),
+    ])
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+class CompletionCache:
+    """A thread-safe LRU cache with per-entry expiry and hit/miss counters."""
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str):
+        """Returns the cached completion for `key`, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key: str, completion: str, ttl: float = None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._entries[key] = (expires_at, completion)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+completion_cache = CompletionCache(settings.LLM_CACHE_MAX_ENTRIES, settings.LLM_CACHE_TTL)
@@ -1,19 +1,200 @@
 import json
+import uuid
 from channels.generic.websocket import AsyncWebsocketConsumer
 from django.contrib.auth.models import User
 from asgiref.sync import sync_to_async
 from django.db.models import Count
 from django.conf import settings
+from django.db import transaction
 from .models import Thread, Message
-from .utils import get_conversation_chain, save_conversation_history
+from .archive import history_page
+from .inbox import mark_read, record_message
+from . import presence
+from .utils import aload_conversation
+from .scheduler import SchedulerError
+from .codec import (
+    BINARY_SUBPROTOCOL, FrameError, binary_available, decode_binary_frame, decode_frame,
+    encode_binary_frame, encode_frame, group_event,
+)
+from .throttling import BucketRegistry, OutboundQueue, TokenBucket
+from media_sharing_project.metrics import ConsumerMetricsMixin
 import logging
 
 logger = logging.getLogger(__name__)
-class ChatConsumer(AsyncWebsocketConsumer):
-    """Handles WebSocket connections for the public chat room."""
-    # This set is shared across all ChatConsumer instances in the same process.
-    # For a multi-process setup, a shared backend like Redis would be needed.
-    online_users = set()
+
+class FrameProtocolMixin:
+    """
+    Speaks JSON text frames, or compact binary frames to clients that
+    negotiate `BINARY_SUBPROTOCOL` (see `chat.codec`).
+
+    Also applies flood control (see `chat.throttling`): incoming frames are
+    size-checked and rate limited per connection and per user, and outgoing
+    frames go through a bounded queue so a slow reader cannot pile up
+    messages on the server.
+    """
+    binary = False
+    outbound = None
+    closing = False
+    # Per-user buckets, shared by all connections in this process.
+    user_buckets = None
+
+    async def accept_protocol(self):
+        self.binary = binary_available() and BINARY_SUBPROTOCOL in self.scope.get('subprotocols', ())
+        self.rate_limit = TokenBucket(settings.CHAT_RATE_LIMIT, settings.CHAT_RATE_BURST)
+        self.strikes = 0
+        if FrameProtocolMixin.user_buckets is None:
+            FrameProtocolMixin.user_buckets = BucketRegistry(
+                settings.CHAT_USER_RATE_LIMIT, settings.CHAT_USER_RATE_BURST
+            )
+        await self.accept(subprotocol=BINARY_SUBPROTOCOL if self.binary else None)
+        self.outbound = OutboundQueue(
+            self.write_frame, settings.CHAT_OUTBOUND_QUEUE_SIZE, settings.CHAT_SLOW_CONSUMER_POLICY,
+            on_error=self.write_failed,
+        )
+
+    async def websocket_disconnect(self, message):
+        if self.outbound is not None:
+            await self.outbound.close()
+        await super().websocket_disconnect(message)
+
+    async def admit_frame(self, text_data=None, bytes_data=None) -> bool:
+        """
+        Checks an incoming frame against the size and rate limits. Closes
+        the connection for oversized frames or persistent flooding.
+        """
+        if self.closing:
+            return False
+        size = len(bytes_data) if bytes_data is not None else len(text_data.encode('utf-8'))
+        if size > settings.CHAT_MAX_FRAME_BYTES:
+            logger.warning(f"Closing WebSocket of user {self.user.id}: {size}-byte frame")
+            self.closing = True
+            await self.close(code=1009)
+            return False
+
+        user_bucket = FrameProtocolMixin.user_buckets.get(self.user.id)
+        if self.rate_limit.consume() and user_bucket.consume():
+            self.strikes = 0
+            return True
+
+        self.strikes += 1
+        if self.strikes >= settings.CHAT_FLOOD_MAX_STRIKES:
+            logger.warning(f"Closing WebSocket of user {self.user.id}: flooding")
+            self.closing = True
+            await self.close(code=1008)
+        elif self.strikes == 1:
+            # Tell the client once per run of rejected frames.
+            retry_after = max(self.rate_limit.retry_after(), user_bucket.retry_after())
+            await self.send_frame({'type': 'rate_limited', 'retry_after': round(retry_after, 1)})
+        return False
+
+    def decode_client_frame(self, text_data=None, bytes_data=None):
+        if bytes_data is not None:
+            if not self.binary:
+                raise FrameError("Binary frame on a JSON connection")
+            return decode_binary_frame(bytes_data)
+        return decode_frame(text_data)
+
+    async def write_frame(self, frame):
+        text_data, bytes_data = frame
+        await self.send(text_data=text_data, bytes_data=bytes_data)
+
+    async def write_failed(self, error):
+        if not self.closing:
+            self.closing = True
+            await self.close(code=1011)
+
+    async def queue_frame(self, text_data=None, bytes_data=None, coalesce_key=None):
+        if self.closing:
+            return
+        if not self.outbound.put((text_data, bytes_data), coalesce_key):
+            logger.warning(f"Closing WebSocket of user {self.user.id}: not reading its messages")
+            self.closing = True
+            await self.close(code=1013)
+
+    async def send_frame(self, data):
+        if self.binary:
+            await self.queue_frame(bytes_data=encode_binary_frame(data))
+        else:
+            await self.queue_frame(text_data=encode_frame(data))
+
+    async def forward_event(self, event):
+        """Forwards a group event built with `group_event` in this connection's format."""
+        if self.binary:
+            await self.queue_frame(bytes_data=event['binary'], coalesce_key=event.get('coalesce'))
+        else:
+            await self.queue_frame(text_data=event['frame'], coalesce_key=event.get('coalesce'))
+
+class BotReplyMixin:
+    """
+    Streams `@bot` replies to the WebSocket as they are generated.
+
+    The client receives a `bot_stream_start` frame, one `bot_stream_chunk`
+    frame per generated chunk and a final `bot_stream_end` frame carrying the
+    complete reply. While the request waits for the LLM scheduler,
+    `bot_queue` frames report its queue position (0 once generation starts).
+    The new turns are saved to the user's conversation once the stream has
+    finished.
+    """
+
+    async def stream_bot_reply(self, query, use_cache=True):
+        model = settings.OLLAMA_MODEL
+        stream_id = uuid.uuid4().hex
+
+        await self.send_frame({
+            'type': 'bot_stream_start',
+            'stream_id': stream_id,
+            'username': f'AI Assistant ({model})'
+        })
+
+        async def report_position(position):
+            await self.send_frame({
+                'type': 'bot_queue',
+                'stream_id': stream_id,
+                'position': position
+            })
+
+        try:
+            conversation = await aload_conversation()
+            chain = await conversation.aget_conversation_chain(self.user, model)
+            chunks = []
+            async for chunk in conversation.stream_conversation(
+                chain, query, use_cache, user_key=self.user.id, on_position=report_position
+            ):
+                chunks.append(chunk)
+                await self.send_frame({
+                    'type': 'bot_stream_chunk',
+                    'stream_id': stream_id,
+                    'message': chunk
+                })
+            await conversation.asave_conversation_history(chain)
+            reply = ''.join(chunks)
+        except SchedulerError as e:
+            reply = e.message
+        except Exception as e:
+            logger.error(f"Error in {type(self).__name__} with LangChain: {e}", exc_info=True)
+            reply = "Sorry, I had a problem processing that."
+
+        await self.send_frame({
+            'type': 'bot_stream_end',
+            'stream_id': stream_id,
+            'message': reply
+        })
+
+class ChatConsumer(ConsumerMetricsMixin, FrameProtocolMixin, BotReplyMixin, AsyncWebsocketConsumer):
+    """
+    Handles WebSocket connections for the public chat room. Online users are
+    tracked in chat.presence, shared by all worker processes when the channel
+    layer supports it.
+    """
+
+    @staticmethod
+    def user_list_event(online_users):
+        users = sorted(online_users)
+        return group_event('user_list_update', {
+            'type': 'user_list',
+            'users': users,
+            'user_ids': [online_users[username] for username in users]
+        }, coalesce='presence')
 
     async def connect(self):
         self.room_name = 'public_chat'
@@ -29,44 +210,36 @@ class ChatConsumer(AsyncWebsocketConsumer):
             self.room_group_name,
             self.channel_name
         )
-        await self.accept()
+        await self.accept_protocol()
 
-        # Add user to the online set and broadcast the updated user list
-        ChatConsumer.online_users.add(self.user.username)
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'user_list_update',
-                'users': sorted(list(ChatConsumer.online_users))
-            }
-        )
+        # Add user to the online users and broadcast the updated user list
+        online_users = await presence.join(self.channel_layer, self.room_group_name, self.user)
+        await self.channel_layer.group_send(self.room_group_name, self.user_list_event(online_users))
 
     async def disconnect(self, close_code):
-        # Remove user from the online set and broadcast the updated list
+        # Remove user from the online users and broadcast the updated list
         if self.user.is_authenticated:
-            ChatConsumer.online_users.discard(self.user.username)
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'user_list_update',
-                    'users': sorted(list(ChatConsumer.online_users))
-                }
-            )
+            online_users = await presence.leave(self.channel_layer, self.room_group_name, self.user)
+            await self.channel_layer.group_send(self.room_group_name, self.user_list_event(online_users))
 
         # Leave room group
         await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
 
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
         """
         Receives a message from the WebSocket.
         If the message starts with '@bot', it's treated as a query for the AI.
         Otherwise, it's broadcast to the entire room.
         """
+        if not await self.admit_frame(text_data, bytes_data):
+            return
         try:
-            text_data_json = json.loads(text_data)
+            text_data_json = self.decode_client_frame(text_data, bytes_data)
             message = text_data_json['message']
-        except (json.JSONDecodeError, KeyError):
-            logger.warning("ChatConsumer received malformed data: %s", text_data)
+            if not isinstance(message, str):
+                raise TypeError("message is not a string")
+        except (json.JSONDecodeError, FrameError, KeyError, TypeError):
+            logger.warning("ChatConsumer received malformed data: %s", text_data or bytes_data)
             return
 
         username = self.user.username
@@ -75,61 +248,40 @@ class ChatConsumer(AsyncWebsocketConsumer):
             query = message.strip()[5:]
 
             # Echo the user's query back to them so it appears in their log
-            await self.send(text_data=json.dumps({
+            await self.send_frame({
                 'type': 'chat_message',
                 'message': message,
-                'username': username
-            }))
-
-            # Use LangChain for a stateful conversation
-            session = self.scope['session']
-            model = settings.OLLAMA_MODEL
-            try:
-                chain = await sync_to_async(get_conversation_chain)(session, model)
-                response = await sync_to_async(chain.predict)(input=query)
-                await sync_to_async(save_conversation_history)(session, model, chain)
-
-                await self.send(text_data=json.dumps({
-                    'type': 'chat_message',
-                    'message': response,
-                    'username': f'AI Assistant ({model})'
-                }))
-            except Exception as e:
-                logger.error(f"Error in ChatConsumer with LangChain: {e}", exc_info=True)
-                await self.send(text_data=json.dumps({
-                    'type': 'chat_message',
-                    'message': "Sorry, I had a problem processing that.",
-                    'username': 'AI Assistant'
-                }))
+                'username': username,
+                'user_id': self.user.id
+            })
+
+            # Use LangChain for a stateful conversation, streamed as it is generated
+            await self.stream_bot_reply(query, use_cache=text_data_json.get('cache', True))
         else:
             # Broadcast the message to the room group
             await self.channel_layer.group_send(
                 self.room_group_name,
-                {
+                group_event('chat_message', {
                     'type': 'chat_message',
                     'message': message,
-                    'username': username
-                }
+                    'username': username,
+                    'user_id': self.user.id
+                })
             )
 
     async def chat_message(self, event):
-        """Receives a message from the room group and sends it to the WebSocket."""
-        await self.send(text_data=json.dumps({
-            'type': 'chat_message',
-            'message': event['message'],
-            'username': event['username']
-        }))
+        """Forwards a message from the room group, already encoded by the sender, to the WebSocket."""
+        await self.forward_event(event)
 
     async def user_list_update(self, event):
-        """Receives a user list update and sends it to the WebSocket."""
-        await self.send(text_data=json.dumps({
-            'type': 'user_list',
-            'users': event['users']
-        }))
+        """Forwards a pre-encoded user list update to the WebSocket."""
+        await self.forward_event(event)
 
 @sync_to_async
 def get_thread(user1, user2_id):
-    user2 = User.objects.get(id=user2_id)
+    user2 = User.objects.filter(id=user2_id, is_active=True).first()
+    if user2 is None:
+        return None
     # Correctly find a thread with exactly two participants
     thread = Thread.objects.annotate(
         p_count=Count('participants')
@@ -144,10 +296,23 @@ def get_thread(user1, user2_id):
     return thread
 
 @sync_to_async
-def save_message(thread, sender, text):
-    return Message.objects.create(thread=thread, sender=sender, text=text)
+def save_message(thread, sender, text, participant_ids):
+    with transaction.atomic():
+        message = Message.objects.create(thread=thread, sender=sender, text=text)
+        record_message(message, participant_ids)
+    return message
+
+mark_thread_read = sync_to_async(mark_read)
+
+@sync_to_async
+def load_history(thread_id, before):
+    messages, next_cursor = history_page(thread_id, before)
+    return [
+        {'id': message.id, 'user_id': message.sender_id, 'username': message.sender.username, 'message': message.text}
+        for message in messages
+    ], next_cursor
 
-class PrivateChatConsumer(AsyncWebsocketConsumer):
+class PrivateChatConsumer(ConsumerMetricsMixin, FrameProtocolMixin, BotReplyMixin, AsyncWebsocketConsumer):
     """Handles WebSocket connections for private one-on-one chats."""
     async def connect(self):
         self.user = self.scope['user']
@@ -160,19 +325,36 @@ class PrivateChatConsumer(AsyncWebsocketConsumer):
         user_ids = sorted([self.user.id, int(self.other_user_id)])
         self.room_group_name = f'private_chat_{user_ids[0]}_{user_ids[1]}'
         self.thread = await get_thread(self.user, self.other_user_id)
+        if self.thread is None:
+            await self.close()
+            return
 
         await self.channel_layer.group_add(self.room_group_name, self.channel_name)
-        await self.accept()
+        await self.accept_protocol()
 
     async def disconnect(self, close_code):
         await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
 
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
+        if not await self.admit_frame(text_data, bytes_data):
+            return
         try:
-            text_data_json = json.loads(text_data)
+            text_data_json = self.decode_client_frame(text_data, bytes_data)
+            if text_data_json.get('type') == 'read':
+                # Read receipt: the user has seen the thread up to now.
+                await mark_thread_read(self.user, self.thread.id)
+                return
+            if text_data_json.get('type') == 'history':
+                # An older page of the thread, recent or archived.
+                before = text_data_json.get('before')
+                messages, next_cursor = await load_history(self.thread.id, int(before) if before else None)
+                await self.send_frame({'type': 'history', 'messages': messages, 'before': next_cursor})
+                return
             message = text_data_json['message']
-        except (json.JSONDecodeError, KeyError):
-            logger.warning("PrivateChatConsumer received malformed data: %s", text_data)
+            if not isinstance(message, str):
+                raise TypeError("message is not a string")
+        except (json.JSONDecodeError, FrameError, KeyError, TypeError, ValueError, AttributeError):
+            logger.warning("PrivateChatConsumer received malformed data: %s", text_data or bytes_data)
             return
 
         username = self.user.username
@@ -181,42 +363,24 @@ class PrivateChatConsumer(AsyncWebsocketConsumer):
             query = message.strip()[5:]
 
             # Echo the user's query back to them so it appears in their log
-            await self.send(text_data=json.dumps({
+            await self.send_frame({
                 'type': 'chat_message',
                 'message': message,
-                'username': username
-            }))
+                'username': username,
+                'user_id': self.user.id
+            })
 
             # Use LangChain for a stateful conversation, private to the user
-            session = self.scope['session']
-            model = settings.OLLAMA_MODEL
-            try:
-                chain = await sync_to_async(get_conversation_chain)(session, model)
-                response = await sync_to_async(chain.predict)(input=query)
-                await sync_to_async(save_conversation_history)(session, model, chain)
-
-                await self.send(text_data=json.dumps({
-                    'type': 'chat_message',
-                    'message': response,
-                    'username': f'AI Assistant ({model})'
-                }))
-            except Exception as e:
-                logger.error(f"Error in PrivateChatConsumer with LangChain: {e}", exc_info=True)
-                await self.send(text_data=json.dumps({
-                    'type': 'chat_message',
-                    'message': "Sorry, I had a problem processing that.",
-                    'username': 'AI Assistant'
-                }))
+            await self.stream_bot_reply(query, use_cache=text_data_json.get('cache', True))
         else:
             # It's a regular message for the other user; save and broadcast it.
-            await save_message(self.thread, self.user, message)
+            await save_message(self.thread, self.user, message, [self.user.id, int(self.other_user_id)])
             await self.channel_layer.group_send(
                 self.room_group_name,
-                {'type': 'chat_message', 'message': message, 'username': username}
+                group_event('chat_message', {
+                    'type': 'chat_message', 'message': message, 'username': username, 'user_id': self.user.id
+                })
             )
 
     async def chat_message(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'chat_message',
-            'message': event['message'], 'username': event['username']
-        }))
\ No newline at end of file
+        await self.forward_event(event)
\ No newline at end of file
@@ -0,0 +1,172 @@
+"""
+The LangChain side of the AI assistant: conversation chains with stored
+memory (see `chat.memory`), streamed through the LLM scheduler, and the
+`ChatOllama` model that talks to Ollama through the pooled clients.
+
+LangChain takes a second or more and tens of megabytes to import, so only
+this module and `chat.memory` import it, and nothing imports them when the
+project loads: views and consumers get this module from
+`chat.utils.aload_conversation` when they first need it, and ASGI startup
+preloads it in the background when CHAT_LANGCHAIN_WARMUP is on. Workers
+that only serve media never load LangChain.
+"""
+from django.conf import settings
+from langchain.chains import LLMChain
+from langchain.prompts import (
+    ChatPromptTemplate,
+    MessagesPlaceholder,
+    SystemMessagePromptTemplate,
+    HumanMessagePromptTemplate,
+)
+from langchain_community.chat_models import ChatOllama
+from langchain_community.llms.ollama import OllamaEndpointNotFoundError
+
+from .completion_cache import make_key
+from .memory import aload_memory, asave_memory, aclear_memory
+from .ollama_client import astream, stream
+from .retrieval import aretrieve_context
+from .scheduler import get_scheduler
+from .utils import SYSTEM_PROMPT, get_cached_completion, store_completion
+
+class PooledChatOllama(ChatOllama):
+    """
+    `ChatOllama` that talks to Ollama through the shared pooled clients
+    instead of opening a new `requests`/`aiohttp` session for every call.
+    """
+
+    def _request_payload(self, payload, stop=None, **kwargs):
+        # Mirrors how `ChatOllama` assembles the request body.
+        if self.stop is not None and stop is not None:
+            raise ValueError("`stop` found in both the input and default params.")
+        elif self.stop is not None:
+            stop = self.stop
+
+        params = self._default_params
+        for key in self._default_params:
+            if key in kwargs:
+                params[key] = kwargs[key]
+
+        if "options" in kwargs:
+            params["options"] = kwargs["options"]
+        else:
+            params["options"] = {
+                **params["options"],
+                "stop": stop,
+                **{k: v for k, v in kwargs.items() if k not in self._default_params},
+            }
+
+        if payload.get("messages"):
+            return {"messages": payload.get("messages", []), **params}
+        return {"prompt": payload.get("prompt"), "images": payload.get("images", []), **params}
+
+    def _request_headers(self):
+        return self.headers if isinstance(self.headers, dict) else {}
+
+    def _check_status(self, status_code, detail):
+        if status_code == 404:
+            raise OllamaEndpointNotFoundError(
+                "Ollama call failed with status code 404. "
+                f"Maybe your model is not found and you should pull the model with `ollama pull {self.model}`."
+            )
+        raise ValueError(f"Ollama call failed with status code {status_code}. Details: {detail}")
+
+    def _create_stream(self, api_url, payload, stop=None, **kwargs):
+        response = stream(
+            'POST', api_url,
+            json=self._request_payload(payload, stop, **kwargs),
+            headers=self._request_headers(),
+            auth=self.auth,
+        )
+        try:
+            if response.status_code != 200:
+                response.read()
+                self._check_status(response.status_code, response.text)
+            yield from response.iter_lines()
+        finally:
+            response.close()
+
+    async def _acreate_stream(self, api_url, payload, stop=None, **kwargs):
+        async with astream(
+            'POST', api_url,
+            json=self._request_payload(payload, stop, **kwargs),
+            headers=self._request_headers(),
+            auth=self.auth,
+        ) as response:
+            if response.status_code != 200:
+                await response.aread()
+                self._check_status(response.status_code, response.text)
+            async for line in response.aiter_lines():
+                yield line
+
+async def aget_conversation_chain(user, model_name: str):
+    """
+    Initializes a LangChain conversation chain, loading the user's windowed
+    conversation memory for the model.
+    """
+    llm = PooledChatOllama(model=model_name, base_url=settings.OLLAMA_HOST)
+    memory = await aload_memory(user, model_name)
+
+    prompt = ChatPromptTemplate(
+        messages=[
+            # `context` is site content retrieved for the question, if any.
+            SystemMessagePromptTemplate.from_template(SYSTEM_PROMPT + "{context}"),
+            MessagesPlaceholder(variable_name="history"),
+            HumanMessagePromptTemplate.from_template("{input}")
+        ]
+    )
+
+    # LLMChain is a good general-purpose chain.
+    chain = LLMChain(llm=llm, prompt=prompt, memory=memory, verbose=settings.DEBUG)
+    return chain
+
+async def asave_conversation_history(chain):
+    """
+    Appends the turns added during this request to the stored conversation
+    and starts summarizing turns that have dropped out of the memory window.
+    """
+    await asave_memory(chain.memory, llm=chain.llm)
+
+def conversation_cache_key(chain, query: str, context: str = '') -> str:
+    """Builds the completion cache key for the next turn of a conversation chain."""
+    history = [(message.type, message.content) for message in chain.memory.buffer_as_messages]
+    return make_key(chain.llm.model, SYSTEM_PROMPT + context, history, query)
+
+async def stream_conversation(chain, query: str, use_cache: bool = True, user_key=None, on_position=None):
+    """
+    Streams the chain's reply to `query` chunk by chunk.
+
+    The prompt is built exactly as `chain.predict` would build it, with the
+    site content most relevant to `query` added to the system prompt (see
+    `chat.retrieval`), but the LLM is invoked in streaming mode through the
+    LLM scheduler. A cached
+    completion is yielded as a single chunk. Once the stream is exhausted the
+    complete turn is recorded in the chain's memory, so
+    `asave_conversation_history` can be called afterwards as usual.
+    """
+    context = await aretrieve_context(query)
+    cache_key = conversation_cache_key(chain, query, context)
+    reply = get_cached_completion(cache_key, use_cache)
+    if reply is not None:
+        yield reply
+    else:
+        inputs = chain.prep_inputs({'input': query, 'context': context})
+        messages = chain.prompt.format_messages(**inputs)
+
+        async def generate():
+            async for chunk in chain.llm.astream(messages):
+                if chunk.content:
+                    yield chunk.content
+
+        chunks = []
+        scheduler_key = cache_key if use_cache else None
+        async for chunk in get_scheduler().stream(chain.llm.model, user_key, scheduler_key, generate, on_position):
+            chunks.append(chunk)
+            yield chunk
+        reply = ''.join(chunks)
+        store_completion(cache_key, reply, use_cache)
+
+    chain.memory.save_context({'input': query}, {chain.output_key: reply})
+
+async def aclear_conversation_history(user, model_name: str):
+    """Clears the user's conversation history for a given model."""
+    await aclear_memory(user, model_name)
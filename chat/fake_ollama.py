@@ -0,0 +1,122 @@
+"""
+A minimal, in-process stand-in for the Ollama HTTP API.
+
+It answers `/api/tags`, `/api/chat` and `/api/generate` (streaming and
+non-streaming) with a fixed number of tokens, sleeping between tokens to
+mimic inference. It supports keep-alive so pooled clients behave as they
+would against a real Ollama. Used by the benchmark commands; it is not
+meant for production.
+"""
+import asyncio
+import json
+
+class FakeOllamaServer:
+    def __init__(self, host='127.0.0.1', port=0, tokens=20, token_delay=0.01, models=('llama3',)):
+        self.host = host
+        self.port = port
+        self.tokens = tokens
+        self.token_delay = token_delay
+        self.models = list(models)
+        self.requests = 0
+        self._server = None
+        self._handlers = set()
+
+    @property
+    def url(self):
+        return f'http://{self.host}:{self.port}'
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            # Close kept-alive connections so their handlers finish cleanly.
+            for handler in list(self._handlers):
+                handler.cancel()
+            await asyncio.gather(*self._handlers, return_exceptions=True)
+            await self._server.wait_closed()
+            self._server = None
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc_info):
+        await self.stop()
+
+    def _token(self, index):
+        return f'token{index} '
+
+    async def _handle(self, reader, writer):
+        self._handlers.add(asyncio.current_task())
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                self.requests += 1
+                await self._respond(writer, method, path, json.loads(body) if body else {})
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            self._handlers.discard(asyncio.current_task())
+            writer.close()
+
+    async def _respond(self, writer, method, path, payload):
+        if method == 'GET' and path == '/api/tags':
+            await self._send_json(writer, {'models': [{'name': name} for name in self.models]})
+        elif method == 'POST' and path in ('/api/chat', '/api/generate'):
+            if payload.get('stream', True):
+                await self._stream(writer, path, payload)
+            else:
+                await asyncio.sleep(self.token_delay * self.tokens)
+                content = ''.join(self._token(i) for i in range(self.tokens))
+                await self._send_json(writer, self._chunk(path, payload, content, done=True))
+        else:
+            await self._send_json(writer, {'error': 'not found'}, status='404 Not Found')
+
+    def _chunk(self, path, payload, content, done):
+        chunk = {'model': payload.get('model'), 'done': done}
+        if path == '/api/chat':
+            chunk['message'] = {'role': 'assistant', 'content': content}
+        else:
+            chunk['response'] = content
+        return chunk
+
+    async def _send_json(self, writer, data, status='200 OK'):
+        body = json.dumps(data).encode()
+        writer.write(
+            f'HTTP/1.1 {status}\r\nContent-Type: application/json\r\n'
+            f'Content-Length: {len(body)}\r\n\r\n'.encode() + body
+        )
+        await writer.drain()
+
+    async def _stream(self, writer, path, payload):
+        writer.write(
+            b'HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\n'
+            b'Transfer-Encoding: chunked\r\n\r\n'
+        )
+        for index in range(self.tokens + 1):
+            if index < self.tokens:
+                await asyncio.sleep(self.token_delay)
+                chunk = self._chunk(path, payload, self._token(index), done=False)
+            else:
+                chunk = self._chunk(path, payload, '', done=True)
+            line = (json.dumps(chunk) + '\n').encode()
+            writer.write(b'%x\r\n%s\r\n' % (len(line), line))
+            await writer.drain()
+        writer.write(b'0\r\n\r\n')
+        await writer.drain()
@@ -0,0 +1,351 @@
+"""
+A minimal, in-process stand-in for a Redis server.
+
+It speaks RESP2 and implements just the commands `chat.channel_layer` uses
+(lists with blocking pops, sorted sets, hashes, expiry, key scans and
+WATCH/MULTI/EXEC transactions), so
+the chat can be run across several worker processes on one machine without
+a real Redis:
+
+    python manage.py run_fake_redis --port 6379
+    CHANNEL_REDIS_HOSTS=redis://127.0.0.1:6379 daphne -p 8001 media_sharing_project.asgi:application
+    CHANNEL_REDIS_HOSTS=redis://127.0.0.1:6379 daphne -p 8002 media_sharing_project.asgi:application
+
+Data lives in memory only. It is not meant for production. Unlike Redis,
+EXEC compares the watched keys' values, not whether they were written.
+"""
+import asyncio
+import copy
+import fnmatch
+import time
+from collections import deque
+
+class CommandError(Exception):
+    pass
+
+# Reply for a blocking pop that timed out, and for an aborted transaction.
+_NULL_ARRAY = object()
+# Reply for a command queued in a transaction.
+_QUEUED = object()
+
+class _Session:
+    """Transaction state of one client connection."""
+
+    def __init__(self):
+        # Watched key -> copy of its value when it was watched.
+        self.watched = {}
+        # Commands queued since MULTI, or None outside a transaction.
+        self.queued = None
+
+class FakeRedisServer:
+    def __init__(self, host='127.0.0.1', port=0):
+        self.host = host
+        self.port = port
+        self.commands = 0
+        self._data = {}
+        self._expires = {}
+        self._pushed = asyncio.Condition()
+        self._server = None
+        self._handlers = set()
+
+    @property
+    def url(self):
+        return f'redis://{self.host}:{self.port}'
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            for handler in list(self._handlers):
+                handler.cancel()
+            await asyncio.gather(*self._handlers, return_exceptions=True)
+            await self._server.wait_closed()
+            self._server = None
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc_info):
+        await self.stop()
+
+    # Protocol
+
+    async def _read_command(self, reader):
+        line = await reader.readline()
+        if not line:
+            return None
+        if not line.startswith(b'*'):
+            # Inline command, e.g. from telnet.
+            return line.split()
+        args = []
+        for _ in range(int(line[1:])):
+            length = int((await reader.readline())[1:])
+            args.append((await reader.readexactly(length + 2))[:-2])
+        return args
+
+    def _encode(self, value):
+        if value is None:
+            return b'$-1\r\n'
+        if value is True:
+            return b'+OK\r\n'
+        if isinstance(value, CommandError):
+            return b'-ERR %s\r\n' % str(value).encode()
+        if isinstance(value, int):
+            return b':%d\r\n' % value
+        if isinstance(value, str):
+            value = value.encode()
+        if isinstance(value, bytes):
+            return b'$%d\r\n%s\r\n' % (len(value), value)
+        if isinstance(value, float):
+            return self._encode(repr(value))
+        return b'*%d\r\n' % len(value) + b''.join(self._encode(item) for item in value)
+
+    async def _handle(self, reader, writer):
+        self._handlers.add(asyncio.current_task())
+        session = _Session()
+        try:
+            while True:
+                args = await self._read_command(reader)
+                if not args:
+                    break
+                self.commands += 1
+                result = await self._dispatch(session, args[0].decode().lower(), args[1:])
+                if result is _NULL_ARRAY:
+                    writer.write(b'*-1\r\n')
+                elif result is _QUEUED:
+                    writer.write(b'+QUEUED\r\n')
+                else:
+                    writer.write(self._encode(result))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            self._handlers.discard(asyncio.current_task())
+            writer.close()
+
+    async def _call(self, name, args):
+        method = getattr(self, f'cmd_{name}', None)
+        try:
+            if method is None:
+                raise CommandError(f"unknown command '{name}'")
+            result = method(*args)
+            if asyncio.iscoroutine(result):
+                result = await result
+        except CommandError as e:
+            result = e
+        except (TypeError, ValueError):
+            result = CommandError(f"wrong arguments for '{name}'")
+        return result
+
+    async def _dispatch(self, session, name, args):
+        if name == 'multi':
+            session.queued = []
+            return True
+        if name == 'exec':
+            return await self._exec(session)
+        if name == 'discard':
+            session.queued = None
+            session.watched.clear()
+            return True
+        if session.queued is not None:
+            session.queued.append((name, args))
+            return _QUEUED
+        if name == 'watch':
+            for key in args:
+                session.watched[key] = copy.deepcopy(self._get(key))
+            return True
+        if name == 'unwatch':
+            session.watched.clear()
+            return True
+        return await self._call(name, args)
+
+    async def _exec(self, session):
+        queued, session.queued = session.queued, None
+        watched, session.watched = session.watched, {}
+        if queued is None:
+            return CommandError('EXEC without MULTI')
+        if any(self._get(key) != value for key, value in watched.items()):
+            return _NULL_ARRAY
+        # Queued commands do not block, so nothing runs between them.
+        return [await self._call(name, args) for name, args in queued]
+
+    # Storage
+
+    def _get(self, key, kind=None, create=False):
+        deadline = self._expires.get(key)
+        if deadline is not None and deadline <= time.monotonic():
+            self._delete(key)
+        value = self._data.get(key)
+        if value is None and create:
+            value = self._data[key] = kind()
+        if value is not None and kind is not None and not isinstance(value, kind):
+            raise CommandError('WRONGTYPE Operation against a key holding the wrong kind of value')
+        return value
+
+    def _delete(self, key):
+        self._expires.pop(key, None)
+        return self._data.pop(key, None) is not None
+
+    def _cleanup(self, key):
+        if key in self._data and not self._data[key]:
+            self._delete(key)
+
+    # Commands
+
+    def cmd_ping(self, *args):
+        return args[0] if args else 'PONG'
+
+    def cmd_client(self, *args):
+        return True
+
+    def cmd_select(self, index):
+        return True
+
+    def cmd_flushall(self, *args):
+        self._data.clear()
+        self._expires.clear()
+        return True
+
+    cmd_flushdb = cmd_flushall
+
+    def cmd_del(self, *keys):
+        return sum(self._delete(key) for key in keys if self._get(key) is not None)
+
+    def cmd_exists(self, *keys):
+        return sum(1 for key in keys if self._get(key) is not None)
+
+    def cmd_expire(self, key, seconds):
+        if self._get(key) is None:
+            return 0
+        self._expires[key] = time.monotonic() + int(seconds)
+        return 1
+
+    def cmd_keys(self, pattern):
+        pattern = pattern.decode()
+        return [key for key in list(self._data) if self._get(key) is not None and fnmatch.fnmatchcase(key.decode(), pattern)]
+
+    def cmd_scan(self, cursor, *args):
+        options = dict(zip(args[::2], args[1::2]))
+        pattern = options.get(b'MATCH', options.get(b'match', b'*'))
+        return [b'0', self.cmd_keys(pattern)]
+
+    async def cmd_rpush(self, key, *values):
+        items = self._get(key, deque, create=True)
+        items.extend(values)
+        async with self._pushed:
+            self._pushed.notify_all()
+        return len(items)
+
+    def cmd_lpop(self, key):
+        items = self._get(key, deque)
+        if not items:
+            return None
+        value = items.popleft()
+        self._cleanup(key)
+        return value
+
+    def cmd_llen(self, key):
+        return len(self._get(key, deque) or ())
+
+    def cmd_lrange(self, key, start, stop):
+        items = list(self._get(key, deque) or ())
+        start, stop = int(start), int(stop)
+        return items[start:None if stop == -1 else stop + 1]
+
+    def cmd_ltrim(self, key, start, stop):
+        items = self._get(key, deque)
+        if items is None:
+            return True
+        start, stop = int(start), int(stop)
+        if start == 0 and stop >= 0:
+            # The channel layer's capping trim: drop from the tail in place.
+            while len(items) > stop + 1:
+                items.pop()
+        else:
+            kept = self.cmd_lrange(key, start, stop)
+            items.clear()
+            items.extend(kept)
+        self._cleanup(key)
+        return True
+
+    async def cmd_blpop(self, *args):
+        *keys, timeout = args
+        timeout = float(timeout)
+        deadline = time.monotonic() + timeout if timeout else None
+        async with self._pushed:
+            while True:
+                for key in keys:
+                    value = self.cmd_lpop(key)
+                    if value is not None:
+                        return [key, value]
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return _NULL_ARRAY
+                try:
+                    await asyncio.wait_for(self._pushed.wait(), remaining)
+                except asyncio.TimeoutError:
+                    return _NULL_ARRAY
+
+    def cmd_zadd(self, key, *args):
+        members = self._get(key, dict, create=True)
+        added = 0
+        for score, member in zip(args[::2], args[1::2]):
+            added += member not in members
+            members[member] = float(score)
+        return added
+
+    def cmd_zrem(self, key, *members):
+        scores = self._get(key, dict)
+        if scores is None:
+            return 0
+        removed = sum(scores.pop(member, None) is not None for member in members)
+        self._cleanup(key)
+        return removed
+
+    def _sorted_members(self, key):
+        scores = self._get(key, dict) or {}
+        return sorted(scores, key=lambda member: (scores[member], member))
+
+    def cmd_zrange(self, key, start, stop):
+        members = self._sorted_members(key)
+        start, stop = int(start), int(stop)
+        return members[start:None if stop == -1 else stop + 1]
+
+    def cmd_zcard(self, key):
+        return len(self._get(key, dict) or ())
+
+    def cmd_zremrangebyscore(self, key, low, high):
+        scores = self._get(key, dict)
+        if scores is None:
+            return 0
+        low, high = float(low), float(high)
+        doomed = [member for member, score in scores.items() if low <= score <= high]
+        for member in doomed:
+            del scores[member]
+        self._cleanup(key)
+        return len(doomed)
+
+    def cmd_hincrby(self, key, field, amount):
+        fields = self._get(key, dict, create=True)
+        fields[field] = int(fields.get(field, 0)) + int(amount)
+        return fields[field]
+
+    def cmd_hget(self, key, field):
+        value = (self._get(key, dict) or {}).get(field)
+        return None if value is None else str(value)
+
+    def cmd_hdel(self, key, *names):
+        fields = self._get(key, dict)
+        if fields is None:
+            return 0
+        removed = sum(fields.pop(name, None) is not None for name in names)
+        self._cleanup(key)
+        return removed
+
+    def cmd_hgetall(self, key):
+        fields = self._get(key, dict) or {}
+        return [item for name, value in fields.items() for item in (name, str(value))]
@@ -0,0 +1,93 @@
+"""
+Per-user inbox of private conversations.
+
+Every participant of a thread has an `InboxEntry` holding the thread's last
+message preview, its time and the participant's unread count. Entries are
+updated incrementally as messages are saved (`record_message`) and cleared
+by read receipts (`mark_read`), so listing the inbox is one query on the
+`(user, -last_activity, -id)` index, paginated by keyset rather than offset.
+"""
+from datetime import datetime, timedelta, timezone
+
+from django.conf import settings
+from django.db.models import Case, F, Q, Value, When
+from django.utils.text import Truncator
+
+from .models import InboxEntry
+
+PREVIEW_LENGTH = 100
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+def _other_user_id(user_id, participant_ids):
+    others = [other for other in participant_ids if other != user_id]
+    return others[0] if len(others) == 1 else None
+
+def record_message(message, participant_ids):
+    """
+    Updates the inbox entries of `participant_ids` for a newly saved
+    `message`: the sender's unread count is reset, everyone else's goes up
+    by one. Call it in the transaction that saved the message.
+    """
+    preview = Truncator(message.text).chars(PREVIEW_LENGTH)
+    entries = InboxEntry.objects.filter(thread_id=message.thread_id, user_id__in=participant_ids)
+    updated = entries.update(
+        last_sender_id=message.sender_id,
+        last_message_preview=preview,
+        last_activity=message.created_at,
+        unread_count=Case(When(user_id=message.sender_id, then=Value(0)), default=F('unread_count') + 1),
+    )
+    if updated == len(participant_ids):
+        return
+
+    # First message in this thread for some participants.
+    existing = set(entries.values_list('user_id', flat=True))
+    InboxEntry.objects.bulk_create([
+        InboxEntry(
+            user_id=user_id,
+            thread_id=message.thread_id,
+            other_user_id=_other_user_id(user_id, participant_ids),
+            last_sender_id=message.sender_id,
+            last_message_preview=preview,
+            last_activity=message.created_at,
+            unread_count=0 if user_id == message.sender_id else 1,
+        )
+        for user_id in participant_ids if user_id not in existing
+    ], ignore_conflicts=True)
+
+def mark_read(user, thread_id):
+    """Clears `user`'s unread count for a thread."""
+    InboxEntry.objects.filter(user=user, thread_id=thread_id, unread_count__gt=0).update(unread_count=0)
+
+def encode_cursor(entry) -> str:
+    timestamp = (entry.last_activity - _EPOCH) // timedelta(microseconds=1)
+    return f'{timestamp}-{entry.id}'
+
+def decode_cursor(cursor):
+    """Returns `(last_activity, id)` for a cursor, or None if it is malformed."""
+    try:
+        timestamp, entry_id = (int(part) for part in cursor.split('-'))
+    except (AttributeError, ValueError):
+        return None
+    return _EPOCH + timedelta(microseconds=timestamp), entry_id
+
+def inbox_page(user, before=None, limit=None):
+    """
+    Returns `(entries, next_cursor)`: up to `limit` of `user`'s inbox entries,
+    most recent first, older than the `before` cursor if given.
+    `next_cursor` is None on the last page.
+    """
+    limit = limit or settings.CHAT_INBOX_PAGE_SIZE
+    # Conversations with deleted (deactivated) users are hidden.
+    entries = (
+        InboxEntry.objects.filter(user=user).exclude(other_user__is_active=False)
+        .select_related('other_user', 'last_sender')
+    )
+    position = decode_cursor(before) if before else None
+    if position is not None:
+        last_activity, entry_id = position
+        entries = entries.filter(Q(last_activity__lt=last_activity) | Q(last_activity=last_activity, id__lt=entry_id))
+    entries = list(entries.order_by('-last_activity', '-id')[:limit + 1])
+
+    next_cursor = encode_cursor(entries[limit - 1]) if len(entries) > limit else None
+    return entries[:limit], next_cursor
@@ -0,0 +1,26 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from chat.archive import archive_messages
+
+class Command(BaseCommand):
+    help = (
+        "Moves private messages older than CHAT_ARCHIVE_AFTER_DAYS days from the "
+        "message table to the archive, in short batches. Run it periodically."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than-days', type=float, help='Archive messages older than this (default: CHAT_ARCHIVE_AFTER_DAYS).')
+        parser.add_argument('--batch-size', type=int, help='Messages moved per transaction (default: CHAT_ARCHIVE_BATCH_SIZE).')
+
+    def handle(self, *args, **options):
+        days = options['older_than_days']
+        if days is None:
+            days = settings.CHAT_ARCHIVE_AFTER_DAYS
+        started = time.perf_counter()
+        moved = archive_messages(timezone.now() - timedelta(days=days), options['batch_size'])
+        self.stdout.write(f"Archived {moved} messages in {time.perf_counter() - started:.1f}s")
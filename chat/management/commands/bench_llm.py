@@ -0,0 +1,118 @@
+import asyncio
+import json
+import statistics
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+
+from chat.fake_ollama import FakeOllamaServer
+from chat.ollama_client import aclose_clients
+from chat.conversation import aget_conversation_chain, asave_conversation_history, stream_conversation
+
+class Command(BaseCommand):
+    help = (
+        "Benchmarks concurrent AI assistant conversations against an in-process "
+        "fake Ollama server, comparing the thread-offloaded `chain.predict` "
+        "pipeline with the native async one. Runs against a throwaway test database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--conversations', type=int, default=50, help='Concurrent conversations.')
+        parser.add_argument('--turns', type=int, default=2, help='Turns per conversation.')
+        parser.add_argument('--tokens', type=int, default=20, help='Tokens per fake reply.')
+        parser.add_argument('--token-delay', type=float, default=0.005, help='Seconds between fake tokens.')
+        parser.add_argument('--mode', choices=['threaded', 'async', 'both'], default='both')
+        parser.add_argument('--json', action='store_true', help='Print machine-readable results.')
+
+    def handle(self, *args, **options):
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            results = asyncio.run(self.run(options))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+        for mode, result in results.items():
+            self.stdout.write(
+                f"{mode:>8}: {result['turns']} turns in {result['wall_seconds']:.2f}s "
+                f"({result['turns_per_second']:.1f}/s), latency p50 {result['p50_ms']:.0f}ms "
+                f"p95 {result['p95_ms']:.0f}ms, peak threads {result['peak_threads']}"
+            )
+
+    async def run(self, options):
+        modes = ['threaded', 'async'] if options['mode'] == 'both' else [options['mode']]
+        conversations = options['conversations']
+        results = {}
+        async with FakeOllamaServer(tokens=options['tokens'], token_delay=options['token_delay']) as server:
+            overrides = override_settings(
+                DEBUG=False,
+                OLLAMA_HOST=server.url,
+                LLM_CACHE_ENABLED=False,
+                CHAT_MEMORY_SUMMARIZE=False,
+                LLM_MAX_CONCURRENCY=conversations,
+                LLM_MAX_QUEUE=conversations,
+                OLLAMA_MAX_CONNECTIONS=conversations,
+                OLLAMA_MAX_KEEPALIVE_CONNECTIONS=conversations,
+            )
+            overrides.enable()
+            try:
+                for mode in modes:
+                    users = await sync_to_async(self.create_users)(mode, conversations)
+                    results[mode] = await self.measure(mode, users, options['turns'])
+            finally:
+                # Drop pooled keep-alive connections before the fake server goes away.
+                await aclose_clients()
+                overrides.disable()
+        return results
+
+    def create_users(self, mode, count):
+        User.objects.bulk_create([User(username=f'bench-{mode}-{i}') for i in range(count)])
+        return list(User.objects.filter(username__startswith=f'bench-{mode}-'))
+
+    async def threaded_turn(self, user, query):
+        # The pipeline as it was: inference runs in a worker thread.
+        chain = await aget_conversation_chain(user, settings.OLLAMA_MODEL)
+        reply = await sync_to_async(chain.predict)(input=query, context='')
+        await asave_conversation_history(chain)
+        return reply
+
+    async def async_turn(self, user, query):
+        chain = await aget_conversation_chain(user, settings.OLLAMA_MODEL)
+        reply = ''.join([chunk async for chunk in stream_conversation(chain, query, use_cache=False, user_key=user.id)])
+        await asave_conversation_history(chain)
+        return reply
+
+    async def measure(self, mode, users, turns):
+        turn = self.threaded_turn if mode == 'threaded' else self.async_turn
+        latencies = []
+        peak_threads = threading.active_count()
+
+        async def conversation(user):
+            nonlocal peak_threads
+            for index in range(turns):
+                started = time.perf_counter()
+                await turn(user, f'Question {index} from {user.username}')
+                latencies.append(time.perf_counter() - started)
+                peak_threads = max(peak_threads, threading.active_count())
+
+        started = time.perf_counter()
+        await asyncio.gather(*(conversation(user) for user in users))
+        wall = time.perf_counter() - started
+
+        latencies.sort()
+        return {
+            'turns': len(latencies),
+            'wall_seconds': wall,
+            'turns_per_second': len(latencies) / wall,
+            'p50_ms': statistics.median(latencies) * 1000,
+            'p95_ms': latencies[int(len(latencies) * 0.95) - 1] * 1000,
+            'peak_threads': peak_threads,
+        }
@@ -0,0 +1,442 @@
+import asyncio
+import gc
+import json
+import os
+import platform
+import time
+import tracemalloc
+
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.auth.models import User
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+
+from chat.channel_layer import close_channel_layer
+from chat.fake_ollama import FakeOllamaServer
+from chat.fake_redis import FakeRedisServer
+from chat.ollama_client import aclose_clients
+from chat.scheduler import QueueTimeout, SchedulerError
+from chat.utils import aload_conversation
+
+SCENARIOS = ['public', 'private', 'bot']
+
+# Replies sent instead of an answer when the LLM scheduler turns a question away.
+REJECTIONS = {SchedulerError.message, QueueTimeout.message}
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def summarize_ms(values):
+    return {
+        'count': len(values),
+        'p50_ms': percentile(values, 0.5) * 1000 if values else None,
+        'p99_ms': percentile(values, 0.99) * 1000 if values else None,
+        'max_ms': max(values) * 1000 if values else None,
+    }
+
+def rss_bytes():
+    """Current resident set size of this process, or None where /proc is unavailable."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+def rates(connected, total, seconds):
+    return {
+        'connections': connected,
+        'failed_connections': total - connected,
+        'connect_seconds': seconds,
+        'connects_per_second': connected / seconds if seconds else 0,
+    }
+
+class BenchClient:
+    """
+    A simulated browser: a WebSocket to the real ASGI application, plus a
+    task reading its frames as they arrive and passing them to `on_frame`.
+    """
+
+    def __init__(self, application, path, session_key):
+        self.communicator = WebsocketCommunicator(
+            application, path, headers=[(b'cookie', f'sessionid={session_key}'.encode())]
+        )
+        self.on_frame = None
+        self.frames = 0
+        self.last_frame_at = 0.0
+        self._reader = None
+
+    async def connect(self, timeout):
+        connected, _ = await self.communicator.connect(timeout)
+        if connected:
+            self._reader = asyncio.ensure_future(self._read())
+        return connected
+
+    async def _read(self):
+        # Reads the output queue directly: `receive_output` cancels the
+        # application when it times out.
+        while True:
+            message = await self.communicator.output_queue.get()
+            if message['type'] != 'websocket.send':
+                return
+            self.frames += 1
+            self.last_frame_at = time.perf_counter()
+            if self.on_frame is not None and message.get('text') is not None:
+                self.on_frame(json.loads(message['text']), self.last_frame_at)
+
+    async def send(self, data):
+        await self.communicator.send_to(text_data=json.dumps(data))
+
+    async def disconnect(self):
+        if self._reader is not None:
+            self._reader.cancel()
+        await self.communicator.disconnect(timeout=10)
+
+class Command(BaseCommand):
+    help = (
+        "Load-tests the chat WebSocket consumers in-process: thousands of "
+        "simulated clients connect to the ASGI application from "
+        "media_sharing_project/asgi.py. Reports connect rate, fan-out latency, "
+        "memory per connection, message throughput and @bot latency against a "
+        "fake Ollama server. Runs against a throwaway test database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=1000, help='Clients in the public room.')
+        parser.add_argument('--messages', type=int, default=20, help='Broadcasts sent to the public room.')
+        parser.add_argument('--message-interval', type=float, default=0.05, help='Seconds between broadcasts.')
+        parser.add_argument('--pairs', type=int, default=200, help='Pairs of clients in private rooms.')
+        parser.add_argument('--bots', type=int, default=20, help='Concurrent @bot questions.')
+        parser.add_argument('--tokens', type=int, default=20, help='Tokens per fake @bot reply.')
+        parser.add_argument('--token-delay', type=float, default=0.005, help='Seconds between fake tokens.')
+        parser.add_argument(
+            '--memory-sample', type=int, default=100,
+            help='Connections of each scenario measured for memory with allocation tracing.',
+        )
+        parser.add_argument('--connect-concurrency', type=int, default=100, help='Connections opened at once.')
+        parser.add_argument('--timeout', type=float, default=60, help='Seconds to wait for each phase.')
+        parser.add_argument('--scenario', action='append', choices=SCENARIOS, help='Run only these scenarios.')
+        parser.add_argument(
+            '--fake-redis', action='store_true',
+            help='Use the Redis channel layer against an in-process fake Redis server.',
+        )
+        parser.add_argument('--output', help='Write the results as JSON to this file.')
+        parser.add_argument('--json', action='store_true', help='Print machine-readable results.')
+
+    def handle(self, *args, **options):
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            results = asyncio.run(self.run(options))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+        self.report(results)
+
+    def report(self, results):
+        def ms(value):
+            return '-' if value is None else f'{value:.1f}ms'
+
+        for name in SCENARIOS:
+            result = results.get(name)
+            if result is None:
+                continue
+            line = f"{name:>8}: {result['connections']} connections at {result['connects_per_second']:.0f}/s"
+            if result.get('bytes_per_connection') is not None:
+                line += f", {result['bytes_per_connection'] / 1024:.1f} KiB each"
+            if 'latency' in result:
+                latency = result['latency']
+                line += (
+                    f"; {result['delivered']}/{result['expected']} delivered, "
+                    f"{result['messages_per_second']:.0f} msgs/s, "
+                    f"latency p50 {ms(latency['p50_ms'])} p99 {ms(latency['p99_ms'])}"
+                )
+            if 'first_chunk' in result:
+                line += (
+                    f"; {result['completed']}/{result['questions']} answered ({result['rejected']} rejected), "
+                    f"first chunk p50 {ms(result['first_chunk']['p50_ms'])} p99 {ms(result['first_chunk']['p99_ms'])}, "
+                    f"reply p50 {ms(result['reply']['p50_ms'])} p99 {ms(result['reply']['p99_ms'])}"
+                )
+            self.stdout.write(line)
+
+    async def run(self, options):
+        from media_sharing_project.asgi import application
+
+        scenarios = options['scenario'] or SCENARIOS
+        results = {'config': self.config(options)}
+        async with FakeOllamaServer(tokens=options['tokens'], token_delay=options['token_delay']) as ollama:
+            redis = await FakeRedisServer().start() if options['fake_redis'] else None
+            overrides = {
+                'DEBUG': False,
+                'OLLAMA_HOST': ollama.url,
+                'LLM_CACHE_ENABLED': False,
+                'CHAT_MEMORY_SUMMARIZE': False,
+            }
+            if redis is not None:
+                overrides['CHANNEL_LAYERS'] = {
+                    'default': {
+                        'BACKEND': 'chat.channel_layer.RedisChannelLayer',
+                        'CONFIG': {**settings.CHANNEL_LAYERS['default'].get('CONFIG', {}), 'hosts': [redis.url]},
+                    }
+                }
+            with override_settings(**overrides):
+                results['config']['channel_layer'] = type(get_channel_layer()).__name__
+                try:
+                    for name in scenarios:
+                        results[name] = await getattr(self, f'run_{name}')(application, options)
+                finally:
+                    await aclose_clients()
+                    await close_channel_layer()
+                    if redis is not None:
+                        await redis.stop()
+        return results
+
+    def config(self, options):
+        return {
+            'started_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'options': {
+                key: options[key] for key in (
+                    'clients', 'messages', 'message_interval', 'pairs', 'bots', 'tokens',
+                    'token_delay', 'memory_sample', 'connect_concurrency', 'fake_redis',
+                )
+            },
+            'settings': {
+                key: getattr(settings, key) for key in (
+                    'CHAT_JSON_CODEC', 'CHAT_OUTBOUND_QUEUE_SIZE', 'CHAT_SLOW_CONSUMER_POLICY',
+                    'LLM_MAX_CONCURRENCY', 'LLM_MAX_QUEUE',
+                )
+            },
+        }
+
+    @sync_to_async
+    def create_sessions(self, prefix, count):
+        """Creates `count` users with a logged-in session each; returns `(user, session_key)` pairs."""
+        User.objects.bulk_create([User(username=f'{prefix}-{i}') for i in range(count)])
+        users = list(User.objects.filter(username__startswith=f'{prefix}-').order_by('id'))
+        sessions = []
+        for user in users:
+            session = SessionStore()
+            session[SESSION_KEY] = str(user.pk)
+            session[BACKEND_SESSION_KEY] = 'django.contrib.auth.backends.ModelBackend'
+            session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+            session.create()
+            sessions.append((user, session.session_key))
+        return sessions
+
+    async def connect_all(self, clients, options):
+        """Connects `clients`, a bounded number at a time; returns the connected ones and the elapsed time."""
+        semaphore = asyncio.Semaphore(options['connect_concurrency'])
+
+        async def connect(client):
+            async with semaphore:
+                return await client.connect(options['timeout'])
+
+        started = time.perf_counter()
+        connected = await asyncio.gather(*(connect(client) for client in clients))
+        elapsed = time.perf_counter() - started
+        return [client for client, ok in zip(clients, connected) if ok], elapsed
+
+    async def measure_memory(self, clients, options):
+        """
+        Connects a sample of `clients` with allocation tracing on, which
+        slows connecting down, so the rest are connected and timed without
+        it. Returns the connected sample and the bytes allocated per connection.
+        """
+        if not clients:
+            return [], None
+        gc.collect()
+        tracemalloc.start()
+        try:
+            before = tracemalloc.get_traced_memory()[0]
+            connected, _ = await self.connect_all(clients, options)
+            await self.settle(connected, timeout=options['timeout'])
+            gc.collect()
+            allocated = tracemalloc.get_traced_memory()[0] - before
+        finally:
+            tracemalloc.stop()
+        return connected, allocated / len(connected) if connected else None
+
+    async def settle(self, clients, quiet=0.5, timeout=60):
+        """Waits until no client has received a frame for `quiet` seconds."""
+        deadline = time.perf_counter() + timeout
+        while time.perf_counter() < deadline:
+            await asyncio.sleep(quiet / 5)
+            last = max((client.last_frame_at for client in clients), default=0)
+            if time.perf_counter() - last >= quiet:
+                return
+
+    async def disconnect_all(self, clients):
+        await asyncio.gather(*(client.disconnect() for client in clients), return_exceptions=True)
+
+    async def run_public(self, application, options):
+        """N clients in the public room; timed broadcasts from rotating senders."""
+        sessions = await self.create_sessions('bench-public', options['clients'])
+        clients = [BenchClient(application, '/ws/chat/', key) for _, key in sessions]
+        rss_before = rss_bytes()
+        sample, memory = await self.measure_memory(clients[:options['memory_sample']], options)
+        connected, connect_seconds = await self.connect_all(clients[len(sample):], options)
+        connected = sample + connected
+        # Every join broadcasts the online list; let those drain first.
+        await self.settle(connected, timeout=options['timeout'])
+        rss_after = rss_bytes()
+
+        sent_at = {}
+        latencies = []
+        done = asyncio.Event()
+        expected = options['messages'] * len(connected)
+
+        def on_frame(data, received_at):
+            if data.get('type') == 'chat_message' and data['message'].startswith('bench '):
+                latencies.append(received_at - sent_at[data['message']])
+                if len(latencies) == expected:
+                    done.set()
+
+        for client in connected:
+            client.on_frame = on_frame
+        frames_before = sum(client.frames for client in connected)
+
+        started = time.perf_counter()
+        for index in range(options['messages']):
+            message = f'bench {index}'
+            sent_at[message] = time.perf_counter()
+            await connected[index % len(connected)].send({'message': message})
+            await asyncio.sleep(options['message_interval'])
+        try:
+            await asyncio.wait_for(done.wait(), options['timeout'])
+        except asyncio.TimeoutError:
+            pass
+        elapsed = time.perf_counter() - started
+        frames = sum(client.frames for client in connected) - frames_before
+
+        await self.disconnect_all(connected)
+        return {
+            **rates(len(connected), len(clients), connect_seconds),
+            'bytes_per_connection': memory,
+            'rss_growth_bytes': rss_after - rss_before if rss_before is not None else None,
+            'expected': expected,
+            'delivered': len(latencies),
+            'frames_received': frames,
+            'messages_per_second': frames / elapsed if elapsed else 0,
+            'latency': summarize_ms(latencies),
+        }
+
+    async def run_private(self, application, options):
+        """Pairs of clients in private rooms, each side sending one message to the other."""
+        sessions = await self.create_sessions('bench-private', options['pairs'] * 2)
+        clients = []
+        for index in range(0, len(sessions) - 1, 2):
+            (first, first_key), (second, second_key) = sessions[index], sessions[index + 1]
+            clients.append(BenchClient(application, f'/ws/chat/private/{second.pk}/', first_key))
+            clients.append(BenchClient(application, f'/ws/chat/private/{first.pk}/', second_key))
+        # Sample whole pairs, so sampled clients still have their partner.
+        sample, memory = await self.measure_memory(clients[:options['memory_sample'] // 2 * 2], options)
+        connected, connect_seconds = await self.connect_all(clients[len(sample):], options)
+        connected = sample + connected
+
+        sent_at = {}
+        latencies = []
+        done = asyncio.Event()
+        # Both members of the room receive every message, the sender included.
+        expected = len(connected) * 2
+
+        def on_frame(data, received_at):
+            if data.get('type') == 'chat_message' and data['message'] in sent_at:
+                latencies.append(received_at - sent_at[data['message']])
+                if len(latencies) == expected:
+                    done.set()
+
+        for client in connected:
+            client.on_frame = on_frame
+
+        started = time.perf_counter()
+        for index, client in enumerate(connected):
+            message = f'private {index}'
+            sent_at[message] = time.perf_counter()
+            await client.send({'message': message})
+        try:
+            await asyncio.wait_for(done.wait(), options['timeout'])
+        except asyncio.TimeoutError:
+            pass
+        elapsed = time.perf_counter() - started
+
+        await self.disconnect_all(connected)
+        return {
+            **rates(len(connected), len(clients), connect_seconds),
+            'bytes_per_connection': memory,
+            'expected': expected,
+            'delivered': len(latencies),
+            'messages_per_second': len(latencies) / elapsed if elapsed else 0,
+            'latency': summarize_ms(latencies),
+        }
+
+    async def run_bot(self, application, options):
+        """Concurrent @bot questions in the public room, answered by the fake Ollama server."""
+        # Loaded at startup in production (CHAT_LANGCHAIN_WARMUP); keep it out of the timings.
+        await aload_conversation()
+        sessions = await self.create_sessions('bench-bot', options['bots'])
+        clients = [BenchClient(application, '/ws/chat/', key) for _, key in sessions]
+        connected, connect_seconds = await self.connect_all(clients, options)
+        await self.settle(connected, timeout=options['timeout'])
+
+        asked_at = {}
+        first_chunk = []
+        replies = []
+        rejected = 0
+        done = asyncio.Event()
+
+        def handler(client):
+            state = {'chunks': 0}
+
+            def on_frame(data, received_at):
+                nonlocal rejected
+                if data.get('type') == 'bot_stream_chunk':
+                    if state['chunks'] == 0:
+                        first_chunk.append(received_at - asked_at[client])
+                    state['chunks'] += 1
+                elif data.get('type') == 'bot_stream_end':
+                    if state['chunks']:
+                        replies.append(received_at - asked_at[client])
+                    elif data['message'] in REJECTIONS:
+                        rejected += 1
+                    if len(replies) + rejected == len(connected):
+                        done.set()
+            return on_frame
+
+        for client in connected:
+            client.on_frame = handler(client)
+
+        started = time.perf_counter()
+        for index, client in enumerate(connected):
+            asked_at[client] = time.perf_counter()
+            await client.send({'message': f'@bot benchmark question {index}', 'cache': False})
+        try:
+            await asyncio.wait_for(done.wait(), options['timeout'])
+        except asyncio.TimeoutError:
+            pass
+        elapsed = time.perf_counter() - started
+
+        await self.disconnect_all(connected)
+        return {
+            **rates(len(connected), len(clients), connect_seconds),
+            'questions': len(connected),
+            'completed': len(replies),
+            'rejected': rejected,
+            'replies_per_second': len(replies) / elapsed if elapsed else 0,
+            'first_chunk': summarize_ms(first_chunk),
+            'reply': summarize_ms(replies),
+        }
@@ -0,0 +1,21 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.retrieval import get_index, rebuild_index
+
+class Command(BaseCommand):
+    help = (
+        "Rebuilds the assistant's site content index (media titles, category "
+        "names and comments) from the database, dropping rows of deleted content."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Documents embedded per batch.')
+
+    def handle(self, *args, **options):
+        if get_index() is None:
+            raise CommandError("Retrieval is unavailable: set CHAT_RAG_ENABLED and install numpy.")
+        started = time.perf_counter()
+        rows = rebuild_index(options['batch_size'])
+        self.stdout.write(f"Indexed {rows} documents in {time.perf_counter() - started:.1f}s")
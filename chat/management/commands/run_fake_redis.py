@@ -0,0 +1,30 @@
+import asyncio
+
+from django.core.management.base import BaseCommand
+
+from chat.fake_redis import FakeRedisServer
+
+class Command(BaseCommand):
+    help = (
+        "Runs an in-memory Redis stand-in for local multi-process testing of "
+        "the chat (set CHANNEL_REDIS_HOSTS=redis://HOST:PORT for the workers). "
+        "Not for production."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=6379)
+
+    def handle(self, *args, **options):
+        try:
+            asyncio.run(self.serve(options['host'], options['port']))
+        except KeyboardInterrupt:
+            pass
+
+    async def serve(self, host, port):
+        server = await FakeRedisServer(host, port).start()
+        self.stdout.write(f"Fake Redis listening on {server.url}")
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await server.stop()
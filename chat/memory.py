@@ -0,0 +1,153 @@
+"""
+Token-budgeted conversation memory for the AI assistant.
+
+Conversations are stored in the `Conversation`/`ConversationTurn` tables
+rather than the session. Only the most recent turns that fit in
+`settings.CHAT_MEMORY_TOKEN_BUDGET` are loaded into the prompt; older turns
+are folded into a running summary. Each request appends only its own new
+turns, so the cost of a turn does not grow with the length of the history.
+All storage access uses Django's async ORM interface.
+
+Summarizing calls the LLM, so it runs as a background task after the turns
+are saved, at most one per conversation: the summary is only needed by later
+requests. Turns whose summary was not generated (e.g. the LLM failed, or the
+event loop ended first) are summarized after a later request.
+"""
+import asyncio
+import logging
+
+from django.conf import settings
+from langchain.memory import ConversationBufferMemory
+from langchain.memory.prompt import SUMMARY_PROMPT
+from langchain.schema import AIMessage, HumanMessage, SystemMessage, get_buffer_string
+
+from .models import Conversation, ConversationTurn
+from .scheduler import get_scheduler
+
+logger = logging.getLogger(__name__)
+
+# Conversation id -> the task summarizing it.
+_summarizing = {}
+
+def estimate_tokens(text: str) -> int:
+    """Roughly estimates the number of tokens in `text` (about four characters per token)."""
+    return len(text) // 4 + 1 if text else 0
+
+class StoredConversationMemory(ConversationBufferMemory):
+    """
+    A `ConversationBufferMemory` holding the windowed tail of a stored
+    conversation, prefixed with the summary of everything before it.
+    """
+    conversation_id: int
+    summary: str = ''
+    # Number of messages in `chat_memory` that are already stored.
+    persisted: int = 0
+
+    @property
+    def buffer_as_messages(self):
+        messages = self.chat_memory.messages
+        if self.summary:
+            messages = [SystemMessage(content=f"Summary of the earlier conversation: {self.summary}")] + messages
+        return messages
+
+def _turn_to_message(turn):
+    message_class = HumanMessage if turn.role == ConversationTurn.HUMAN else AIMessage
+    return message_class(content=turn.content)
+
+async def _window(conversation):
+    """Returns the newest turns that fit in the token budget, oldest first."""
+    budget = settings.CHAT_MEMORY_TOKEN_BUDGET - estimate_tokens(conversation.summary)
+    recent = conversation.turns.order_by('-id')[:settings.CHAT_MEMORY_MAX_MESSAGES]
+
+    window = []
+    used = 0
+    async for turn in recent:
+        used += turn.token_count
+        if used > budget:
+            break
+        window.append(turn)
+    window.reverse()
+    return window
+
+async def aload_memory(user, model_name: str) -> StoredConversationMemory:
+    """Loads the memory window of `user`'s conversation with `model_name`."""
+    conversation, _ = await Conversation.objects.aget_or_create(user=user, model=model_name)
+    window = await _window(conversation)
+
+    memory = StoredConversationMemory(
+        conversation_id=conversation.id,
+        summary=conversation.summary,
+        memory_key="history",
+        input_key="input",
+        return_messages=True,
+    )
+    memory.chat_memory.messages = [_turn_to_message(turn) for turn in window]
+    memory.persisted = len(window)
+    return memory
+
+async def asave_memory(memory: StoredConversationMemory, llm=None):
+    """
+    Appends the turns added to `memory` since it was loaded. If `llm` is
+    given, turns that have dropped out of the window are summarized in the
+    background.
+    """
+    new_messages = memory.chat_memory.messages[memory.persisted:]
+    if not new_messages:
+        return
+    await ConversationTurn.objects.abulk_create([
+        ConversationTurn(
+            conversation_id=memory.conversation_id,
+            role=ConversationTurn.HUMAN if message.type == 'human' else ConversationTurn.AI,
+            content=message.content,
+            token_count=estimate_tokens(message.content),
+        )
+        for message in new_messages
+    ])
+    memory.persisted = len(memory.chat_memory.messages)
+
+    conversation = await Conversation.objects.aget(id=memory.conversation_id)
+    # Bumps `updated_at`.
+    await conversation.asave(update_fields=['updated_at'])
+    if llm is not None and settings.CHAT_MEMORY_SUMMARIZE:
+        summarize_later(conversation, llm)
+
+def summarize_later(conversation, llm):
+    """Starts `asummarize_overflow` as a background task, unless one is running for the conversation."""
+    if conversation.id in _summarizing:
+        return
+    task = asyncio.ensure_future(asummarize_overflow(conversation, llm))
+    _summarizing[conversation.id] = task
+    task.add_done_callback(lambda _: _summarizing.pop(conversation.id, None))
+
+async def asummarize_overflow(conversation, llm):
+    """
+    Folds the turns that no longer fit in the memory window into the
+    conversation's running summary. The summary is generated through the
+    LLM scheduler, queued under the conversation's user.
+    """
+    window = await _window(conversation)
+    window_start = window[0].id if window else None
+
+    overflow = conversation.turns.filter(id__gt=conversation.summarized_through)
+    if window_start is not None:
+        overflow = overflow.filter(id__lt=window_start)
+    overflow = [turn async for turn in overflow]
+    if not overflow:
+        return
+
+    new_lines = get_buffer_string([_turn_to_message(turn) for turn in overflow])
+    prompt = SUMMARY_PROMPT.format(summary=conversation.summary, new_lines=new_lines)
+    try:
+        result = await get_scheduler().run(llm.model, conversation.user_id, None, lambda: llm.ainvoke(prompt))
+    except Exception as e:
+        # The turns stay stored; they will be summarized on a later request.
+        logger.warning(f"Could not summarize conversation {conversation.id}: {e}")
+        return
+
+    conversation.summary = getattr(result, 'content', result).strip()
+    conversation.summarized_through = overflow[-1].id
+    await conversation.asave(update_fields=['summary', 'summarized_through', 'updated_at'])
+
+async def aclear_memory(user, model_name: str):
+    """Deletes `user`'s conversation with `model_name`."""
+    await Conversation.objects.filter(user=user, model=model_name).adelete()
@@ -0,0 +1,59 @@
+# Generated by Django 5.2.18 on 2026-10-19 03:12
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_inbox(apps, schema_editor):
+    """Creates inbox entries for threads that already have messages (all marked read)."""
+    Thread = apps.get_model('chat', 'Thread')
+    Message = apps.get_model('chat', 'Message')
+    InboxEntry = apps.get_model('chat', 'InboxEntry')
+    entries = []
+    for thread in Thread.objects.prefetch_related('participants').iterator(chunk_size=500):
+        last = Message.objects.filter(thread=thread).order_by('-created_at', '-id').first()
+        if last is None:
+            continue
+        participant_ids = [user.id for user in thread.participants.all()]
+        for user_id in participant_ids:
+            others = [other for other in participant_ids if other != user_id]
+            entries.append(InboxEntry(
+                user_id=user_id,
+                thread=thread,
+                other_user_id=others[0] if len(others) == 1 else None,
+                last_sender_id=last.sender_id,
+                last_message_preview=last.text[:100],
+                last_activity=last.created_at,
+            ))
+    InboxEntry.objects.bulk_create(entries, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_conversation_memory'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InboxEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_message_preview', models.CharField(blank=True, max_length=255)),
+                ('last_activity', models.DateTimeField()),
+                ('unread_count', models.PositiveIntegerField(default=0)),
+                ('last_sender', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('other_user', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('thread', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='inbox_entries', to='chat.thread')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='inbox_entries', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name_plural': 'inbox entries',
+                'indexes': [models.Index(fields=['user', '-last_activity', '-id'], name='chat_inbox_user_activity')],
+                'unique_together': {('user', 'thread')},
+            },
+        ),
+        migrations.RunPython(backfill_inbox, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,70 @@
+from django.db import migrations
+
+# A contentless FTS5 index over chat_message.text: it stores only the index,
+# keyed by message id, and is kept in sync by triggers. Each row also
+# indexes a "thread<id>" token so searches can be restricted to a user's
+# threads inside the full-text query itself.
+CREATE_SQL = [
+    """
+    CREATE VIRTUAL TABLE chat_message_search USING fts5(
+        text, thread_key, content='', tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER chat_message_search_insert AFTER INSERT ON chat_message BEGIN
+        INSERT INTO chat_message_search (rowid, text, thread_key)
+        VALUES (new.id, new.text, 'thread' || new.thread_id);
+    END
+    """,
+    """
+    CREATE TRIGGER chat_message_search_delete AFTER DELETE ON chat_message BEGIN
+        INSERT INTO chat_message_search (chat_message_search, rowid, text, thread_key)
+        VALUES ('delete', old.id, old.text, 'thread' || old.thread_id);
+    END
+    """,
+    """
+    CREATE TRIGGER chat_message_search_update AFTER UPDATE OF text, thread_id ON chat_message BEGIN
+        INSERT INTO chat_message_search (chat_message_search, rowid, text, thread_key)
+        VALUES ('delete', old.id, old.text, 'thread' || old.thread_id);
+        INSERT INTO chat_message_search (rowid, text, thread_key)
+        VALUES (new.id, new.text, 'thread' || new.thread_id);
+    END
+    """,
+    """
+    INSERT INTO chat_message_search (rowid, text, thread_key)
+    SELECT id, text, 'thread' || thread_id FROM chat_message
+    """,
+]
+
+DROP_SQL = [
+    "DROP TRIGGER IF EXISTS chat_message_search_insert",
+    "DROP TRIGGER IF EXISTS chat_message_search_delete",
+    "DROP TRIGGER IF EXISTS chat_message_search_update",
+    "DROP TABLE IF EXISTS chat_message_search",
+]
+
+
+def create_search_index(apps, schema_editor):
+    # Other databases fall back to a plain substring search (see chat/search.py).
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for statement in CREATE_SQL:
+        schema_editor.execute(statement)
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for statement in DROP_SQL:
+        schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_inbox'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,67 @@
+# Generated by Django 5.2.18 on 2026-10-19 04:04
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+# Archived messages stay in the full-text index (see 0006): moving a message
+# deletes it from chat_message, whose trigger drops it from the index, and
+# inserting it here adds it back under the same id.
+CREATE_SQL = [
+    """
+    CREATE TRIGGER chat_archivedmessage_search_insert AFTER INSERT ON chat_archivedmessage BEGIN
+        INSERT INTO chat_message_search (rowid, text, thread_key)
+        VALUES (new.id, new.text, 'thread' || new.thread_id);
+    END
+    """,
+    """
+    CREATE TRIGGER chat_archivedmessage_search_delete AFTER DELETE ON chat_archivedmessage BEGIN
+        INSERT INTO chat_message_search (chat_message_search, rowid, text, thread_key)
+        VALUES ('delete', old.id, old.text, 'thread' || old.thread_id);
+    END
+    """,
+]
+
+DROP_SQL = [
+    "DROP TRIGGER IF EXISTS chat_archivedmessage_search_insert",
+    "DROP TRIGGER IF EXISTS chat_archivedmessage_search_delete",
+]
+
+
+def create_search_triggers(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for statement in CREATE_SQL:
+        schema_editor.execute(statement)
+
+
+def drop_search_triggers(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for statement in DROP_SQL:
+        schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_message_search'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedMessage',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('text', models.TextField()),
+                ('created_at', models.DateTimeField()),
+                ('sender', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('thread', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_messages', to='chat.thread')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['thread', 'id'], name='chat_archived_thread_id')],
+            },
+        ),
+        migrations.RunPython(create_search_triggers, drop_search_triggers),
+    ]
@@ -14,4 +14,74 @@ class Message(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
 
     class Meta:
-        ordering = ['created_at']
\ No newline at end of file
+        ordering = ['created_at']
+
+class ArchivedMessage(models.Model):
+    """
+    A message moved out of `Message` once it is older than
+    CHAT_ARCHIVE_AFTER_DAYS (see chat/archive.py). It keeps its id, so
+    archived and recent messages page together by id.
+    """
+    id = models.BigIntegerField(primary_key=True)
+    thread = models.ForeignKey(Thread, on_delete=models.CASCADE, related_name='archived_messages')
+    sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    text = models.TextField()
+    created_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [models.Index(fields=['thread', 'id'], name='chat_archived_thread_id')]
+
+    def as_message(self) -> Message:
+        """An unsaved `Message` with this message's fields, for code that shows messages."""
+        return Message(
+            id=self.id, thread_id=self.thread_id, sender=self.sender, text=self.text, created_at=self.created_at,
+        )
+
+class Conversation(models.Model):
+    """A user's conversation with the AI assistant for one model."""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='ai_conversations')
+    model = models.CharField(max_length=255)
+    # Running summary of the turns that no longer fit in the memory window.
+    summary = models.TextField(blank=True)
+    # Id of the newest turn already folded into `summary`.
+    summarized_through = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('user', 'model')
+
+class ConversationTurn(models.Model):
+    """A single human or AI message in a conversation with the AI assistant."""
+    HUMAN = 'human'
+    AI = 'ai'
+    ROLE_CHOICES = [(HUMAN, 'Human'), (AI, 'AI')]
+
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='turns')
+    role = models.CharField(max_length=10, choices=ROLE_CHOICES)
+    content = models.TextField()
+    # Estimated prompt tokens, stored so the memory window can be sized without re-reading content.
+    token_count = models.PositiveIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['id']
+
+class InboxEntry(models.Model):
+    """
+    A private thread as it appears in one participant's inbox. The last
+    message and unread count are denormalized here and kept up to date as
+    messages are sent (see chat/inbox.py), so the inbox is a single indexed query.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='inbox_entries')
+    thread = models.ForeignKey(Thread, on_delete=models.CASCADE, related_name='inbox_entries')
+    # The other participant of a one-on-one thread.
+    other_user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, related_name='+')
+    last_sender = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, related_name='+')
+    last_message_preview = models.CharField(max_length=255, blank=True)
+    last_activity = models.DateTimeField()
+    unread_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('user', 'thread')
+        indexes = [models.Index(fields=['user', '-last_activity', '-id'], name='chat_inbox_user_activity')]
+        verbose_name_plural = "inbox entries"
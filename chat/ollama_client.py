@@ -0,0 +1,176 @@
+"""
+Process-wide, pooled HTTP clients for the Ollama API.
+
+Every call to Ollama goes through the clients in this module so that TCP
+connections are kept alive and reused, and so that the number of concurrent
+upstream connections is capped by `settings.OLLAMA_MAX_CONNECTIONS`.
+Transient failures (refused connections, an overloaded Ollama answering 503)
+are retried with exponential backoff and full jitter.
+"""
+import asyncio
+import logging
+import random
+import time
+import weakref
+from contextlib import asynccontextmanager
+
+import httpx
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Errors raised before the request reached Ollama, so retrying them never
+# runs an inference twice. A dropped connection (RemoteProtocolError) may
+# come after Ollama started generating, so it is not retried.
+RETRYABLE_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+RETRYABLE_STATUS_CODES = {502, 503, 504}
+
+# An AsyncClient is bound to the event loop it was first used on, so keep one
+# per loop. Under an ASGI server this is a single client per process.
+_async_clients = weakref.WeakKeyDictionary()
+_sync_client = None
+
+def _client_options():
+    return {
+        'base_url': settings.OLLAMA_HOST,
+        'timeout': httpx.Timeout(settings.OLLAMA_TIMEOUT, connect=settings.OLLAMA_CONNECT_TIMEOUT),
+        'limits': httpx.Limits(
+            max_connections=settings.OLLAMA_MAX_CONNECTIONS,
+            max_keepalive_connections=settings.OLLAMA_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=settings.OLLAMA_KEEPALIVE_EXPIRY,
+        ),
+    }
+
+def get_async_client() -> httpx.AsyncClient:
+    """Returns the shared async client for the running event loop."""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(**_client_options())
+        _async_clients[loop] = client
+    return client
+
+def get_sync_client() -> httpx.Client:
+    """Returns the shared sync client, used from synchronous code paths."""
+    global _sync_client
+    if _sync_client is None or _sync_client.is_closed:
+        _sync_client = httpx.Client(**_client_options())
+    return _sync_client
+
+async def aclose_clients():
+    """Closes the pooled clients. Called on ASGI lifespan shutdown."""
+    global _sync_client
+    client = _async_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+    if _sync_client is not None:
+        _sync_client.close()
+        _sync_client = None
+
+def backoff_delay(attempt: int) -> float:
+    """Exponential backoff with full jitter for the given (0-based) retry attempt."""
+    ceiling = min(settings.OLLAMA_RETRY_MAX_DELAY, settings.OLLAMA_RETRY_BACKOFF * (2 ** attempt))
+    return random.uniform(0, ceiling)
+
+def _should_retry(attempt, max_retries, response=None, error=None):
+    if attempt >= (settings.OLLAMA_MAX_RETRIES if max_retries is None else max_retries):
+        return False
+    if error is not None:
+        return isinstance(error, RETRYABLE_ERRORS)
+    return response.status_code in RETRYABLE_STATUS_CODES
+
+async def arequest(method: str, url: str, max_retries=None, **kwargs) -> httpx.Response:
+    """
+    Sends a request through the shared async client, retrying transient
+    failures up to `max_retries` times (OLLAMA_MAX_RETRIES by default).
+    """
+    client = get_async_client()
+    attempt = 0
+    while True:
+        try:
+            response = await client.request(method, url, **kwargs)
+        except httpx.RequestError as e:
+            if not _should_retry(attempt, max_retries, error=e):
+                raise
+            logger.warning(f"Retrying Ollama {method} {url} after error: {e}")
+        else:
+            if not _should_retry(attempt, max_retries, response=response):
+                return response
+            logger.warning(f"Retrying Ollama {method} {url} after status {response.status_code}")
+        await asyncio.sleep(backoff_delay(attempt))
+        attempt += 1
+
+def request(method: str, url: str, max_retries=None, **kwargs) -> httpx.Response:
+    """
+    Sends a request through the shared sync client, retrying transient
+    failures up to `max_retries` times (OLLAMA_MAX_RETRIES by default).
+    """
+    client = get_sync_client()
+    attempt = 0
+    while True:
+        try:
+            response = client.request(method, url, **kwargs)
+        except httpx.RequestError as e:
+            if not _should_retry(attempt, max_retries, error=e):
+                raise
+            logger.warning(f"Retrying Ollama {method} {url} after error: {e}")
+        else:
+            if not _should_retry(attempt, max_retries, response=response):
+                return response
+            logger.warning(f"Retrying Ollama {method} {url} after status {response.status_code}")
+        time.sleep(backoff_delay(attempt))
+        attempt += 1
+
+@asynccontextmanager
+async def astream(method: str, url: str, max_retries=None, **kwargs):
+    """
+    Opens a streaming response through the shared async client.
+
+    Only opening the stream is retried; once the response headers have arrived
+    the body is handed to the caller as-is.
+    """
+    client = get_async_client()
+    auth = kwargs.pop('auth', None) or httpx.USE_CLIENT_DEFAULT
+    attempt = 0
+    while True:
+        try:
+            response = await client.send(client.build_request(method, url, **kwargs), auth=auth, stream=True)
+        except httpx.RequestError as e:
+            if not _should_retry(attempt, max_retries, error=e):
+                raise
+            logger.warning(f"Retrying Ollama {method} {url} after error: {e}")
+        else:
+            if not _should_retry(attempt, max_retries, response=response):
+                break
+            await response.aclose()
+            logger.warning(f"Retrying Ollama {method} {url} after status {response.status_code}")
+        await asyncio.sleep(backoff_delay(attempt))
+        attempt += 1
+
+    try:
+        yield response
+    finally:
+        await response.aclose()
+
+def stream(method: str, url: str, max_retries=None, **kwargs):
+    """
+    Opens a streaming response through the shared sync client. The caller
+    must close the returned response.
+    """
+    client = get_sync_client()
+    auth = kwargs.pop('auth', None) or httpx.USE_CLIENT_DEFAULT
+    attempt = 0
+    while True:
+        try:
+            response = client.send(client.build_request(method, url, **kwargs), auth=auth, stream=True)
+        except httpx.RequestError as e:
+            if not _should_retry(attempt, max_retries, error=e):
+                raise
+            logger.warning(f"Retrying Ollama {method} {url} after error: {e}")
+        else:
+            if not _should_retry(attempt, max_retries, response=response):
+                return response
+            response.close()
+            logger.warning(f"Retrying Ollama {method} {url} after status {response.status_code}")
+        time.sleep(backoff_delay(attempt))
+        attempt += 1
@@ -0,0 +1,40 @@
+"""
+Who is online in a chat group.
+
+Connections are counted per member, so a user with two tabs open stays
+online until both are closed. With a channel layer that has the `presence`
+extension (`chat.channel_layer.RedisChannelLayer`) the counts are shared by
+all worker processes, and a crashed worker's connections drop out once its
+heartbeat lapses; otherwise they are kept in this process.
+"""
+from collections import Counter, defaultdict
+
+_local = defaultdict(Counter)
+
+def member_key(user) -> str:
+    return f'{user.id}:{user.username}'
+
+def _members(counts) -> dict:
+    """Maps usernames to user IDs."""
+    members = {}
+    for key in counts:
+        user_id, _, username = key.partition(':')
+        members[username] = int(user_id)
+    return members
+
+async def join(channel_layer, group, user) -> dict:
+    """Records a connection of `user` to `group`; returns the online usernames mapped to their IDs."""
+    if 'presence' in getattr(channel_layer, 'extensions', ()):
+        return _members(await channel_layer.presence_add(group, member_key(user)))
+    _local[group][member_key(user)] += 1
+    return _members(_local[group])
+
+async def leave(channel_layer, group, user) -> dict:
+    """Records that a connection of `user` to `group` has closed; returns the online members."""
+    if 'presence' in getattr(channel_layer, 'extensions', ()):
+        return _members(await channel_layer.presence_discard(group, member_key(user)))
+    counts = _local[group]
+    counts[member_key(user)] -= 1
+    if counts[member_key(user)] <= 0:
+        del counts[member_key(user)]
+    return _members(counts)
@@ -0,0 +1,433 @@
+"""
+Retrieval over site content for the AI assistant.
+
+Media titles, category names and comments are embedded into an index kept
+on disk in `settings.CHAT_RAG_INDEX_DIR`:
+
+- `vectors.f32` holds the unit-length embeddings as one contiguous
+  float32 matrix, one row per document, memory-mapped for searching;
+- `keys.i64` holds the `(kind, object id)` of each row;
+- `index.json` records the embedder and dimension the index was built with.
+
+New content is appended to both files under a file lock, so every worker
+sees it on its next search without reloading anything else. A search is a
+single matrix-vector product over the mapped rows plus a partial sort, so
+its cost grows linearly with the index (1 KB per row at the default 256
+dimensions) and stays within a few milliseconds for tens of thousands of
+documents. Rows are only ever appended; rows of deleted or private content
+are filtered out when the results are loaded, reading further down the
+ranking until enough remain, and `manage.py build_rag_index` rewrites the
+index from scratch. Rows appended to the live index while it rebuilds are
+copied over before the new index is swapped in, under the same lock.
+
+The default embedder is a deterministic feature-hashing embedder that
+needs no model; set `CHAT_RAG_EMBEDDER = 'ollama'` to use an Ollama
+embedding model instead. Requires the optional `numpy` package; without it
+the assistant simply gets no site context.
+"""
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import transaction
+from django.urls import reverse
+
+from . import ollama_client
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+logger = logging.getLogger(__name__)
+
+MEDIA, CATEGORY, COMMENT = 1, 2, 3
+
+_WORD = re.compile(r'\w+')
+
+# Longest comment quoted in the prompt, in characters.
+MAX_SNIPPET = 300
+
+class HashingEmbedder:
+    """
+    Embeds text by hashing its words into `dim` signed buckets. Deterministic
+    across processes and free to compute, so it also serves as the embedder
+    for tests; it only matches shared words, not meaning.
+    """
+    name = 'hashing'
+
+    def __init__(self, dim: int):
+        self.dim = dim
+
+    def embed(self, texts):
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for word in _WORD.findall(text.lower()):
+                digest = zlib.crc32(word.encode('utf-8'))
+                vectors[row, digest % self.dim] += 1.0 if digest & 0x80000000 else -1.0
+        return vectors
+
+    async def aembed(self, texts):
+        return self.embed(texts)
+
+class OllamaEmbedder:
+    """Embeds text with an Ollama embedding model through the pooled clients."""
+    name = 'ollama'
+
+    def __init__(self, model: str, dim: int):
+        self.model = model
+        self.dim = dim
+
+    def _vectors(self, response):
+        response.raise_for_status()
+        vectors = np.asarray(response.json()['embeddings'], dtype=np.float32)
+        if vectors.shape[1] != self.dim:
+            raise ValueError(f"{self.model} returns {vectors.shape[1]}-dimensional embeddings, not CHAT_RAG_DIM={self.dim}")
+        return vectors
+
+    def embed(self, texts):
+        return self._vectors(ollama_client.request('POST', '/api/embed', json={'model': self.model, 'input': list(texts)}))
+
+    async def aembed(self, texts):
+        return self._vectors(await ollama_client.arequest('POST', '/api/embed', json={'model': self.model, 'input': list(texts)}))
+
+def get_embedder():
+    if settings.CHAT_RAG_EMBEDDER == 'ollama':
+        return OllamaEmbedder(settings.CHAT_RAG_EMBEDDING_MODEL, settings.CHAT_RAG_DIM)
+    return HashingEmbedder(settings.CHAT_RAG_DIM)
+
+def normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+class EmbeddingIndex:
+    """An append-only embedding matrix on disk; see the module docstring."""
+
+    def __init__(self, path, embedder):
+        self.path = str(path)
+        self.embedder = embedder
+        self._lock = threading.Lock()
+        # The mapped files and the (inode, size) they were mapped at.
+        self._mapped = None
+        self._vectors = None
+        self._keys = None
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _meta(self):
+        return {'embedder': self.embedder.name, 'dim': self.embedder.dim}
+
+    def _compatible(self):
+        try:
+            with open(self._file('index.json')) as f:
+                return json.load(f) == self._meta()
+        except FileNotFoundError:
+            return False
+
+    @contextlib.contextmanager
+    def locked(self):
+        """Holds the file lock that serializes appends and rebuilds."""
+        while True:
+            os.makedirs(self.path, exist_ok=True)
+            lock = open(self._file('.lock'), 'a')
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                current = os.stat(self._file('.lock')).st_ino == os.fstat(lock.fileno()).st_ino
+            except FileNotFoundError:
+                current = False
+            if current:
+                break
+            # A rebuild swapped the directory while we waited.
+            lock.close()
+        try:
+            yield
+        finally:
+            lock.close()
+
+    def _rows(self):
+        """Returns the number of complete rows on disk."""
+        try:
+            vectors_size = os.path.getsize(self._file('vectors.f32'))
+            keys_size = os.path.getsize(self._file('keys.i64'))
+        except FileNotFoundError:
+            return 0
+        return min(vectors_size // (4 * self.embedder.dim), keys_size // 16)
+
+    def _write(self, vectors: bytes, keys: bytes):
+        if not os.path.exists(self._file('index.json')):
+            os.makedirs(self.path, exist_ok=True)
+            with open(self._file('index.json'), 'w') as f:
+                json.dump(self._meta(), f)
+        elif not self._compatible():
+            logger.warning(f"Not appending to {self.path}: it was built with another embedder; run build_rag_index")
+            return
+        # Vectors first: readers only use rows that have a key as well.
+        with open(self._file('vectors.f32'), 'ab') as f:
+            f.write(vectors)
+        with open(self._file('keys.i64'), 'ab') as f:
+            f.write(keys)
+
+    def _read(self, start, stop):
+        """Returns the raw `(vectors, keys)` bytes of rows `start` to `stop`."""
+        with open(self._file('vectors.f32'), 'rb') as f:
+            f.seek(start * 4 * self.embedder.dim)
+            vectors = f.read((stop - start) * 4 * self.embedder.dim)
+        with open(self._file('keys.i64'), 'rb') as f:
+            f.seek(start * 16)
+            keys = f.read((stop - start) * 16)
+        return vectors, keys
+
+    def append(self, keys, texts):
+        """Embeds `texts` and appends them with their `(kind, id)` keys."""
+        if not texts:
+            return
+        vectors = normalize(self.embedder.embed(texts)).astype(np.float32)
+        keys = np.asarray(keys, dtype=np.int64).reshape(-1, 2)
+        with self.locked():
+            self._write(vectors.tobytes(), keys.tobytes())
+
+    def _map(self):
+        """Returns the current `(vectors, keys)`, remapping the files if they changed."""
+        try:
+            vectors_stat = os.stat(self._file('vectors.f32'))
+            keys_stat = os.stat(self._file('keys.i64'))
+        except FileNotFoundError:
+            return None, None
+        state = (vectors_stat.st_ino, vectors_stat.st_size, keys_stat.st_ino, keys_stat.st_size)
+        with self._lock:
+            if state != self._mapped:
+                rows = min(vectors_stat.st_size // (4 * self.embedder.dim), keys_stat.st_size // 16)
+                if rows == 0 or not self._compatible():
+                    self._vectors = self._keys = None
+                else:
+                    self._vectors = np.memmap(self._file('vectors.f32'), dtype=np.float32, mode='r', shape=(rows, self.embedder.dim))
+                    self._keys = np.memmap(self._file('keys.i64'), dtype=np.int64, mode='r', shape=(rows, 2))
+                self._mapped = state
+            return self._vectors, self._keys
+
+    def __len__(self):
+        vectors, _ = self._map()
+        return 0 if vectors is None else len(vectors)
+
+    def vectors_of(self, kind):
+        """Returns `(ids, vectors)` of the newest row of every document of `kind`."""
+        vectors, keys = self._map()
+        if vectors is None:
+            return np.empty(0, dtype=np.int64), np.empty((0, self.embedder.dim), dtype=np.float32)
+        rows = np.flatnonzero(keys[:, 0] == kind)[::-1]
+        _, newest = np.unique(keys[rows, 1], return_index=True)
+        rows = rows[newest]
+        return np.asarray(keys[rows, 1]), np.asarray(vectors[rows])
+
+    def ranked(self, query_vector, min_score: float = 0.0, batch: int = 16):
+        """
+        Yields lists of `(kind, id, score)` of the documents most similar to
+        `query_vector`, best first, each document once. The first list holds
+        up to `batch` rows; each later one reaches twice as deep, so callers
+        that discard hits pay only for the rows they look at.
+        """
+        vectors, keys = self._map()
+        if vectors is None:
+            return
+        query = normalize(np.asarray(query_vector, dtype=np.float32).reshape(1, -1))[0]
+        scores = vectors @ query
+        seen = set()
+        # Rows already yielded. Every row outside a window scores at most
+        # as high as the rows in it, so each window continues the ranking.
+        visited = np.zeros(len(scores), dtype=bool)
+        count = batch
+        while not visited.all():
+            count = min(len(scores), count)
+            top = np.argpartition(-scores, count - 1)[:count]
+            top = top[~visited[top]]
+            top = top[np.argsort(-scores[top], kind='stable')]
+            visited[top] = True
+            hits = []
+            for row in top:
+                score = float(scores[row])
+                if score < min_score:
+                    if hits:
+                        yield hits
+                    return
+                key = (int(keys[row, 0]), int(keys[row, 1]))
+                # A document appended more than once occupies several rows.
+                if key in seen:
+                    continue
+                seen.add(key)
+                hits.append((*key, score))
+            if hits:
+                yield hits
+            count *= 2
+
+    def search(self, query_vector, k: int, min_score: float = 0.0):
+        """Returns up to `k` `(kind, id, score)` of the rows most similar to `query_vector`, best first."""
+        results = []
+        for hits in self.ranked(query_vector, min_score, batch=2 * k):
+            results.extend(hits)
+            if len(results) >= k:
+                break
+        return results[:k]
+
+_index = None
+_index_lock = threading.Lock()
+
+def get_index():
+    """Returns the process-wide index, or None if retrieval is unavailable."""
+    global _index
+    if np is None or not settings.CHAT_RAG_ENABLED:
+        return None
+    with _index_lock:
+        if _index is None:
+            _index = EmbeddingIndex(settings.CHAT_RAG_INDEX_DIR, get_embedder())
+        return _index
+
+def media_text(media):
+    return media.title
+
+def category_text(category):
+    return category.name
+
+def comment_text(comment):
+    return comment.text
+
+# Embedding may call out to Ollama, so appends run off the request thread,
+# one at a time.
+_index_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='rag-index')
+
+def _append(keys, texts):
+    try:
+        get_index().append(keys, texts)
+    except Exception as e:
+        logger.warning(f"Could not index {keys}: {e}")
+
+def _index_later(kind, obj, text):
+    if get_index() is None:
+        return
+    transaction.on_commit(lambda: _index_executor.submit(_append, [(kind, obj.pk)], [text]))
+
+def index_media(media):
+    """Adds a media item's title to the index once the transaction commits."""
+    _index_later(MEDIA, media, media_text(media))
+
+def index_category(category):
+    _index_later(CATEGORY, category, category_text(category))
+
+def index_comment(comment):
+    _index_later(COMMENT, comment, comment_text(comment))
+
+def rebuild_index(batch_size=500):
+    """
+    Rewrites the index from the database next to the live one and swaps it
+    in. Returns the number of indexed rows.
+    """
+    from media.models import Category, Comment, Media
+
+    live = get_index()
+    if live is None:
+        return 0
+    staging = EmbeddingIndex(f'{live.path}.new', live.embedder)
+    shutil.rmtree(staging.path, ignore_errors=True)
+    # Content committed after this point may be missing from the queries
+    # below, but its append lands in the live index past this row.
+    with live.locked():
+        high_water = live._rows()
+
+    sources = [
+        (MEDIA, Media.objects.only('id', 'title'), media_text),
+        (CATEGORY, Category.objects.only('id', 'name'), category_text),
+        (COMMENT, Comment.objects.only('id', 'text'), comment_text),
+    ]
+    rows = 0
+    for kind, queryset, text in sources:
+        keys, texts = [], []
+        for obj in queryset.order_by('id').iterator(chunk_size=batch_size):
+            keys.append((kind, obj.pk))
+            texts.append(text(obj))
+            if len(texts) == batch_size:
+                staging.append(keys, texts)
+                rows += len(texts)
+                keys, texts = [], []
+        staging.append(keys, texts)
+        rows += len(texts)
+
+    with live.locked():
+        if live._compatible() and live._rows() > high_water:
+            staging._write(*live._read(high_water, live._rows()))
+        # Readers notice the new files by their inode and remap them.
+        old = f'{live.path}.old'
+        shutil.rmtree(old, ignore_errors=True)
+        if os.path.exists(live.path):
+            os.rename(live.path, old)
+        if os.path.exists(staging.path):
+            os.rename(staging.path, live.path)
+        shutil.rmtree(old, ignore_errors=True)
+    return rows
+
+async def _load(hits):
+    """Loads the visible content of search hits, in hit order, as prompt lines."""
+    from media.models import Category, Comment, Media
+
+    ids = {MEDIA: [], CATEGORY: [], COMMENT: []}
+    for kind, object_id, _ in hits:
+        ids[kind].append(object_id)
+    # Only public content is ever shown to the assistant.
+    media = await Media.objects.filter(is_public=True).select_related('owner').ain_bulk(ids[MEDIA])
+    categories = await Category.objects.ain_bulk(ids[CATEGORY])
+    comments = await (
+        Comment.objects.filter(media__is_public=True, media__deleted_at__isnull=True, author__is_active=True)
+        .select_related('author', 'media').ain_bulk(ids[COMMENT])
+    )
+
+    lines = []
+    for kind, object_id, _ in hits:
+        if kind == MEDIA and object_id in media:
+            item = media[object_id]
+            lines.append(f'Media "{item.title}" uploaded by {item.owner.username} ({reverse("media_detail", args=[item.pk])})')
+        elif kind == CATEGORY and object_id in categories:
+            category = categories[object_id]
+            lines.append(f'Category "{category.name}" ({reverse("home_by_category", args=[category.slug])})')
+        elif kind == COMMENT and object_id in comments:
+            comment = comments[object_id]
+            text = ' '.join(comment.text.split())
+            if len(text) > MAX_SNIPPET:
+                text = text[:MAX_SNIPPET] + '…'
+            lines.append(f'{comment.author.username} commented on "{comment.media.title}": {text}')
+    return lines
+
+async def aretrieve_context(query: str) -> str:
+    """
+    Returns the site content most relevant to `query`, formatted for the
+    system prompt, or an empty string if nothing relevant was found.
+    """
+    index = get_index()
+    if index is None or not query.strip():
+        return ''
+    try:
+        query_vector = (await index.embedder.aembed([query]))[0]
+        k = settings.CHAT_RAG_TOP_K
+        lines = []
+        # Hits on private or deleted content are dropped, so read further
+        # down the ranking until k visible ones are found.
+        for hits in index.ranked(query_vector, settings.CHAT_RAG_MIN_SCORE, batch=2 * k):
+            lines.extend(await _load(hits))
+            if len(lines) >= k:
+                break
+        lines = lines[:k]
+    except Exception as e:
+        logger.warning(f"Could not retrieve site context: {e}")
+        return ''
+    if not lines:
+        return ''
+    return (
+        "\n\nThe following content from this site may be relevant to the question; "
+        "use it only if it is:\n" + '\n'.join(f'- {line}' for line in lines)
+    )
@@ -0,0 +1,364 @@
+"""
+Fair-share scheduler for LLM requests.
+
+All calls to Ollama from the chat consumers and views pass through the
+scheduler, which
+
+- caps the number of concurrent generations per model,
+- queues waiting requests per user and grants free slots round-robin across
+  users, so one user flooding `@bot` cannot starve everyone else,
+- coalesces identical in-flight prompts so they share a single generation,
+- rejects requests immediately when the queue is full, and gives up on
+  requests that have waited longer than their deadline,
+- reports queue positions to callers so they can be shown to users.
+
+Scheduler state is tied to the event loop; use `get_scheduler()`.
+"""
+import asyncio
+import contextlib
+import inspect
+import logging
+import time
+import weakref
+from collections import OrderedDict, defaultdict, deque
+
+from django.conf import settings
+
+from media_sharing_project.metrics import CallbackGauge, Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+llm_requests = Counter(
+    'llm_requests_total',
+    "LLM requests by model and outcome: generated, coalesced (shared an identical in-flight "
+    "generation), rejected, timeout, cancelled or error.",
+    ['model', 'outcome'],
+)
+llm_queue_wait = Histogram('llm_queue_wait_seconds', "Time generations waited for a slot.", ['model'])
+llm_time_to_first_token = Histogram(
+    'llm_time_to_first_token_seconds', "Time from the start of a generation to its first chunk.", ['model'],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0),
+)
+llm_generation_duration = Histogram(
+    'llm_generation_seconds', "Duration of generations, once started.", ['model'],
+    buckets=(0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0),
+)
+# Ollama streams one token per chunk.
+llm_generated_tokens = Counter('llm_generated_tokens_total', "Streamed chunks (tokens) generated.", ['model'])
+llm_tokens_per_second = Histogram(
+    'llm_tokens_per_second', "Streaming rate of each generation after its first token.", ['model'],
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500),
+)
+
+class SchedulerError(Exception):
+    """Base class for requests the scheduler could not run."""
+    message = "The assistant is busy right now. Please try again in a moment."
+
+class QueueFull(SchedulerError):
+    """Raised immediately when a request cannot even be queued."""
+
+class QueueTimeout(SchedulerError):
+    """Raised when a queued request was not started before its deadline."""
+    message = "The assistant is taking too long to respond. Please try again later."
+
+def _notify(listener, position):
+    result = listener(position)
+    if inspect.isawaitable(result):
+        asyncio.ensure_future(result)
+
+class _Broadcast:
+    """The chunks of one generation, replayed to every request sharing it."""
+
+    def __init__(self):
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.task = None
+        self.subscribers = 0
+        self.position = None
+        self.position_listeners = []
+        self._changed = asyncio.Event()
+
+    def _wake(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def publish(self, chunk):
+        self.chunks.append(chunk)
+        self._wake()
+
+    def finish(self, error=None):
+        self.done = True
+        self.error = error
+        self._wake()
+
+    def set_position(self, position):
+        self.position = position
+        for listener in self.position_listeners:
+            _notify(listener, position)
+
+    def add_position_listener(self, listener):
+        self.position_listeners.append(listener)
+        if self.position:
+            _notify(listener, self.position)
+
+    async def subscribe(self, on_position=None):
+        """Yields every chunk, from the first; `on_position` must already be registered."""
+        self.subscribers += 1
+        try:
+            index = 0
+            while True:
+                while index < len(self.chunks):
+                    yield self.chunks[index]
+                    index += 1
+                if self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                await self._changed.wait()
+        finally:
+            if on_position is not None:
+                self.position_listeners.remove(on_position)
+            self.subscribers -= 1
+            # Nobody is listening any more; stop generating.
+            if self.subscribers == 0 and not self.done and self.task is not None:
+                self.task.cancel()
+
+class _Ticket:
+    def __init__(self, user_key, broadcast):
+        self.user_key = user_key
+        self.broadcast = broadcast
+        self.granted = asyncio.get_running_loop().create_future()
+        self.position = None
+
+class _ModelQueue:
+    """Concurrency slots and per-user waiting lines for one model."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        # user_key -> deque of tickets. Users are served in round-robin order:
+        # a user is moved to the back after each grant.
+        self.waiting = OrderedDict()
+        self.size = 0
+
+    def user_queue_length(self, user_key):
+        return len(self.waiting.get(user_key, ()))
+
+    def enqueue(self, ticket):
+        self.waiting.setdefault(ticket.user_key, deque()).append(ticket)
+        self.size += 1
+
+    def remove(self, ticket):
+        tickets = self.waiting.get(ticket.user_key)
+        if tickets is not None and ticket in tickets:
+            tickets.remove(ticket)
+            self.size -= 1
+            if not tickets:
+                del self.waiting[ticket.user_key]
+
+    def grant(self):
+        """Hands free slots to waiting tickets, one user at a time."""
+        while self.active < self.limit and self.waiting:
+            user_key, tickets = next(iter(self.waiting.items()))
+            ticket = tickets.popleft()
+            self.size -= 1
+            if tickets:
+                self.waiting.move_to_end(user_key)
+            else:
+                del self.waiting[user_key]
+            if ticket.granted.done():
+                continue
+            ticket.granted.set_result(None)
+            self.active += 1
+
+    def positions(self):
+        """Yields `(ticket, position)` in the order slots will be granted (1-based)."""
+        lengths = [len(tickets) for tickets in self.waiting.values()]
+        for user_index, tickets in enumerate(self.waiting.values()):
+            for ticket_index, ticket in enumerate(tickets):
+                # Earlier rounds of every user, plus earlier users in this round.
+                position = sum(min(length, ticket_index) for length in lengths)
+                position += sum(1 for length in lengths[:user_index] if length > ticket_index)
+                yield ticket, position + 1
+
+class LLMScheduler:
+    def __init__(self):
+        self._queues = {}
+        self._inflight = {}
+
+    def _queue(self, model):
+        queue = self._queues.get(model)
+        if queue is None:
+            limit = settings.LLM_MODEL_CONCURRENCY.get(model, settings.LLM_MAX_CONCURRENCY)
+            queue = self._queues[model] = _ModelQueue(limit)
+        return queue
+
+    def has_capacity(self, model, user_key, key=None) -> bool:
+        """Checks whether a request could be admitted right now."""
+        if key is not None and key in self._inflight:
+            return True
+        queue = self._queue(model)
+        if queue.active < queue.limit and not queue.waiting:
+            return True
+        return (
+            queue.size < settings.LLM_MAX_QUEUE
+            and queue.user_queue_length(user_key) < settings.LLM_MAX_QUEUE_PER_USER
+        )
+
+    def stats(self) -> dict:
+        return {
+            model: {'active': queue.active, 'queued': queue.size, 'limit': queue.limit}
+            for model, queue in self._queues.items()
+        }
+
+    def _report_positions(self, queue):
+        for ticket, position in queue.positions():
+            if position != ticket.position:
+                ticket.position = position
+                ticket.broadcast.set_position(position)
+
+    def _enqueue(self, queue, ticket):
+        queue.enqueue(ticket)
+        queue.grant()
+        self._report_positions(queue)
+
+    async def _acquire(self, queue, ticket, timeout):
+        try:
+            await asyncio.wait_for(asyncio.shield(ticket.granted), timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            queue.remove(ticket)
+            if ticket.granted.done() and not ticket.granted.cancelled():
+                # The slot was granted just as we gave up; hand it back.
+                self._release(queue)
+            else:
+                ticket.granted.cancel()
+                self._report_positions(queue)
+            if isinstance(e, asyncio.TimeoutError):
+                raise QueueTimeout() from None
+            raise
+
+        if ticket.position is not None:
+            # Tell callers that saw a queue position that generation has started.
+            ticket.broadcast.set_position(0)
+
+    def _release(self, queue):
+        queue.active -= 1
+        queue.grant()
+        self._report_positions(queue)
+
+    async def _produce(self, model, key, broadcast, queue, ticket, make_stream, timeout):
+        outcome = 'error'
+        try:
+            queued_at = time.perf_counter()
+            try:
+                await self._acquire(queue, ticket, timeout)
+            except QueueTimeout:
+                outcome = 'timeout'
+                raise
+            started = time.perf_counter()
+            llm_queue_wait.labels(model).observe(started - queued_at)
+            first_chunk_at = None
+            chunks = 0
+            try:
+                async for chunk in make_stream():
+                    if first_chunk_at is None:
+                        first_chunk_at = time.perf_counter()
+                        llm_time_to_first_token.labels(model).observe(first_chunk_at - started)
+                    chunks += 1
+                    broadcast.publish(chunk)
+            finally:
+                self._release(queue)
+            finished = time.perf_counter()
+            llm_generation_duration.labels(model).observe(finished - started)
+            llm_generated_tokens.labels(model).inc(chunks)
+            if chunks > 1 and finished > first_chunk_at:
+                llm_tokens_per_second.labels(model).observe((chunks - 1) / (finished - first_chunk_at))
+            outcome = 'generated'
+        except asyncio.CancelledError:
+            outcome = 'cancelled'
+            broadcast.finish(SchedulerError())
+            raise
+        except Exception as e:
+            broadcast.finish(e)
+        else:
+            broadcast.finish()
+        finally:
+            llm_requests.labels(model, outcome).inc()
+            if self._inflight.get(key) is broadcast:
+                del self._inflight[key]
+
+    async def stream(self, model, user_key, key, make_stream, on_position=None, timeout=None):
+        """
+        Runs `make_stream()` (an async iterator factory) once a slot for
+        `model` is free and yields its chunks.
+
+        Requests with the same `key` that are queued or running at the same
+        time share one generation. `on_position(position)` is called whenever
+        the request's place in the queue changes; it may return an awaitable.
+        Raises `QueueFull` immediately if the request cannot be queued, and
+        `QueueTimeout` if it waits longer than `timeout` seconds.
+        """
+        broadcast = self._inflight.get(key) if key is not None else None
+        if broadcast is None:
+            if not self.has_capacity(model, user_key):
+                llm_requests.labels(model, 'rejected').inc()
+                raise QueueFull()
+            if timeout is None:
+                timeout = settings.LLM_QUEUE_TIMEOUT
+            broadcast = _Broadcast()
+            if on_position is not None:
+                broadcast.add_position_listener(on_position)
+            if key is not None:
+                self._inflight[key] = broadcast
+            # Queue right away so the admission check above stays accurate for
+            # requests arriving before the producer task first runs.
+            queue = self._queue(model)
+            ticket = _Ticket(user_key, broadcast)
+            self._enqueue(queue, ticket)
+            broadcast.task = asyncio.ensure_future(
+                self._produce(model, key, broadcast, queue, ticket, make_stream, timeout)
+            )
+        else:
+            logger.debug(f"Coalescing LLM request for {model} with an identical in-flight prompt")
+            llm_requests.labels(model, 'coalesced').inc()
+            if on_position is not None:
+                broadcast.add_position_listener(on_position)
+
+        async for chunk in broadcast.subscribe(on_position):
+            yield chunk
+
+    async def run(self, model, user_key, key, make_coroutine, on_position=None, timeout=None):
+        """Like `stream`, for a coroutine factory producing a single result."""
+        async def single():
+            yield await make_coroutine()
+
+        # Close the stream at once so its slot is released before returning.
+        async with contextlib.aclosing(self.stream(model, user_key, key, single, on_position, timeout)) as results:
+            async for result in results:
+                return result
+
+_schedulers = weakref.WeakKeyDictionary()
+
+def get_scheduler() -> LLMScheduler:
+    """Returns the scheduler for the running event loop."""
+    loop = asyncio.get_running_loop()
+    scheduler = _schedulers.get(loop)
+    if scheduler is None:
+        scheduler = _schedulers[loop] = LLMScheduler()
+    return scheduler
+
+def _scheduler_totals(field):
+    totals = defaultdict(int)
+    for scheduler in list(_schedulers.values()):
+        for model, stats in scheduler.stats().items():
+            totals[model] += stats[field]
+    return [((model,), total) for model, total in totals.items()]
+
+CallbackGauge(
+    'llm_active_generations', "Generations running, by model.", ['model'], lambda: _scheduler_totals('active'),
+)
+CallbackGauge(
+    'llm_queued_requests', "Requests waiting for a generation slot, by model.", ['model'],
+    lambda: _scheduler_totals('queued'),
+)
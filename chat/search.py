@@ -0,0 +1,168 @@
+"""
+Full-text search over a user's private messages.
+
+On SQLite, messages are indexed in the contentless FTS5 table
+`chat_message_search`, which triggers keep in sync with `chat_message` (see
+migration 0006). Every row also carries a `thread<id>` token, so for users
+in a few threads the search is restricted to them inside the full-text
+query itself; for users in many threads, matches are checked against their
+thread memberships newest first until a page is full. Results are newest
+first and paginated by message id. Archived messages (see `chat.archive`)
+stay in the index and are found too. Other databases fall back to a
+substring search.
+"""
+import re
+
+from django.conf import settings
+from django.db import connections, router
+from django.db.models import OuterRef, Subquery
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+
+from .models import ArchivedMessage, InboxEntry, Message, Thread
+
+EXCERPT_RADIUS = 60
+
+_WORD = re.compile(r'\w+')
+
+def search_terms(query: str) -> list:
+    return _WORD.findall(query.lower())
+
+def _match_expression(terms, thread_ids=None):
+    # Terms are \w+ only, so quoting them is enough to keep FTS5 syntax out.
+    expression = 'text : (' + ' '.join(f'"{term}"' for term in terms) + ')'
+    if thread_ids is not None:
+        threads = ' OR '.join(f'thread{thread_id}' for thread_id in thread_ids)
+        expression += f' AND thread_key : ({threads})'
+    return expression
+
+def _matching_ids(user, terms, thread_ids, before, limit):
+    connection = connections[router.db_for_read(Message)]
+    if connection.vendor == 'sqlite':
+        if len(thread_ids) <= settings.CHAT_SEARCH_MAX_THREAD_TERMS:
+            # Few threads: intersect with their tokens inside the index.
+            sql = 'SELECT s.rowid FROM chat_message_search s WHERE chat_message_search MATCH %s'
+            params = [_match_expression(terms, thread_ids)]
+        else:
+            # Many threads: a long OR of thread tokens costs more than
+            # checking membership of matches as they come, newest first.
+            # Each match's thread is looked up by primary key, recent
+            # messages first, then the archive.
+            sql = (
+                'SELECT s.rowid FROM chat_message_search s '
+                'WHERE chat_message_search MATCH %s AND COALESCE('
+                '(SELECT thread_id FROM chat_message WHERE id = s.rowid), '
+                '(SELECT thread_id FROM chat_archivedmessage WHERE id = s.rowid)'
+                ') IN (SELECT thread_id FROM chat_thread_participants WHERE user_id = %s)'
+            )
+            params = [_match_expression(terms), user.id]
+        if before is not None:
+            sql += ' AND s.rowid < %s'
+            params.append(before)
+        sql += ' ORDER BY s.rowid DESC LIMIT %s'
+        params.append(limit)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return [row[0] for row in cursor.fetchall()]
+
+    ids = []
+    for model in (Message, ArchivedMessage):
+        messages = model.objects.filter(thread_id__in=thread_ids)
+        for term in terms:
+            messages = messages.filter(text__icontains=term)
+        if before is not None:
+            messages = messages.filter(id__lt=before)
+        ids += messages.order_by('-id').values_list('id', flat=True)[:limit - len(ids)]
+        if len(ids) >= limit:
+            break
+    return ids
+
+def excerpt(text: str, terms) -> str:
+    """The part of `text` around the first match, with matches highlighted."""
+    pattern = re.compile('|'.join(re.escape(term) for term in terms), re.IGNORECASE)
+    match = pattern.search(text)
+    start = max(0, match.start() - EXCERPT_RADIUS) if match else 0
+    end = min(len(text), (match.end() if match else 0) + EXCERPT_RADIUS)
+    window = text[start:end]
+
+    parts = []
+    position = 0
+    for found in pattern.finditer(window):
+        parts.append(escape(window[position:found.start()]))
+        parts.append(f'<mark>{escape(found.group())}</mark>')
+        position = found.end()
+    parts.append(escape(window[position:]))
+    prefix = '…' if start > 0 else ''
+    suffix = '…' if end < len(text) else ''
+    return mark_safe(prefix + ''.join(parts) + suffix)
+
+def _with_neighbours(messages, size):
+    """
+    Annotates the ids of up to `size` messages before and after each message
+    in its thread, in the same table (recent or archived).
+    """
+    annotations = {}
+    for offset in range(size):
+        thread_messages = messages.model.objects.filter(thread_id=OuterRef('thread_id'))
+        annotations[f'before_{offset}'] = Subquery(
+            thread_messages.filter(id__lt=OuterRef('id')).order_by('-id').values('id')[offset:offset + 1]
+        )
+        annotations[f'after_{offset}'] = Subquery(
+            thread_messages.filter(id__gt=OuterRef('id')).order_by('id').values('id')[offset:offset + 1]
+        )
+    return messages.annotate(**annotations)
+
+def search_messages(user, query, before=None, limit=None, context=None):
+    """
+    Searches the messages in `user`'s threads. Returns `(results, next_cursor)`.
+    Each result is a dict with the `message`, the `other_user` of its thread,
+    a highlighted `excerpt` and up to `context` messages `before` and `after`
+    it in the thread.
+    """
+    limit = limit or settings.CHAT_SEARCH_PAGE_SIZE
+    context = settings.CHAT_SEARCH_CONTEXT if context is None else context
+    terms = search_terms(query)
+    # Threads with deleted (deactivated) users are left out.
+    thread_ids = list(
+        Thread.objects.filter(participants=user).exclude(participants__is_active=False).values_list('id', flat=True)
+    )
+    if not terms or not thread_ids:
+        return [], None
+
+    ids = _matching_ids(user, terms, thread_ids, before, limit + 1)
+    next_cursor = ids[limit - 1] if len(ids) > limit else None
+    ids = ids[:limit]
+
+    messages = {}
+    neighbours = {}
+    for model in (Message, ArchivedMessage):
+        missing = [message_id for message_id in ids if message_id not in messages]
+        if not missing:
+            break
+        found = _with_neighbours(model.objects.filter(id__in=missing).select_related('sender'), context).in_bulk()
+        messages.update(found)
+        neighbours.update(model.objects.filter(id__in=[
+            getattr(message, f'{side}_{offset}')
+            for message in found.values() for side in ('before', 'after') for offset in range(context)
+        ]).select_related('sender').in_bulk())
+    other_users = {
+        entry.thread_id: entry.other_user
+        for entry in InboxEntry.objects.filter(user=user, thread_id__in={m.thread_id for m in messages.values()})
+        .select_related('other_user')
+    }
+
+    results = []
+    for message_id in ids:
+        message = messages.get(message_id)
+        if message is None:
+            continue
+        earlier = [neighbours.get(getattr(message, f'before_{offset}')) for offset in reversed(range(context))]
+        later = [neighbours.get(getattr(message, f'after_{offset}')) for offset in range(context)]
+        results.append({
+            'message': message,
+            'other_user': other_users.get(message.thread_id),
+            'excerpt': excerpt(message.text, terms),
+            'before': [neighbour for neighbour in earlier if neighbour is not None],
+            'after': [neighbour for neighbour in later if neighbour is not None],
+        })
+    return results, next_cursor
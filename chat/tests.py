@@ -0,0 +1,822 @@
+import asyncio
+import json
+import shutil
+import tempfile
+import unittest
+from datetime import timedelta
+from unittest import mock
+
+import httpx
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connections
+from django.test import AsyncClient, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from media.models import Media
+from media.tests import REPLICA, ReplicaMixin
+from . import codec, completion_cache, memory, ollama_client, retrieval, utils
+from . import throttling
+from .channel_layer import RedisChannelLayer
+from .completion_cache import CompletionCache, make_key
+from .consumers import FrameProtocolMixin, get_thread
+from .fake_redis import FakeRedisServer
+from .archive import archive_messages, history_page
+from .inbox import PREVIEW_LENGTH, inbox_page, mark_read, record_message
+from .models import ArchivedMessage, Conversation, ConversationTurn, InboxEntry, Message, Thread
+from .search import search_messages
+from .throttling import DISCONNECT, DROP_OLDEST, BucketRegistry, OutboundQueue, TokenBucket
+from .scheduler import LLMScheduler, QueueFull, QueueTimeout
+from .retrieval import MEDIA, EmbeddingIndex, np
+
+class RedisChannelLayerTests(SimpleTestCase):
+    """Two layer instances stand in for two worker processes sharing one server."""
+
+    async def asyncSetUp(self):
+        self.server = await FakeRedisServer().start()
+        self.layers = [RedisChannelLayer(hosts=[self.server.url], max_connections=4) for _ in range(2)]
+
+    async def asyncTearDown(self):
+        for layer in self.layers:
+            await layer.close()
+        await self.server.stop()
+
+    def run_async(self, test):
+        async def run():
+            await self.asyncSetUp()
+            try:
+                await asyncio.wait_for(test(), timeout=20)
+            finally:
+                await self.asyncTearDown()
+        asyncio.run(run())
+
+    def test_group_send_reaches_both_processes(self):
+        async def test():
+            first, second = self.layers
+            channels = [await first.new_channel(), await first.new_channel(), await second.new_channel()]
+            for layer, channel in zip((first, first, second), channels):
+                await layer.group_add('room', channel)
+            await second.group_send('room', {'type': 'chat.message', 'text': 'hi'})
+            received = await asyncio.gather(*(
+                layer.receive(channel) for layer, channel in zip((first, first, second), channels)
+            ))
+            self.assertEqual(received, [{'type': 'chat.message', 'text': 'hi'}] * 3)
+        self.run_async(test)
+
+    def test_bursts_wait_for_a_connection(self):
+        async def test():
+            first, second = self.layers
+            channels = [await first.new_channel() for _ in range(50)]
+            await asyncio.gather(*(first.group_add('room', channel) for channel in channels))
+            # Far more concurrent sends than pooled connections.
+            await asyncio.gather(*(second.group_send('room', {'type': 'tick', 'n': n}) for n in range(100)))
+            for channel in channels[:3]:
+                received = [(await first.receive(channel))['n'] for _ in range(100)]
+                self.assertEqual(sorted(received), list(range(100)))
+        self.run_async(test)
+
+    def test_presence_counts_are_shared(self):
+        async def test():
+            first, second = self.layers
+            await asyncio.gather(*(
+                layer.presence_add('room', '1:alice') for layer in (first, second) for _ in range(10)
+            ))
+            await second.presence_add('room', '2:bob')
+            await asyncio.gather(*(
+                layer.presence_discard('room', '1:alice') for layer in (first, second) for _ in range(9)
+            ))
+            self.assertEqual(await first.presence_add('room', '2:bob'), {'1:alice': 2, '2:bob': 2})
+            members = await asyncio.gather(
+                first.presence_discard('room', '1:alice'), second.presence_discard('room', '1:alice'),
+            )
+            self.assertNotIn('1:alice', members[-1])
+            self.assertEqual(await first.presence_discard('room', '2:bob'), {'2:bob': 1})
+        self.run_async(test)
+
+    def test_presence_discard_retries_after_a_concurrent_add(self):
+        async def test():
+            first, second = self.layers
+            await first.presence_add('room', '1:alice')
+            read_count = self.server.cmd_hget
+
+            def hget_then_connect(key, field):
+                # Another connection's connect lands between the read and the write.
+                count = read_count(key, field)
+                self.server.cmd_hget = read_count
+                self.server.cmd_hincrby(key, field, 1)
+                return count
+
+            self.server.cmd_hget = hget_then_connect
+            self.assertEqual(await first.presence_discard('room', '1:alice'), {'1:alice': 1})
+            self.assertEqual(await first.presence_discard('room', '1:alice'), {})
+        self.run_async(test)
+
+    def test_group_events_arrive_encoded(self):
+        async def test():
+            first, second = self.layers
+            channel = await first.new_channel()
+            await first.group_add('room', channel)
+            event = codec.group_event('chat_message', {'type': 'chat_message', 'user_id': 7, 'username': 'zoë', 'message': 'hi'})
+            await second.group_send('room', event)
+            self.assertEqual(await first.receive(channel), event)
+        self.run_async(test)
+
+    def test_presence_of_a_crashed_process_expires(self):
+        async def test():
+            first, second = [RedisChannelLayer(hosts=[self.server.url], presence_ttl=0.3) for _ in range(2)]
+            self.layers += [first, second]
+            await second.presence_add('room', '2:bob')
+            self.assertEqual(await first.presence_add('room', '1:alice'), {'1:alice': 1, '2:bob': 1})
+            # The second process dies without discarding its connections.
+            second._heartbeat.cancel()
+            await asyncio.sleep(0.5)
+            self.assertEqual(await first.presence_add('room', '1:alice'), {'1:alice': 2})
+        self.run_async(test)
+
+class CodecTests(SimpleTestCase):
+    payload = {'type': 'chat_message', 'user_id': 7, 'username': 'zoë', 'message': 'héllo "you"'}
+
+    def test_group_event_round_trips_with_each_json_codec(self):
+        for name in ('json', 'orjson'):
+            encode, decode = codec._load_codec(name)
+            with self.subTest(name), mock.patch.multiple(codec, _encode=encode, _decode=decode):
+                event = codec.group_event('chat_message', self.payload, coalesce='messages')
+                self.assertEqual(event['type'], 'chat_message')
+                self.assertEqual(event['coalesce'], 'messages')
+                self.assertEqual(codec.decode_frame(event['frame']), self.payload)
+
+    @unittest.skipUnless(codec.binary_available(), "binary frames require msgpack")
+    def test_group_event_carries_a_binary_frame(self):
+        import msgpack
+
+        event = codec.group_event('chat_message', self.payload)
+        self.assertEqual(msgpack.unpackb(event['binary']), [1, 7, 'héllo "you"'])
+        users = codec.group_event('user_list_update', {'type': 'user_list', 'user_ids': [1, 2], 'users': ['a', 'b']})
+        self.assertEqual(msgpack.unpackb(users['binary']), [2, [1, 2], ['a', 'b']])
+        # Types without a binary layout are sent as JSON only.
+        self.assertNotIn('binary', codec.group_event('chat_message', {'type': 'notice', 'text': 'x'}))
+
+    @unittest.skipUnless(codec.binary_available(), "binary frames require msgpack")
+    def test_client_binary_frames(self):
+        import msgpack
+
+        self.assertEqual(
+            codec.decode_binary_frame(msgpack.packb([1, 'hi', True])),
+            {'type': 'chat_message', 'message': 'hi', 'cache': True},
+        )
+        self.assertEqual(codec.decode_binary_frame(msgpack.packb([9, 42])), {'type': 'history', 'before': 42})
+        for payload in (b'\xc1', msgpack.packb([2, [], []]), msgpack.packb([1, 5])):
+            with self.assertRaises(codec.FrameError):
+                codec.decode_binary_frame(payload)
+
+class SummaryLLM:
+    """Returns a fixed summary once `release` is set."""
+    model = 'llama3'
+
+    def __init__(self):
+        self.release = asyncio.Event()
+        self.prompts = []
+
+    async def ainvoke(self, prompt):
+        self.prompts.append(prompt)
+        await self.release.wait()
+        return 'They said hello.'
+
+@override_settings(CHAT_MEMORY_TOKEN_BUDGET=10, CHAT_MEMORY_MAX_MESSAGES=50, CHAT_MEMORY_SUMMARIZE=True)
+class MemoryTests(TestCase):
+    # 11 characters, estimated at 3 tokens.
+    turn = 'hello world'
+
+    def setUp(self):
+        self.user = User.objects.create_user('alice', password='x')
+
+    async def add_turns(self, conversation, count):
+        return await ConversationTurn.objects.abulk_create([
+            ConversationTurn(conversation=conversation, role=ConversationTurn.HUMAN, content=f'{self.turn}{n}'[-11:], token_count=3)
+            for n in range(count)
+        ])
+
+    async def test_window_fits_the_token_budget(self):
+        # The summary takes 3 of the 10 tokens, leaving room for two turns.
+        conversation = await Conversation.objects.acreate(user=self.user, model='llama3', summary=self.turn)
+        turns = await self.add_turns(conversation, 4)
+        loaded = await memory.aload_memory(self.user, 'llama3')
+        self.assertEqual([message.content for message in loaded.chat_memory.messages], [turn.content for turn in turns[2:]])
+        self.assertEqual(loaded.persisted, 2)
+        self.assertIn(self.turn, loaded.buffer_as_messages[0].content)
+
+    @override_settings(CHAT_MEMORY_MAX_MESSAGES=1)
+    async def test_window_reads_at_most_max_messages(self):
+        conversation = await Conversation.objects.acreate(user=self.user, model='llama3')
+        await self.add_turns(conversation, 3)
+        self.assertEqual(len((await memory.aload_memory(self.user, 'llama3')).chat_memory.messages), 1)
+
+    async def test_save_appends_only_new_turns(self):
+        loaded = await memory.aload_memory(self.user, 'llama3')
+        loaded.save_context({'input': 'hi'}, {'response': 'hello'})
+        await memory.asave_memory(loaded)
+        loaded.save_context({'input': 'how are you?'}, {'response': 'fine'})
+        await memory.asave_memory(loaded)
+        await memory.asave_memory(loaded)
+        contents = [content async for content in ConversationTurn.objects.order_by('id').values_list('content', flat=True)]
+        self.assertEqual(contents, ['hi', 'hello', 'how are you?', 'fine'])
+
+    async def test_overflow_is_summarized_in_the_background(self):
+        conversation = await Conversation.objects.acreate(user=self.user, model='llama3')
+        older = await self.add_turns(conversation, 3)
+        loaded = await memory.aload_memory(self.user, 'llama3')
+        loaded.save_context({'input': 'hi'}, {'response': 'hello'})
+        llm = SummaryLLM()
+        await memory.asave_memory(loaded, llm=llm)
+
+        # Saving did not wait for the summary.
+        task = memory._summarizing[conversation.id]
+        await asyncio.sleep(0.05)
+        self.assertEqual(len(llm.prompts), 1)
+        self.assertFalse(task.done())
+        # A second save while it runs does not start another.
+        await memory.asave_memory(loaded, llm=llm)
+        self.assertIs(memory._summarizing[conversation.id], task)
+
+        llm.release.set()
+        await asyncio.wait_for(task, timeout=5)
+        await conversation.arefresh_from_db()
+        self.assertEqual(conversation.summary, 'They said hello.')
+        # With the new turns (3 tokens), only the oldest turn no longer fits.
+        self.assertEqual(conversation.summarized_through, older[0].id)
+        self.assertNotIn(conversation.id, memory._summarizing)
+
+class WordEmbedder:
+    """Embeds text as the counts of a few words, one dimension each."""
+    name = 'words'
+    words = ['cat', 'dog', 'beach', 'sunset']
+    dim = len(words)
+
+    def embed(self, texts):
+        return np.array([[text.lower().split().count(word) for word in self.words] for text in texts], dtype=np.float32)
+
+    async def aembed(self, texts):
+        return self.embed(texts)
+
+@unittest.skipIf(np is None, "retrieval requires numpy")
+class EmbeddingIndexTests(SimpleTestCase):
+    def setUp(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path, ignore_errors=True)
+        self.index = EmbeddingIndex(path, WordEmbedder())
+
+    def query(self, text):
+        return self.index.embedder.embed([text])[0]
+
+    def test_search_ranks_by_similarity(self):
+        self.index.append([(MEDIA, 1), (MEDIA, 2), (MEDIA, 3), (MEDIA, 4)], ['dog', 'cat dog', 'cat', 'beach'])
+        hits = self.index.search(self.query('cat'), k=3, min_score=0.1)
+        self.assertEqual([object_id for _, object_id, _ in hits], [3, 2])
+        self.assertAlmostEqual(hits[0][2], 1.0, places=5)
+
+    def test_ranked_reads_further_and_skips_repeated_documents(self):
+        texts = ['cat ' * n + 'dog ' * (10 - n) for n in range(10, 0, -1)]
+        self.index.append([(MEDIA, n) for n in range(10)], texts)
+        # Re-indexed documents appear once, at their best score.
+        self.index.append([(MEDIA, 0), (MEDIA, 1)], texts[:2])
+        batches = list(self.index.ranked(self.query('cat'), batch=2))
+        self.assertEqual([len(batch) for batch in batches], [1, 1, 4, 4])
+        self.assertEqual([object_id for batch in batches for _, object_id, _ in batch], list(range(10)))
+
+@unittest.skipIf(np is None, "retrieval requires numpy")
+@override_settings(CHAT_RAG_TOP_K=2, CHAT_RAG_MIN_SCORE=0.1)
+class RetrievalContextTests(TestCase):
+    def setUp(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path, ignore_errors=True)
+        self.index = EmbeddingIndex(path, WordEmbedder())
+        patcher = mock.patch.object(retrieval, 'get_index', return_value=self.index)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.owner = User.objects.create_user('owner', password='x')
+
+    def add_media(self, title, **fields):
+        media = Media.objects.create(owner=self.owner, title=title, file='user_media/a.jpg', **fields)
+        self.index.append([(MEDIA, media.pk)], [title])
+        return media
+
+    async def test_private_and_deleted_hits_do_not_crowd_out_public_ones(self):
+        for n in range(10):
+            await self.async_add_media(f'cat {n}', is_public=False)
+        await self.async_add_media('cat', deleted_at=timezone.now())
+        await self.async_add_media('cat dog')
+        await self.async_add_media('cat dog dog')
+        await self.async_add_media('dog')
+
+        context = await retrieval.aretrieve_context('cat')
+        lines = [line for line in context.splitlines() if line.startswith('- ')]
+        self.assertEqual(len(lines), 2)
+        self.assertIn('"cat dog" uploaded by owner', lines[0])
+        self.assertIn('"cat dog dog" uploaded by owner', lines[1])
+
+    def test_rebuild_keeps_rows_appended_meanwhile(self):
+        self.add_media('cat')
+        original_append = EmbeddingIndex.append
+        appended = []
+
+        def append_during_rebuild(index, keys, texts):
+            if index is not self.index and not appended:
+                # An upload commits after the rebuild read its table.
+                appended.append(self.index.append([(MEDIA, 99)], ['beach']))
+            original_append(index, keys, texts)
+
+        with mock.patch.object(EmbeddingIndex, 'append', append_during_rebuild):
+            self.assertEqual(retrieval.rebuild_index(), 1)
+        self.assertEqual(len(self.index), 2)
+        self.assertEqual(self.index.search(self.index.embedder.embed(['beach'])[0], k=1)[0][:2], (MEDIA, 99))
+
+    async def test_nothing_visible(self):
+        await self.async_add_media('cat', is_public=False)
+        self.assertEqual(await retrieval.aretrieve_context('cat'), '')
+
+    async def async_add_media(self, title, **fields):
+        from asgiref.sync import sync_to_async
+        return await sync_to_async(self.add_media)(title, **fields)
+
+class ConsumerReplicaTests(ReplicaMixin, TransactionTestCase):
+    async def test_reconnecting_finds_the_new_thread(self):
+        alice = await User.objects.acreate(username='alice')
+        bob = await User.objects.acreate(username='bob')
+        # Connections are not requests: the second lookup must see the first's thread.
+        first = await get_thread(alice, bob.id)
+        self.assertEqual(await get_thread(alice, bob.id), first)
+        self.assertEqual(await Thread.objects.acount(), 1)
+        self.assertFalse(await Thread.objects.using(REPLICA).aexists())
+
+@override_settings(LLM_MAX_CONCURRENCY=1, LLM_MODEL_CONCURRENCY={}, LLM_MAX_QUEUE=10, LLM_MAX_QUEUE_PER_USER=5)
+class SchedulerTests(SimpleTestCase):
+    def setUp(self):
+        self.scheduler = LLMScheduler()
+        self.started = []
+        self.gate = asyncio.Event()
+
+    def generation(self, name):
+        """A generation that records its start and waits for `self.gate` before yielding `name`."""
+        async def make_stream():
+            self.started.append(name)
+            await self.gate.wait()
+            yield name
+        return make_stream
+
+    def request(self, user, name, key=None, **kwargs):
+        async def collect():
+            return [chunk async for chunk in self.scheduler.stream('m', user, key, self.generation(name), **kwargs)]
+        return asyncio.ensure_future(collect())
+
+    async def test_users_take_turns(self):
+        requests = [self.request('a', f'a{n}') for n in range(4)] + [self.request('b', 'b0')]
+        await asyncio.sleep(0)
+        self.gate.set()
+        await asyncio.wait_for(asyncio.gather(*requests), 5)
+        # b waits for a's running request, not for all of a's queue.
+        self.assertEqual(self.started, ['a0', 'a1', 'b0', 'a2', 'a3'])
+
+    async def test_identical_requests_share_a_generation(self):
+        first = self.request('a', 'first', key='same prompt')
+        second = self.request('b', 'second', key='same prompt')
+        await asyncio.sleep(0)
+        self.gate.set()
+        self.assertEqual(await asyncio.wait_for(asyncio.gather(first, second), 5), [['first'], ['first']])
+        self.assertEqual(self.started, ['first'])
+
+    @override_settings(LLM_MAX_QUEUE_PER_USER=1)
+    async def test_full_queue_rejects_at_once(self):
+        running = self.request('a', 'a0')
+        queued = self.request('a', 'a1')
+        await asyncio.sleep(0)
+        with self.assertRaises(QueueFull):
+            await asyncio.wait_for(self.request('a', 'a2'), 1)
+        # Other users still get a place.
+        other = self.request('b', 'b0')
+        self.gate.set()
+        await asyncio.wait_for(asyncio.gather(running, queued, other), 5)
+
+    async def test_queued_request_times_out(self):
+        running = self.request('a', 'a0')
+        with self.assertRaises(QueueTimeout):
+            await asyncio.wait_for(self.request('b', 'b0', timeout=0.05), 5)
+        self.assertEqual(self.scheduler.stats()['m'], {'active': 1, 'queued': 0, 'limit': 1})
+        self.gate.set()
+        await asyncio.wait_for(running, 5)
+        self.assertEqual(self.started, ['a0'])
+
+    async def test_positions_are_reported(self):
+        positions = {'b': [], 'c': []}
+        requests = [self.request('a', 'a0')] + [
+            self.request(user, f'{user}0', on_position=positions[user].append) for user in ('b', 'c')
+        ]
+        await asyncio.sleep(0)
+        self.assertEqual(positions, {'b': [1], 'c': [2]})
+        self.gate.set()
+        await asyncio.wait_for(asyncio.gather(*requests), 5)
+        # 0 means generation has started.
+        self.assertEqual(positions, {'b': [1, 0], 'c': [2, 1, 0]})
+
+class InboxTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+        self.thread = Thread.objects.create()
+        self.thread.participants.add(self.alice, self.bob)
+        self.participant_ids = [self.alice.pk, self.bob.pk]
+
+    def send(self, sender, text, thread=None):
+        message = Message.objects.create(thread=thread or self.thread, sender=sender, text=text)
+        record_message(message, self.participant_ids)
+        return message
+
+    def entry(self, user):
+        return InboxEntry.objects.get(user=user, thread=self.thread)
+
+    def test_first_message_creates_entries(self):
+        message = self.send(self.alice, 'x' * 500)
+        alice, bob = self.entry(self.alice), self.entry(self.bob)
+        self.assertEqual((alice.other_user, alice.unread_count), (self.bob, 0))
+        self.assertEqual((bob.other_user, bob.unread_count), (self.alice, 1))
+        self.assertEqual(bob.last_activity, message.created_at)
+        self.assertEqual(len(bob.last_message_preview), PREVIEW_LENGTH)
+
+    def test_later_messages_update_in_one_query(self):
+        self.send(self.alice, 'hello')
+        message = Message.objects.create(thread=self.thread, sender=self.alice, text='again')
+        with self.assertNumQueries(1):
+            record_message(message, self.participant_ids)
+        self.assertEqual(self.entry(self.bob).unread_count, 2)
+        self.assertEqual(self.entry(self.bob).last_message_preview, 'again')
+
+        # Replying resets the sender's count only.
+        self.send(self.bob, 'hi')
+        self.assertEqual((self.entry(self.alice).unread_count, self.entry(self.bob).unread_count), (1, 0))
+
+        mark_read(self.alice, self.thread.pk)
+        self.assertEqual(self.entry(self.alice).unread_count, 0)
+
+    def test_pages_follow_the_cursor(self):
+        same_time = timezone.now()
+        for n in range(5):
+            InboxEntry.objects.create(
+                user=self.alice, thread=Thread.objects.create(), other_user=self.bob,
+                last_activity=same_time - timedelta(minutes=n % 2),
+            )
+        expected = list(InboxEntry.objects.filter(user=self.alice).order_by('-last_activity', '-id'))
+
+        pages, cursor = [], None
+        while True:
+            entries, cursor = inbox_page(self.alice, before=cursor, limit=2)
+            pages.append(entries)
+            if cursor is None:
+                break
+        self.assertEqual([len(page) for page in pages], [2, 2, 1])
+        self.assertEqual([entry for page in pages for entry in page], expected)
+        # A malformed cursor starts from the top.
+        self.assertEqual(inbox_page(self.alice, before='nonsense', limit=2)[0], expected[:2])
+
+    def test_conversations_with_deactivated_users_are_hidden(self):
+        self.send(self.bob, 'hello')
+        self.bob.is_active = False
+        self.bob.save()
+        self.assertEqual(inbox_page(self.alice), ([], None))
+
+class SearchTests(TestCase):
+    def setUp(self):
+        self.alice, self.bob, self.carol = (User.objects.create_user(name) for name in ('alice', 'bob', 'carol'))
+        self.own = self.thread(self.alice, self.bob)
+        self.others = self.thread(self.bob, self.carol)
+        self.visible = [
+            Message.objects.create(thread=self.own, sender=self.bob, text=f'the secret plan, part {n}') for n in range(3)
+        ]
+        Message.objects.create(thread=self.others, sender=self.carol, text='the secret plan, between us')
+
+    def thread(self, *users):
+        thread = Thread.objects.create()
+        thread.participants.add(*users)
+        return thread
+
+    def found(self, user=None, query='secret plan'):
+        results, _ = search_messages(user or self.alice, query)
+        return [result['message'].id for result in results]
+
+    def expected(self):
+        return [message.id for message in reversed(self.visible)]
+
+    def test_only_own_threads_are_searched(self):
+        # Few threads are matched inside the index, many are checked per match.
+        for max_thread_terms in (50, 0):
+            with self.subTest(max_thread_terms=max_thread_terms), \
+                    override_settings(CHAT_SEARCH_MAX_THREAD_TERMS=max_thread_terms):
+                self.assertEqual(self.found(), self.expected())
+                self.assertEqual(len(self.found(self.carol)), 1)
+
+    def test_only_own_threads_are_searched_without_fts(self):
+        with mock.patch.object(connections['default'], 'vendor', 'postgresql'):
+            self.assertEqual(self.found(), self.expected())
+            self.assertEqual(len(self.found(self.carol)), 1)
+
+    def test_archived_messages_stay_searchable(self):
+        archive_messages(timezone.now() + timedelta(seconds=1))
+        self.assertFalse(Message.objects.exists())
+        for max_thread_terms in (50, 0):
+            with self.subTest(max_thread_terms=max_thread_terms), \
+                    override_settings(CHAT_SEARCH_MAX_THREAD_TERMS=max_thread_terms):
+                self.assertEqual(self.found(), self.expected())
+                self.assertEqual(len(self.found(self.carol)), 1)
+        # Deleting from the archive removes the message from the index.
+        ArchivedMessage.objects.filter(pk=self.visible[-1].pk).delete()
+        self.assertEqual(self.found(), self.expected()[1:])
+
+class ArchiveTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user('alice')
+        self.thread = Thread.objects.create()
+        self.ids = [
+            Message.objects.create(thread=self.thread, sender=self.alice, text=f'message {n}').id for n in range(7)
+        ]
+        # The first four are old.
+        Message.objects.filter(id__in=self.ids[:4]).update(created_at=timezone.now() - timedelta(days=100))
+
+    def archive(self):
+        return archive_messages(timezone.now() - timedelta(days=90), batch_size=3)
+
+    def test_archiving_moves_old_messages_once(self):
+        self.assertEqual(self.archive(), 4)
+        self.assertEqual(list(ArchivedMessage.objects.order_by('id').values_list('id', flat=True)), self.ids[:4])
+        self.assertEqual(list(Message.objects.order_by('id').values_list('id', flat=True)), self.ids[4:])
+        self.assertEqual(self.archive(), 0)
+
+    def test_history_pages_run_from_recent_into_archived_messages(self):
+        self.archive()
+        pages, cursor = [], None
+        while True:
+            messages, cursor = history_page(self.thread.pk, before=cursor, limit=2)
+            pages.insert(0, [(message.id, message.text) for message in messages])
+            if cursor is None:
+                break
+        self.assertEqual([len(page) for page in pages], [1, 2, 2, 2])
+        self.assertEqual([message for page in pages for message in page], [(pk, f'message {n}') for n, pk in enumerate(self.ids)])
+
+class TokenBucketTests(SimpleTestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch.object(throttling, 'time', mock.Mock(monotonic=lambda: self.now))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_refills_at_the_rate_up_to_the_burst(self):
+        bucket = TokenBucket(rate=2, burst=3)
+        self.assertEqual([bucket.consume() for _ in range(4)], [True, True, True, False])
+        self.assertAlmostEqual(bucket.retry_after(), 0.5)
+        self.now += 0.5
+        self.assertEqual([bucket.consume() for _ in range(2)], [True, False])
+        self.now += 60
+        self.assertTrue(bucket.is_full)
+        self.assertEqual([bucket.consume() for _ in range(4)], [True, True, True, False])
+
+class OutboundQueueTests(SimpleTestCase):
+    def setUp(self):
+        self.sent = []
+        self.reading = asyncio.Event()
+
+    async def send(self, frame):
+        await self.reading.wait()
+        self.sent.append(frame)
+
+    async def drain(self, queue, count):
+        self.reading.set()
+        while len(self.sent) < count:
+            await asyncio.sleep(0.01)
+        await queue.close()
+
+    async def test_drop_oldest(self):
+        queue = OutboundQueue(self.send, max_size=3, policy=DROP_OLDEST)
+        self.assertTrue(all(queue.put(n) for n in range(5)))
+        self.assertEqual(queue.dropped, 2)
+        await asyncio.wait_for(self.drain(queue, 3), 5)
+        self.assertEqual(self.sent, [2, 3, 4])
+
+    async def test_disconnect(self):
+        queue = OutboundQueue(self.send, max_size=3, policy=DISCONNECT)
+        self.assertEqual([queue.put(n) for n in range(4)], [True, True, True, False])
+        await asyncio.wait_for(self.drain(queue, 3), 5)
+        self.assertEqual(self.sent, [0, 1, 2])
+
+    async def test_presence_updates_are_coalesced(self):
+        queue = OutboundQueue(self.send, max_size=3, policy=DISCONNECT)
+        queue.put('online: a', coalesce_key='presence')
+        queue.put('message')
+        queue.put('online: a, b', coalesce_key='presence')
+        self.assertEqual(len(queue), 2)
+        await asyncio.wait_for(self.drain(queue, 2), 5)
+        self.assertEqual(self.sent, ['online: a, b', 'message'])
+
+    async def test_write_error_stops_the_queue(self):
+        errors = []
+
+        async def send(frame):
+            raise ConnectionResetError('gone')
+
+        async def on_error(error):
+            errors.append(error)
+
+        queue = OutboundQueue(send, max_size=3, on_error=on_error)
+        queue.put('first')
+        queue.put('second')
+        async def failed():
+            while not errors:
+                await asyncio.sleep(0.01)
+
+        with self.assertLogs('chat.throttling', 'ERROR'):
+            await asyncio.wait_for(failed(), 5)
+        self.assertIsInstance(errors[0], ConnectionResetError)
+        self.assertEqual(len(queue), 0)
+        self.assertFalse(queue.put('third'))
+        await queue.close()
+
+class FrameConsumer(FrameProtocolMixin):
+    """Just enough of a consumer to check incoming frames."""
+
+    def __init__(self):
+        self.user = mock.Mock(id=1)
+        self.rate_limit = TokenBucket(rate=1, burst=1)
+        self.strikes = 0
+        self.closed_with = None
+        self.frames = []
+
+    async def close(self, code=None):
+        self.closed_with = code
+
+    async def send_frame(self, data):
+        self.frames.append(data)
+
+@override_settings(CHAT_MAX_FRAME_BYTES=100, CHAT_FLOOD_MAX_STRIKES=3)
+class AdmitFrameTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch.object(FrameProtocolMixin, 'user_buckets', BucketRegistry(rate=100, burst=100))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.consumer = FrameConsumer()
+
+    async def test_oversized_frame_closes_with_1009(self):
+        with self.assertLogs('chat.consumers', 'WARNING'):
+            self.assertFalse(await self.consumer.admit_frame(text_data='x' * 101))
+        self.assertEqual(self.consumer.closed_with, 1009)
+        self.assertFalse(await self.consumer.admit_frame(text_data='x'))
+
+    async def test_flooding_closes_with_1008(self):
+        self.assertTrue(await self.consumer.admit_frame(text_data='x'))
+        self.assertFalse(await self.consumer.admit_frame(text_data='x'))
+        # The client is told once, then closed after three rejected frames in a row.
+        self.assertEqual([frame['type'] for frame in self.consumer.frames], ['rate_limited'])
+        self.assertFalse(await self.consumer.admit_frame(bytes_data=b'x'))
+        self.assertIsNone(self.consumer.closed_with)
+        with self.assertLogs('chat.consumers', 'WARNING'):
+            self.assertFalse(await self.consumer.admit_frame(text_data='x'))
+        self.assertEqual(self.consumer.closed_with, 1008)
+        self.assertEqual(len(self.consumer.frames), 1)
+
+@override_settings(OLLAMA_MODEL='default-model', OLLAMA_MAX_RETRIES=2)
+class ModelCatalogueTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        executor = mock.patch.object(utils, '_catalogue_executor')
+        self.executor = executor.start()
+        self.addCleanup(executor.stop)
+
+    def test_cold_cache_does_not_wait_for_ollama(self):
+        with mock.patch.object(ollama_client, 'request') as request:
+            self.assertEqual(utils.get_ollama_models(), ['default-model'])
+            self.assertFalse(utils.is_available_model('other-model'))
+            request.assert_not_called()
+        # One background refresh, however many requests miss meanwhile.
+        self.executor.submit.assert_called_once_with(utils._store_model_catalogue)
+
+        response = httpx.Response(
+            200, json={'models': [{'name': 'default-model'}, {'name': 'other-model'}]},
+            request=httpx.Request('GET', '/api/tags'),
+        )
+        with mock.patch.object(ollama_client, 'request', return_value=response):
+            utils._store_model_catalogue()
+        self.assertTrue(utils.is_available_model('other-model'))
+
+    def test_catalogue_requests_are_not_retried(self):
+        client = mock.Mock(request=mock.Mock(side_effect=httpx.ConnectError('refused')))
+        with mock.patch.object(ollama_client, 'get_sync_client', return_value=client):
+            with self.assertRaises(httpx.ConnectError):
+                utils.fetch_ollama_models()
+        self.assertEqual(client.request.call_count, 1)
+
+class CompletionCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch.object(completion_cache, 'time', mock.Mock(monotonic=lambda: self.now))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_keys_ignore_whitespace_only(self):
+        key = make_key('m', 'Be nice.', [('human', 'hi'), ('ai', 'hello')], 'How are you?')
+        self.assertEqual(key, make_key('m', ' Be  nice. ', [('human', 'hi '), ('ai', 'hello')], 'How\nare you?'))
+        for other in (
+            make_key('other', 'Be nice.', [('human', 'hi'), ('ai', 'hello')], 'How are you?'),
+            make_key('m', 'Be brief.', [('human', 'hi'), ('ai', 'hello')], 'How are you?'),
+            make_key('m', 'Be nice.', [('human', 'hi')], 'How are you?'),
+            make_key('m', 'Be nice.', [('human', 'hi'), ('ai', 'hello')], 'how are you?'),
+        ):
+            self.assertNotEqual(key, other)
+
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = CompletionCache(max_entries=2, ttl=60)
+        cache.set('a', 'A')
+        cache.set('b', 'B')
+        self.assertEqual(cache.get('a'), 'A')
+        cache.set('c', 'C')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual((cache.get('a'), cache.get('c')), ('A', 'C'))
+        self.assertEqual(
+            {key: cache.stats()[key] for key in ('size', 'hits', 'misses', 'evictions')},
+            {'size': 2, 'hits': 3, 'misses': 1, 'evictions': 1},
+        )
+
+    def test_entries_expire(self):
+        cache = CompletionCache(max_entries=2, ttl=60)
+        cache.set('a', 'A')
+        cache.set('b', 'B', ttl=120)
+        self.now += 61
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('b'), 'B')
+        self.assertEqual(cache.stats()['size'], 1)
+
+@override_settings(LLM_CACHE_ENABLED=True, LLM_MAX_CONCURRENCY=2, LLM_MODEL_CONCURRENCY={})
+class CompletionOptOutTests(SimpleTestCase):
+    def setUp(self):
+        utils.completion_cache.clear()
+        self.addCleanup(utils.completion_cache.clear)
+        self.calls = 0
+        patcher = mock.patch.object(utils, '_ollama_chat', self.chat)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def chat(self, model, message):
+        self.calls += 1
+        call = self.calls
+        await asyncio.sleep(0.01)
+        return f'reply {call}'
+
+    async def ask(self, use_cache, count=2):
+        return await asyncio.gather(*(
+            utils.get_ollama_response('hello', 'm', use_cache=use_cache, user_key=n) for n in range(count)
+        ))
+
+    async def test_opted_out_requests_run_their_own_generation(self):
+        self.assertEqual(sorted(await self.ask(use_cache=False)), ['reply 1', 'reply 2'])
+        self.assertEqual(utils.completion_cache.stats()['size'], 0)
+
+    async def test_cached_requests_share_a_generation(self):
+        self.assertEqual(await self.ask(use_cache=True), ['reply 1', 'reply 1'])
+        self.assertEqual(await self.ask(use_cache=True, count=1), ['reply 1'])
+        self.assertEqual(self.calls, 1)
+
+class ChatApiResponseTests(SimpleTestCase):
+    def setUp(self):
+        async def stream_reply(message, model, use_cache, user_key):
+            for chunk in ('Hel', 'lo'):
+                yield chunk
+
+        async def reply(message, model, use_cache, user_key):
+            return 'Hello'
+
+        for name, replacement in (
+            ('is_available_model', lambda model: True), ('stream_ollama_response', stream_reply),
+            ('get_ollama_response', reply),
+        ):
+            patcher = mock.patch(f'chat.views.{name}', replacement)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def post(self, body, **headers):
+        return await AsyncClient().post(
+            reverse('chat_api'), json.dumps({'message': 'hi', 'model': 'm', **body}),
+            content_type='application/json', headers=headers,
+        )
+
+    async def read_stream(self, response):
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = b''.join([chunk async for chunk in response.streaming_content]).decode().splitlines()
+        return [json.loads(line) for line in lines]
+
+    async def test_single_json_reply_by_default(self):
+        response = await self.post({})
+        self.assertEqual(response.json(), {'reply': 'Hello', 'model': 'm'})
+
+    async def test_stream_on_request(self):
+        expected = [{'token': 'Hel'}, {'token': 'lo'}, {'done': True, 'reply': 'Hello', 'model': 'm'}]
+        self.assertEqual(await self.read_stream(await self.post({'stream': True})), expected)
+        self.assertEqual(await self.read_stream(await self.post({}, accept='application/x-ndjson')), expected)
+        # An explicit "stream": false wins over the Accept header.
+        response = await self.post({'stream': False}, accept='application/x-ndjson')
+        self.assertEqual(response.json(), {'reply': 'Hello', 'model': 'm'})
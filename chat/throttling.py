@@ -0,0 +1,167 @@
+"""
+Flood control for the chat WebSockets.
+
+- `TokenBucket` limits how fast one connection may send frames, and
+  `BucketRegistry` keeps one bucket per user, shared by all of that user's
+  connections in this process.
+- `OutboundQueue` holds the frames waiting to be written to one socket. It
+  is bounded, so a client that reads slowly cannot make the server buffer
+  its messages without limit. Queued presence updates are coalesced (only
+  the newest one is kept); when the queue is still full, the oldest frame is
+  dropped or the connection is closed, depending on the policy. If writing
+  fails, the queue stops and reports the error through `on_error`, so the
+  connection can be closed instead of queueing frames nobody will write.
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+DROP_OLDEST = 'drop_oldest'
+DISCONNECT = 'disconnect'
+
+class TokenBucket:
+    """Allows `rate` events per second on average, with bursts of up to `burst`."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self, tokens: float = 1) -> bool:
+        """Takes `tokens` from the bucket if it holds enough."""
+        self._refill()
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
+
+    def retry_after(self, tokens: float = 1) -> float:
+        """Seconds until `tokens` will be available."""
+        self._refill()
+        return max(0.0, (tokens - self.tokens) / self.rate)
+
+    @property
+    def is_full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.burst
+
+class BucketRegistry:
+    """Token buckets by key. Full (idle) buckets are pruned once there are more than `max_keys`."""
+
+    def __init__(self, rate: float, burst: float, max_keys: int = 10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = {}
+
+    def get(self, key) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= self.max_keys:
+                self._prune()
+            bucket = self._buckets[key] = TokenBucket(self.rate, self.burst)
+        return bucket
+
+    def _prune(self):
+        # A full bucket behaves exactly like a new one, so dropping it is safe.
+        for key in [key for key, bucket in self._buckets.items() if bucket.is_full]:
+            del self._buckets[key]
+
+class OutboundQueue:
+    """
+    A bounded queue of frames for one connection, written out by a
+    background task through `send(frame)`. If `send` raises, the queue
+    stops and awaits `on_error(error)`.
+    """
+
+    def __init__(self, send, max_size: int, policy: str = DROP_OLDEST, on_error=None):
+        self._send = send
+        self._on_error = on_error
+        self.max_size = max_size
+        self.policy = policy
+        self.failed = False
+        self._frames = deque()
+        # coalesce key -> queued entry, for frames that supersede each other.
+        self._coalescing = {}
+        self._ready = asyncio.Event()
+        self._task = asyncio.ensure_future(self._run())
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self._frames)
+
+    def put(self, frame, coalesce_key=None) -> bool:
+        """
+        Queues `frame`. Returns False if the queue overflowed under the
+        `DISCONNECT` policy, or writing has failed; the caller should then
+        close the connection.
+        """
+        if self.failed:
+            return False
+        if coalesce_key is not None:
+            entry = self._coalescing.get(coalesce_key)
+            if entry is not None:
+                # Replace the queued frame in place; only the newest state matters.
+                entry[1] = frame
+                return True
+
+        if len(self._frames) >= self.max_size:
+            if self.policy == DISCONNECT:
+                return False
+            dropped_key, _ = self._frames.popleft()
+            if dropped_key is not None:
+                del self._coalescing[dropped_key]
+            self.dropped += 1
+
+        entry = [coalesce_key, frame]
+        self._frames.append(entry)
+        if coalesce_key is not None:
+            self._coalescing[coalesce_key] = entry
+        self._ready.set()
+        return True
+
+    async def _run(self):
+        while True:
+            await self._ready.wait()
+            while self._frames:
+                coalesce_key, frame = self._frames.popleft()
+                if coalesce_key is not None:
+                    del self._coalescing[coalesce_key]
+                try:
+                    await self._send(frame)
+                except Exception as e:
+                    await self._fail(e)
+                    return
+            self._ready.clear()
+
+    async def _fail(self, error):
+        logger.error(f"WebSocket writer failed: {error}", exc_info=True)
+        self.failed = True
+        self._frames.clear()
+        self._coalescing.clear()
+        if self._on_error is not None:
+            try:
+                await self._on_error(error)
+            except Exception as e:
+                logger.warning(f"Handling a WebSocket write error failed: {e}")
+
+    async def close(self):
+        """Stops writing; frames still queued are discarded."""
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.warning(f"WebSocket writer failed: {e}")
+        if self.dropped:
+            logger.info(f"Dropped {self.dropped} frames for a slow WebSocket client")
@@ -4,6 +4,8 @@ from . import views
 urlpatterns = [
     path('chat/', views.chat_room, name='chat_room'),
     path('chat/users/', views.users_list, name='chat_users_list'),
+    path('chat/inbox/', views.inbox, name='chat_inbox'),
+    path('chat/search/', views.message_search, name='chat_search'),
     path('chat/private/<int:user_id>/', views.private_chat_room, name='private_chat_room'),
     path('public-chatbot/', views.public_chatbot_view, name='public_chatbot'),
     path('api/chat/', views.chat_api, name='chat_api'),
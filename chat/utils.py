@@ -1,97 +1,216 @@
+import asyncio
 import httpx
+import importlib
 import json
 import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from django.conf import settings
-from langchain_community.chat_models import ChatOllama
-from langchain.chains import LLMChain
-from langchain.memory import ConversationBufferMemory
-from langchain.prompts import (
-    ChatPromptTemplate,
-    MessagesPlaceholder,
-    SystemMessagePromptTemplate,
-    HumanMessagePromptTemplate,
-)
-from langchain.schema import messages_from_dict, messages_to_dict
+from django.core.cache import cache
+from . import ollama_client
+from .completion_cache import completion_cache, make_key
+from .scheduler import get_scheduler
+from media_sharing_project.metrics import Counter
 
 logger = logging.getLogger(__name__)
 
-def get_ollama_models():
-    """Fetches the list of available models from the Ollama API."""
+SYSTEM_PROMPT = "You are a helpful and friendly AI assistant. Provide clear and concise answers."
+
+# The model catalogue is cached in the Django cache so every worker shares it.
+# Entries outlive their TTL so a stale list can be served while it is refreshed.
+MODEL_CATALOGUE_CACHE_KEY = 'ollama:model_catalogue'
+MODEL_CATALOGUE_LOCK_KEY = 'ollama:model_catalogue:refreshing'
+_catalogue_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ollama-models')
+
+llm_cache_lookups = Counter('llm_cache_lookups_total', "Completion cache lookups by result: hit or miss.", ['result'])
+
+def fetch_ollama_models():
+    """Fetches the list of available models from the Ollama API, raising on failure."""
+    # Not retried: a refresh that fails is tried again after OLLAMA_MODELS_CACHE_RETRY_TTL.
+    response = ollama_client.request('GET', '/api/tags', timeout=5.0, max_retries=0)
+    response.raise_for_status()
+    models_data = response.json().get('models', [])
+    return [model['name'] for model in models_data]
+
+def _store_model_catalogue():
+    # Must be called with MODEL_CATALOGUE_LOCK_KEY held; releases it.
     try:
-        response = httpx.get(f"{settings.OLLAMA_HOST}/api/tags", timeout=5.0)
-        response.raise_for_status()
-        models_data = response.json().get('models', [])
-        return [model['name'] for model in models_data]
-    except (httpx.RequestError, json.JSONDecodeError):
-        # Fallback to the default model if the API is unavailable
+        entry = {'models': fetch_ollama_models(), 'expires_at': time.time() + settings.OLLAMA_MODELS_CACHE_TTL}
+        cache.set(MODEL_CATALOGUE_CACHE_KEY, entry, settings.OLLAMA_MODELS_CACHE_TTL + settings.OLLAMA_MODELS_CACHE_STALE_TTL)
+        return entry
+    except (httpx.RequestError, httpx.HTTPStatusError, json.JSONDecodeError) as e:
+        logger.warning(f"Could not refresh the Ollama model catalogue: {e}")
+        # Keep serving the last known list (or the default model) and retry
+        # later, so a down Ollama is not hit on every request.
+        entry = cache.get(MODEL_CATALOGUE_CACHE_KEY) or {'models': [settings.OLLAMA_MODEL]}
+        entry['expires_at'] = time.time() + settings.OLLAMA_MODELS_CACHE_RETRY_TTL
+        cache.set(MODEL_CATALOGUE_CACHE_KEY, entry, settings.OLLAMA_MODELS_CACHE_RETRY_TTL + settings.OLLAMA_MODELS_CACHE_STALE_TTL)
+        return entry
+    finally:
+        cache.delete(MODEL_CATALOGUE_LOCK_KEY)
+
+def schedule_model_catalogue_refresh():
+    """Refreshes the model catalogue in a background thread, unless a refresh is already running."""
+    if cache.add(MODEL_CATALOGUE_LOCK_KEY, True, timeout=30):
+        _catalogue_executor.submit(_store_model_catalogue)
+
+def get_ollama_models():
+    """
+    Returns the list of available models from the shared cache.
+
+    A fresh list is returned as-is. A stale list is returned immediately while
+    a background refresh is scheduled (stale-while-revalidate). A cold cache
+    does not wait for Ollama either: it returns just the default model until
+    the refresh it schedules has filled the cache.
+    """
+    entry = cache.get(MODEL_CATALOGUE_CACHE_KEY)
+    if entry is None or entry['expires_at'] <= time.time():
+        schedule_model_catalogue_refresh()
+    if entry is None:
         return [settings.OLLAMA_MODEL]
+    return entry['models']
+
+def is_available_model(model: str) -> bool:
+    """Checks `model` against the cached model catalogue, without calling Ollama."""
+    return model in get_ollama_models()
+
+async def warm_model_catalogue():
+    """ASGI startup hook that fills the model catalogue without delaying startup."""
+    schedule_model_catalogue_refresh()
+
+def get_cached_completion(cache_key: str, use_cache: bool = True):
+    """
+    Looks up a completion in the completion cache. Returns None on a miss,
+    when caching is disabled, or when the caller opted out with `use_cache`.
+    """
+    if not (settings.LLM_CACHE_ENABLED and use_cache):
+        return None
+    completion = completion_cache.get(cache_key)
+    llm_cache_lookups.labels('miss' if completion is None else 'hit').inc()
+    return completion
+
+def store_completion(cache_key: str, completion: str, use_cache: bool = True):
+    """Stores a completion, unless caching is disabled or the caller opted out with `use_cache`."""
+    if settings.LLM_CACHE_ENABLED and use_cache and completion:
+        completion_cache.set(cache_key, completion)
+
+async def _ollama_chat(model: str, message: str) -> str:
+    # Using /api/chat for better prompt handling with some models
+    response = await ollama_client.arequest(
+        'POST',
+        '/api/chat',
+        json={
+            "model": model,
+            "messages": [{"role": "user", "content": message}],
+            "stream": False
+        },
+    )
+    response.raise_for_status()
+    data = response.json()
+    return data.get('message', {}).get('content', '').strip()
 
-async def get_ollama_response(message: str, model: str = None) -> str:
-    """Gets a stateless response from the Ollama API."""
+async def _ollama_chat_stream(model: str, message: str):
+    async with ollama_client.astream(
+        'POST',
+        '/api/chat',
+        json={
+            "model": model,
+            "messages": [{"role": "user", "content": message}],
+            "stream": True
+        },
+    ) as response:
+        response.raise_for_status()
+        # Ollama streams newline-delimited JSON objects, one per chunk.
+        async for line in response.aiter_lines():
+            if not line:
+                continue
+            data = json.loads(line)
+            chunk = data.get('message', {}).get('content', '')
+            if chunk:
+                yield chunk
+            if data.get('done'):
+                break
+
+async def get_ollama_response(message: str, model: str = None, use_cache: bool = True,
+                              user_key=None, on_position=None) -> str:
+    """
+    Gets a stateless response from the Ollama API, served from the completion
+    cache when possible. The call is queued through the LLM scheduler under
+    `user_key`; scheduler errors are raised to the caller.
+    """
     if model is None:
         model = settings.OLLAMA_MODEL
-    
+
+    cache_key = make_key(model, '', [], message)
+    reply = get_cached_completion(cache_key, use_cache)
+    if reply is not None:
+        return reply
+
+    # Requests that opt out of the cache do not share another request's generation either.
+    scheduler_key = f'complete:{cache_key}' if use_cache else None
     try:
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            # Using /api/chat for better prompt handling with some models
-            response = await client.post(
-                f"{settings.OLLAMA_HOST}/api/chat",
-                json={
-                    "model": model,
-                    "messages": [{"role": "user", "content": message}],
-                    "stream": False
-                },
-            )
-            response.raise_for_status()
-            data = response.json()
-            return data.get('message', {}).get('content', '').strip()
-
-    except (httpx.RequestError, json.JSONDecodeError) as e:
+        reply = await get_scheduler().run(
+            model, user_key, scheduler_key, lambda: _ollama_chat(model, message), on_position
+        )
+        store_completion(cache_key, reply, use_cache)
+        return reply
+
+    except (httpx.RequestError, httpx.HTTPStatusError, json.JSONDecodeError) as e:
         logger.error(f"Error calling Ollama API: {e}")
         return "Sorry, I'm having trouble connecting to the AI service."
 
-# --- LangChain Integration ---
-
-def get_conversation_chain(session, model_name: str):
+async def stream_ollama_response(message: str, model: str = None, use_cache: bool = True,
+                                 user_key=None, on_position=None):
     """
-    Initializes a LangChain conversation chain, loading history from the session.
+    Streams a stateless response from the Ollama API, yielding content
+    chunks as soon as Ollama produces them. A cached completion is yielded
+    as a single chunk. The call is queued through the LLM scheduler under
+    `user_key`; scheduler errors are raised to the caller.
     """
-    llm = ChatOllama(model=model_name, base_url=settings.OLLAMA_HOST)
-    
-    session_key = f"chat_history_{model_name}"
-    
-    # Load history from session
-    history_dict = session.get(session_key, [])
-    history_messages = messages_from_dict(history_dict)
-
-    memory = ConversationBufferMemory(memory_key="history", return_messages=True)
-    # Manually load history into memory
-    memory.chat_memory.messages = history_messages
-
-    prompt = ChatPromptTemplate(
-        messages=[
-            SystemMessagePromptTemplate.from_template(
-                "You are a helpful and friendly AI assistant. Provide clear and concise answers."
-            ),
-            MessagesPlaceholder(variable_name="history"),
-            HumanMessagePromptTemplate.from_template("{input}")
-        ]
-    )
+    if model is None:
+        model = settings.OLLAMA_MODEL
+
+    cache_key = make_key(model, '', [], message)
+    reply = get_cached_completion(cache_key, use_cache)
+    if reply is not None:
+        yield reply
+        return
+
+    chunks = []
+    try:
+        async for chunk in get_scheduler().stream(
+            model, user_key, cache_key if use_cache else None, lambda: _ollama_chat_stream(model, message), on_position
+        ):
+            chunks.append(chunk)
+            yield chunk
+
+    except (httpx.RequestError, httpx.HTTPStatusError, json.JSONDecodeError) as e:
+        logger.error(f"Error streaming from Ollama API: {e}")
+        yield "Sorry, I'm having trouble connecting to the AI service."
+        return
 
-    # LLMChain is a good general-purpose chain.
-    chain = LLMChain(llm=llm, prompt=prompt, memory=memory, verbose=settings.DEBUG)
-    return chain
+    store_completion(cache_key, ''.join(chunks).strip(), use_cache)
 
-def save_conversation_history(session, model_name: str, chain):
+# --- LangChain Integration (loaded on demand, see chat/conversation.py) ---
+
+_conversation = None
+
+def _import_conversation():
+    global _conversation
+    _conversation = importlib.import_module('chat.conversation')
+    return _conversation
+
+async def aload_conversation():
     """
-    Saves the conversation history from the chain's memory into the session.
+    Returns the `chat.conversation` module, importing it (and LangChain) in a
+    worker thread the first time, so the event loop keeps serving meanwhile.
     """
-    session_key = f"chat_history_{model_name}"
-    history_messages = chain.memory.chat_memory.messages
-    session[session_key] = messages_to_dict(history_messages)
-
-def clear_conversation_history(session, model_name: str):
-    """Clears the conversation history for a given model from the session."""
-    session_key = f"chat_history_{model_name}"
-    if session_key in session:
-        del session[session_key]
\ No newline at end of file
+    if _conversation is not None:
+        return _conversation
+    return await asyncio.to_thread(_import_conversation)
+
+async def warm_langchain():
+    """ASGI startup hook that preloads LangChain in the background, if CHAT_LANGCHAIN_WARMUP is on."""
+    if settings.CHAT_LANGCHAIN_WARMUP and _conversation is None:
+        threading.Thread(target=_import_conversation, name='langchain-warmup', daemon=True).start()
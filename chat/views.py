@@ -5,12 +5,70 @@ from .models import Thread
 from django.db.models import Count
 from django.conf import settings
 import json
-from django.http import JsonResponse
-from .utils import get_ollama_models, get_ollama_response, get_conversation_chain, save_conversation_history, clear_conversation_history
+from django.http import JsonResponse, StreamingHttpResponse
+from .utils import (
+    get_ollama_models, is_available_model, get_ollama_response, stream_ollama_response,
+    aload_conversation,
+)
+from .scheduler import get_scheduler, SchedulerError
+from .archive import history_page
+from .inbox import inbox_page, mark_read
+from .search import search_messages
 from asgiref.sync import sync_to_async
 import logging
 
 logger = logging.getLogger(__name__)
+
+def ndjson_response(chunks, model, on_complete=None):
+    """
+    Wraps an async iterator of reply chunks in a streaming NDJSON response.
+
+    Each chunk is sent as `{"token": ...}` on its own line as soon as it is
+    produced, followed by a final `{"done": true, "reply": ..., "model": ...}`
+    line. `on_complete`, if given, is awaited with the full reply once the
+    stream has finished.
+    """
+    async def stream():
+        parts = []
+        try:
+            async for chunk in chunks:
+                parts.append(chunk)
+                yield json.dumps({'token': chunk}) + '\n'
+            reply = ''.join(parts)
+            if on_complete is not None:
+                await on_complete(reply)
+        except SchedulerError as e:
+            yield json.dumps({'error': e.message}) + '\n'
+            return
+        except Exception as e:
+            logger.error(f"Error while streaming reply: {e}", exc_info=True)
+            yield json.dumps({'error': 'An error occurred while processing your request.'}) + '\n'
+            return
+        yield json.dumps({'done': True, 'reply': reply, 'model': model}) + '\n'
+
+    response = StreamingHttpResponse(stream(), content_type='application/x-ndjson')
+    # Stop proxies from buffering the stream and defeating its purpose.
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+def wants_stream(request, data):
+    """
+    Checks whether a chat API client asked for an NDJSON stream, with
+    `"stream": true` or `Accept: application/x-ndjson`. Others get a single
+    JSON reply, as before streaming existed.
+    """
+    if 'stream' in data:
+        return bool(data['stream'])
+    return 'application/x-ndjson' in request.headers.get('Accept', '')
+
+def busy_response(error=None):
+    """The response for LLM requests the scheduler cannot take right now."""
+    message = error.message if error is not None else SchedulerError.message
+    response = JsonResponse({'error': message}, status=503)
+    response['Retry-After'] = '5'
+    return response
+
 @login_required
 def chat_room(request):
     return render(request, 'chat/room.html')
@@ -18,13 +76,31 @@ def chat_room(request):
 @login_required
 def users_list(request):
     """Lists users that can be chatted with."""
-    users = User.objects.exclude(username=request.user.username)
+    users = User.objects.filter(is_active=True).exclude(username=request.user.username)
     return render(request, 'chat/users.html', {'users': users})
 
+@login_required
+def inbox(request):
+    """Lists the user's private conversations, most recently active first."""
+    entries, next_cursor = inbox_page(request.user, before=request.GET.get('before'))
+    return render(request, 'chat/inbox.html', {'entries': entries, 'next_cursor': next_cursor})
+
+@login_required
+def message_search(request):
+    """Searches the user's private messages."""
+    query = request.GET.get('q', '').strip()
+    try:
+        before = int(request.GET['before'])
+    except (KeyError, ValueError):
+        before = None
+    results, next_cursor = search_messages(request.user, query, before=before) if query else ([], None)
+    context = {'query': query, 'results': results, 'next_cursor': next_cursor}
+    return render(request, 'chat/search.html', context)
+
 @login_required
 def private_chat_room(request, user_id):
     """A private chat room with a specific user."""
-    other_user = get_object_or_404(User, id=user_id)
+    other_user = get_object_or_404(User, id=user_id, is_active=True)
 
     # Find a thread that has exactly these two participants
     thread = Thread.objects.annotate(
@@ -39,10 +115,13 @@ def private_chat_room(request, user_id):
         thread = Thread.objects.create()
         thread.participants.add(request.user, other_user)
 
-    # Load past messages
-    messages = thread.messages.all()
+    # The newest page of past messages; older pages are loaded over the WebSocket.
+    messages, history_cursor = history_page(thread.id)
+    mark_read(request.user, thread.id)
 
-    return render(request, 'chat/private_room.html', {'other_user': other_user, 'messages': messages})
+    return render(request, 'chat/private_room.html', {
+        'other_user': other_user, 'messages': messages, 'history_cursor': history_cursor,
+    })
 
 def public_chatbot_view(request):
     """Renders the public AJAX-based chatbot page that does not require login."""
@@ -59,10 +138,23 @@ async def chat_api(request):
             data = json.loads(request.body)
             message = data.get('message')
             model = data.get('model', settings.OLLAMA_MODEL)
-            reply = await get_ollama_response(message, model)
+            if not await sync_to_async(is_available_model)(model):
+                return JsonResponse({'error': f'Unknown model: {model}'}, status=400)
+            use_cache = data.get('cache', True)
+            # Anonymous users are queued fairly by client address.
+            user = await request.auser()
+            user_key = user.id if user.is_authenticated else request.META.get('REMOTE_ADDR')
+            # Reject over-capacity requests before the response starts streaming.
+            if not get_scheduler().has_capacity(model, user_key):
+                return busy_response()
+            if wants_stream(request, data):
+                return ndjson_response(stream_ollama_response(message, model, use_cache, user_key), model)
+            reply = await get_ollama_response(message, model, use_cache, user_key)
             return JsonResponse({'reply': reply, 'model': model})
         except json.JSONDecodeError:
             return JsonResponse({'error': 'Invalid JSON'}, status=400)
+        except SchedulerError as e:
+            return busy_response(e)
     return JsonResponse({'error': 'Invalid request method'}, status=405)
 
 @login_required
@@ -84,13 +176,17 @@ async def ai_chat_api(request):
         data = json.loads(request.body)
         model = data.get('model', settings.OLLAMA_MODEL)
         action = data.get('action')
+        use_cache = data.get('cache', True)
 
     except json.JSONDecodeError:
         return JsonResponse({'error': 'Invalid JSON'}, status=400)
 
+    user = await request.auser()
+    conversation = await aload_conversation()
+
     # Handle clearing history
     if action == 'clear':
-        await sync_to_async(clear_conversation_history)(request.session, model)
+        await conversation.aclear_conversation_history(user, model)
         return JsonResponse({'status': 'history cleared'})
 
     # Handle sending a message
@@ -98,17 +194,32 @@ async def ai_chat_api(request):
     if not message:
         return JsonResponse({'error': 'Message cannot be empty'}, status=400)
 
+    if not await sync_to_async(is_available_model)(model):
+        return JsonResponse({'error': f'Unknown model: {model}'}, status=400)
+
+    # Reject over-capacity requests before the response starts streaming.
+    if not get_scheduler().has_capacity(model, user.id):
+        return busy_response()
+
     try:
-        # Get chain with history from session
-        chain = await sync_to_async(get_conversation_chain)(request.session, model)
-        
-        # Run the prediction (blocking I/O) in a separate thread
-        response = await sync_to_async(chain.predict)(input=message)
+        # Get chain with the user's conversation memory
+        chain = await conversation.aget_conversation_chain(user, model)
+        reply_stream = conversation.stream_conversation(chain, message, use_cache, user_key=user.id)
+
+        if wants_stream(request, data):
+            async def save_history(reply):
+                await conversation.asave_conversation_history(chain)
+
+            return ndjson_response(reply_stream, model, on_complete=save_history)
+
+        response = ''.join([chunk async for chunk in reply_stream])
 
-        # Save the updated history back to the session
-        await sync_to_async(save_conversation_history)(request.session, model, chain)
+        # Append the new turns to the stored conversation
+        await conversation.asave_conversation_history(chain)
 
         return JsonResponse({'reply': response, 'model': model})
+    except SchedulerError as e:
+        return busy_response(e)
     except Exception as e:
         logger.error(f"Error in AI chat API: {e}", exc_info=True)
         return JsonResponse({'error': 'An error occurred while processing your request.'}, status=500)
\ No newline at end of file
@@ -0,0 +1,142 @@
+"""
+Live media activity: new likes, comments and public uploads pushed to the
+pages showing them (see `media.consumers.MediaActivityConsumer`).
+
+Views record activity with `publish_like`, `publish_comment` and
+`publish_upload`. Events are not broadcast one by one: they are collected
+per group and flushed at most once every `settings.MEDIA_ACTIVITY_INTERVAL`
+seconds as one batch, e.g. "+37 likes" with the newest few comments, so a
+hot item costs one fan-out per interval however busy it is.
+
+The batcher lives on the server's event loop; the sync views hand events to
+it through `async_to_sync`. Without an ASGI server's loop (under WSGI, in
+management commands and tests) nothing would be left to flush a batch
+later, so each event is sent on its own, at once.
+"""
+import asyncio
+import logging
+import os
+import weakref
+
+from asgiref.sync import SyncToAsync, async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+from django.urls import reverse
+
+from chat.codec import group_event
+
+logger = logging.getLogger(__name__)
+
+FEED_GROUP = 'media_feed'
+
+def media_group(media_id) -> str:
+    return f'media_{media_id}'
+
+class ActivityBatcher:
+    """Collects activity per group and sends each group one batch per interval."""
+
+    def __init__(self, interval: float, max_items: int):
+        self.interval = interval
+        self.max_items = max_items
+        self.pending = {}
+        self._flush_task = None
+
+    def _batch(self, group):
+        batch = self.pending.get(group)
+        if batch is None:
+            batch = self.pending[group] = {
+                'type': 'media_activity', 'likes': 0, 'comment_count': 0, 'comments': [],
+                'upload_count': 0, 'uploads': [],
+            }
+        if self._flush_task is None:
+            self._flush_task = asyncio.ensure_future(self._flush_later())
+        return batch
+
+    def add_like(self, group, delta):
+        self._batch(group)['likes'] += delta
+
+    def _add_item(self, batch, key, count_key, item):
+        batch[count_key] += 1
+        # Keep only the newest `max_items`; the count says how many there were.
+        batch[key].append(item)
+        del batch[key][:-self.max_items]
+
+    def add_comment(self, group, comment):
+        self._add_item(self._batch(group), 'comments', 'comment_count', comment)
+
+    def add_upload(self, group, upload):
+        self._add_item(self._batch(group), 'uploads', 'upload_count', upload)
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.interval)
+        await self.flush()
+
+    async def flush(self):
+        pending, self.pending = self.pending, {}
+        self._flush_task = None
+        channel_layer = get_channel_layer()
+        for group, batch in pending.items():
+            if not (batch['likes'] or batch['comment_count'] or batch['upload_count']):
+                continue
+            try:
+                await channel_layer.group_send(group, group_event('media_activity', batch))
+            except Exception as e:
+                logger.warning(f"Could not send media activity to {group}: {e}")
+
+_batchers = weakref.WeakKeyDictionary()
+
+def get_batcher() -> ActivityBatcher:
+    """Returns the batcher for the running event loop."""
+    loop = asyncio.get_running_loop()
+    batcher = _batchers.get(loop)
+    if batcher is None:
+        batcher = _batchers[loop] = ActivityBatcher(
+            settings.MEDIA_ACTIVITY_INTERVAL, settings.MEDIA_ACTIVITY_MAX_ITEMS
+        )
+    return batcher
+
+async def _record(method, *args):
+    getattr(get_batcher(), method)(*args)
+
+async def _send_now(method, *args):
+    batcher = ActivityBatcher(0, settings.MEDIA_ACTIVITY_MAX_ITEMS)
+    getattr(batcher, method)(*args)
+    # With no interval, the flush runs at once.
+    await batcher._flush_task
+
+def _in_server_thread() -> bool:
+    """Checks whether this sync code was called from an event loop that outlives it."""
+    # Set by `sync_to_async`, as ASGI servers run sync views; `async_to_sync` looks for the same.
+    threadlocal = SyncToAsync.threadlocal
+    return getattr(threadlocal, 'main_event_loop_pid', None) == os.getpid() and threadlocal.main_event_loop.is_running()
+
+def _dispatch(method, *args):
+    async_to_sync(_record if _in_server_thread() else _send_now)(method, *args)
+
+def _publish(method, *args):
+    # Only announce what was actually committed.
+    transaction.on_commit(lambda: _dispatch(method, *args))
+
+def publish_like(media, delta: int):
+    """Records a like (`delta=1`) or an unlike (`delta=-1`) of `media`."""
+    _publish('add_like', media_group(media.pk), delta)
+
+def publish_comment(comment):
+    _publish('add_comment', media_group(comment.media_id), {
+        'author': comment.author.username,
+        'text': comment.text,
+        'created_at': comment.created_at.isoformat(),
+    })
+
+def publish_upload(media):
+    """Announces a public upload on the feed."""
+    _publish('add_upload', FEED_GROUP, {
+        'id': media.pk,
+        'title': media.title,
+        'owner': media.owner.username,
+        'url': reverse('media_detail', args=[media.pk]),
+        'file_url': media.file.url,
+        'is_image': media.is_image,
+        'categories': [category.slug for category in media.categories.all()],
+    })
@@ -1,15 +1,76 @@
 from django.contrib import admin
-from .models import Media, Comment, Like, Category
+from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
+from django.contrib.auth.models import User
+from chat.models import Message
+from .deletion import mark_media_deleted, mark_users_deleted
+from .models import Media, Comment, Like, Category, PendingDeletion, StorageUsage
+from .related import request_refresh
 
 @admin.register(Category)
 class CategoryAdmin(admin.ModelAdmin):
     list_display = ('name', 'slug')
     prepopulated_fields = {'slug': ('name',)}
 
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        if not change or 'name' in form.changed_data:
+            # Imported here: the retrieval index loads numpy.
+            from chat.retrieval import index_category
+            index_category(obj)
+
 @admin.register(Media)
 class MediaAdmin(admin.ModelAdmin):
     list_display = ('title', 'owner', 'uploaded_at', 'is_public')
     list_filter = ('is_public', 'owner', 'categories')
 
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        # Categories are saved here, after the item itself.
+        request_refresh(form.instance)
+
+    def delete_model(self, request, obj):
+        mark_media_deleted([obj])
+
+    def delete_queryset(self, request, queryset):
+        mark_media_deleted(queryset)
+
 admin.site.register(Comment)
-admin.site.register(Like)
\ No newline at end of file
+admin.site.register(Like)
+
+@admin.register(StorageUsage)
+class StorageUsageAdmin(admin.ModelAdmin):
+    list_display = ('user', 'bytes', 'image_count', 'video_count', 'quota_bytes')
+    # Totals are maintained by media/quota.py; only the quota is edited here.
+    readonly_fields = ('user', 'bytes', 'image_count', 'video_count')
+
+admin.site.unregister(User)
+
+@admin.register(User)
+class UserAdmin(BaseUserAdmin):
+    """
+    Deletes users in the background (see media/deletion.py). The delete
+    confirmation page shows counts instead of every cascaded row, which for
+    an active user would take as long as the deletion itself.
+    """
+
+    def get_queryset(self, request):
+        pending = PendingDeletion.objects.filter(kind=PendingDeletion.USER).values('object_id')
+        return super().get_queryset(request).exclude(pk__in=pending)
+
+    def get_deleted_objects(self, objs, request):
+        users = list(objs)
+        model_count = {
+            'users': len(users),
+            'media items': Media.all_objects.filter(owner__in=users).count(),
+            'comments': Comment.objects.filter(author__in=users).count(),
+            'likes': Like.objects.filter(user__in=users).count(),
+            'private messages': Message.objects.filter(sender__in=users).count(),
+        }
+        perms_needed = set() if self.has_delete_permission(request) else {'user'}
+        return [str(user) for user in users], model_count, perms_needed, []
+
+    def delete_model(self, request, obj):
+        mark_users_deleted([obj])
+
+    def delete_queryset(self, request, queryset):
+        mark_users_deleted(queryset)
@@ -0,0 +1,40 @@
+from channels.generic.websocket import AsyncWebsocketConsumer
+
+from media_sharing_project.metrics import ConsumerMetricsMixin
+
+from .activity import FEED_GROUP, media_group
+from .models import Media
+
+class MediaActivityConsumer(ConsumerMetricsMixin, AsyncWebsocketConsumer):
+    """
+    Pushes batched activity to clients viewing a media item (new likes and
+    comments) or the public feed (new public uploads). Frames are
+    `media_activity` batches, already encoded by `media.activity`.
+    """
+
+    async def connect(self):
+        media_id = self.scope['url_route']['kwargs'].get('pk')
+        if media_id is None:
+            self.group_name = FEED_GROUP
+        else:
+            user = self.scope['user']
+            media_item = await Media.objects.filter(pk=media_id).only('is_public', 'owner_id').afirst()
+            # Private items are only visible to their owner.
+            if media_item is None or not (media_item.is_public or media_item.owner_id == user.id):
+                await self.close()
+                return
+            self.group_name = media_group(media_id)
+
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        await self.accept()
+
+    async def disconnect(self, close_code):
+        if hasattr(self, 'group_name'):
+            await self.channel_layer.group_discard(self.group_name, self.channel_name)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        # This stream is server-to-client only.
+        pass
+
+    async def media_activity(self, event):
+        await self.send(text_data=event['frame'])
@@ -0,0 +1,176 @@
+"""
+Deleting users and media items without long locks.
+
+Deleting a user the usual way cascades through their uploads, comments,
+likes, messages and conversations in one transaction, and deletes their
+files one by one before the request returns. Instead, deletion takes two
+steps:
+
+1. `mark_users_deleted` and `mark_media_deleted` hide everything at once,
+   in one short transaction. Users are deactivated, which logs them out
+   and hides their comments, likes and conversations. Their media items,
+   and deleted media items, get `deleted_at`, which `Media.objects` hides.
+   A `PendingDeletion` row records the remaining work.
+2. `purge_pending` removes the rows, child tables first, in transactions of
+   at most DELETION_BATCH_SIZE rows each. It deletes the files of each
+   batch of media items, DELETION_FILE_WORKERS at a time, before their
+   rows, so no file is left behind. It runs in a background thread once
+   the marking has committed. `manage.py purge_deletions` finishes
+   anything left over, e.g. after a restart.
+"""
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connections, transaction
+from django.utils import timezone
+
+from chat.models import ArchivedMessage, Conversation, ConversationTurn, InboxEntry, Message, Thread
+from media_sharing_project.db_router import use_primary
+from .models import Comment, Like, Media, PendingDeletion, RelatedMedia, RelatedMediaRefresh
+from .quota import release
+
+logger = logging.getLogger(__name__)
+
+_purge_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='deletion')
+_purge_lock = threading.Lock()
+_purge_queued = False
+
+def _pks(objects):
+    return [obj.pk for obj in objects]
+
+def mark_media_deleted(media_items):
+    """Hides `media_items` now and removes them in the background."""
+    ids = _pks(media_items)
+    with transaction.atomic():
+        marked = Media.all_objects.filter(pk__in=ids, deleted_at__isnull=True)
+        # Deleted items stop counting towards their owner's quota at once.
+        release(marked.values_list('owner_id', 'file_size', 'file'))
+        marked.update(deleted_at=timezone.now())
+        PendingDeletion.objects.bulk_create(
+            [PendingDeletion(kind=PendingDeletion.MEDIA, object_id=pk) for pk in ids], ignore_conflicts=True,
+        )
+        transaction.on_commit(schedule_purge)
+
+def mark_users_deleted(users):
+    """Deactivates `users`, hides their content now and removes it in the background."""
+    ids = _pks(users)
+    with transaction.atomic():
+        User.objects.filter(pk__in=ids).update(is_active=False)
+        Media.all_objects.filter(owner_id__in=ids, deleted_at__isnull=True).update(deleted_at=timezone.now())
+        PendingDeletion.objects.bulk_create(
+            [PendingDeletion(kind=PendingDeletion.USER, object_id=pk) for pk in ids], ignore_conflicts=True,
+        )
+        transaction.on_commit(schedule_purge)
+
+def schedule_purge():
+    """Runs `purge_pending` in the background thread, unless a run is already queued."""
+    global _purge_queued
+    with _purge_lock:
+        if _purge_queued:
+            return
+        _purge_queued = True
+    _purge_executor.submit(_run_purge)
+
+def _run_purge():
+    global _purge_queued
+    with _purge_lock:
+        # Deletions marked from now on need another run.
+        _purge_queued = False
+    try:
+        purge_pending()
+    except Exception as e:
+        logger.error(f"Purging deleted content failed: {e}", exc_info=True)
+    finally:
+        connections.close_all()
+
+def _delete_in_batches(queryset, batch_size):
+    model = queryset.model
+    deleted = 0
+    while True:
+        ids = list(queryset.values_list('pk', flat=True)[:batch_size])
+        if not ids:
+            return deleted
+        with transaction.atomic():
+            deleted += model._base_manager.filter(pk__in=ids).delete()[0]
+
+def _delete_file(storage, name):
+    try:
+        storage.delete(name)
+    except Exception as e:
+        logger.warning(f"Could not delete media file {name}: {e}")
+
+def _delete_files(names):
+    storage = Media._meta.get_field('file').storage
+    with ThreadPoolExecutor(max_workers=settings.DELETION_FILE_WORKERS) as pool:
+        list(pool.map(lambda name: _delete_file(storage, name), names))
+
+def _purge_media(media, batch_size):
+    """Removes the media items of the `media` queryset, with their files and dependent rows."""
+    while True:
+        batch = list(media.values_list('pk', 'file')[:batch_size])
+        if not batch:
+            return
+        ids = [pk for pk, _ in batch]
+        _delete_files([name for _, name in batch if name])
+        for dependents in (
+            Comment.objects.filter(media_id__in=ids),
+            Like.objects.filter(media_id__in=ids),
+            RelatedMedia.objects.filter(media_id__in=ids),
+            RelatedMedia.objects.filter(related_id__in=ids),
+            RelatedMediaRefresh.objects.filter(media_id__in=ids),
+            Media.categories.through.objects.filter(media_id__in=ids),
+        ):
+            _delete_in_batches(dependents, batch_size)
+        with transaction.atomic():
+            Media.all_objects.filter(pk__in=ids).delete()
+
+def _purge_user(user_id, batch_size):
+    _purge_media(Media.all_objects.filter(owner_id=user_id), batch_size)
+    for rows in (
+        Comment.objects.filter(author_id=user_id),
+        Like.objects.filter(user_id=user_id),
+        InboxEntry.objects.filter(user_id=user_id),
+        InboxEntry.objects.filter(other_user_id=user_id),
+        Message.objects.filter(sender_id=user_id),
+        ArchivedMessage.objects.filter(sender_id=user_id),
+        Thread.participants.through.objects.filter(user_id=user_id),
+        ConversationTurn.objects.filter(conversation__user_id=user_id),
+        Conversation.objects.filter(user_id=user_id),
+    ):
+        _delete_in_batches(rows, batch_size)
+    # Only a few rows are left to cascade to.
+    with transaction.atomic():
+        User.objects.filter(pk=user_id).delete()
+
+def purge_pending(batch_size=None) -> int:
+    """
+    Removes everything marked deleted, oldest first. Returns the number of
+    users and media items removed. Failures are logged and retried on the
+    next run. Reads the rows to delete from the primary, even if called
+    from a request: a replica may still show rows already purged.
+    """
+    with use_primary():
+        return _purge_pending(batch_size or settings.DELETION_BATCH_SIZE)
+
+def _purge_pending(batch_size):
+    purged = 0
+    failed = []
+    while True:
+        pending = list(PendingDeletion.objects.exclude(pk__in=failed).order_by('pk')[:100])
+        if not pending:
+            return purged
+        for entry in pending:
+            try:
+                if entry.kind == PendingDeletion.USER:
+                    _purge_user(entry.object_id, batch_size)
+                else:
+                    _purge_media(Media.all_objects.filter(pk=entry.object_id), batch_size)
+            except Exception as e:
+                logger.error(f"Could not purge {entry.kind} {entry.object_id}: {e}", exc_info=True)
+                failed.append(entry.pk)
+                continue
+            entry.delete()
+            purged += 1
@@ -0,0 +1,483 @@
+"""
+"Download my data": a ZIP archive of everything a user has put on the site,
+streamed while it is built.
+
+The archive holds the user's uploads under `media/` and their media items,
+comments, likes, chat threads and private messages as JSON documents.
+Nothing is assembled in memory or on disk: files are read in
+`DATA_EXPORT_CHUNK_SIZE` blocks, rows are read with
+`iterator(chunk_size=DATA_EXPORT_QUERY_CHUNK_SIZE)` (server-side cursors on
+databases that have them) and the central directory is spooled to a
+temporary file, so memory use does not grow with the size of the export.
+
+Entries are stored uncompressed (uploads are compressed already) in ZIP64
+format, in a fixed order and with fixed timestamps, so the same data always
+produces the same bytes. That makes the archive size computable up front,
+from one pass over the rows and a stat of each file, and downloads
+resumable with HTTP range requests.
+
+The layout found by that pass (each entry's name, size and CRC; the CRCs of
+uploads are filled in as they are streamed) is cached under the ETag for
+`DATA_EXPORT_LAYOUT_TIMEOUT` seconds. A resume that finds it skips the pass
+and seeks: entries that end before the requested offset only add their
+central directory record, and the rest are regenerated and checked against
+the layout. If one no longer matches, the download is aborted and the layout
+dropped, so the client's next attempt starts over.
+
+Every query reads only rows up to a snapshot of the newest row ids, taken
+when the export is first measured, so uploads, comments or messages added
+while it streams cannot make it longer than its Content-Length. The ETag
+holds the snapshot and a digest of the exported data: a resume sending it
+in `If-Range` rebuilds the archive from the same snapshot, so it carries on
+even if rows were added since. Without a cached layout, the resume measures
+the archive again and starts over if any rows were changed or deleted.
+"""
+import hashlib
+import json
+import os
+import struct
+import tempfile
+import zlib
+from datetime import datetime, timezone
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.core.handlers.asgi import ASGIRequest
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Max
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.http import content_disposition_header
+
+from chat.models import ArchivedMessage, Message, Thread
+from .models import Comment, Like, Media
+
+# ZIP record signatures and sizes (see PKWARE's APPNOTE.TXT).
+LOCAL_HEADER = 0x04034b50
+DATA_DESCRIPTOR = 0x08074b50
+CENTRAL_HEADER = 0x02014b50
+ZIP64_END = 0x06064b50
+ZIP64_LOCATOR = 0x07064b50
+END_OF_DIRECTORY = 0x06054b50
+# Sizes come in a data descriptor after the data; names are UTF-8.
+FLAGS = 0x0008 | 0x0800
+VERSION = 45
+# Made by Unix, so the permissions below are honoured.
+VERSION_MADE_BY = (3 << 8) | VERSION
+FILE_ATTRIBUTES = 0o100644 << 16
+LOCAL_OVERHEAD = 30 + 20 + 24
+CENTRAL_OVERHEAD = 46 + 28
+END_SIZE = 56 + 20 + 22
+# The earliest date a ZIP entry can carry.
+DOS_EPOCH = datetime(1980, 1, 1, tzinfo=timezone.utc)
+
+# Snapshot key -> the tables whose newest id it records; the order of the
+# ids in the ETag.
+SNAPSHOT_TABLES = {
+    'media': (Media,),
+    'comments': (Comment,),
+    'likes': (Like,),
+    'threads': (Thread,),
+    # Archived messages keep their ids.
+    'messages': (Message, ArchivedMessage),
+}
+
+def take_snapshot() -> dict:
+    """Returns the newest row id of every exported table."""
+    return {
+        key: max(model._base_manager.aggregate(newest=Max('pk'))['newest'] or 0 for model in models)
+        for key, models in SNAPSHOT_TABLES.items()
+    }
+
+def parse_etag(etag: str):
+    """Returns the snapshot recorded in an export's ETag, or None if it is not one."""
+    _, *ids = etag.strip('"').split('-')
+    if len(ids) != len(SNAPSHOT_TABLES) or not all(value.isdigit() for value in ids):
+        return None
+    return dict(zip(SNAPSHOT_TABLES, map(int, ids)))
+
+def _dos_datetime(moment):
+    moment = max(moment, DOS_EPOCH).astimezone(timezone.utc)
+    return (
+        (moment.hour << 11) | (moment.minute << 5) | (moment.second // 2),
+        ((moment.year - 1980) << 9) | (moment.month << 5) | moment.day,
+    )
+
+def entry_size(name: bytes, size: int) -> int:
+    """Bytes taken by an entry with this name and data size, including its central directory record."""
+    return LOCAL_OVERHEAD + CENTRAL_OVERHEAD + 2 * len(name) + size
+
+class ExportChanged(Exception):
+    """The exported data no longer matches the layout the download started with."""
+
+class ZipStream:
+    """
+    Writes a ZIP64 archive of stored (uncompressed) entries as a stream of
+    byte blocks. Central directory records are spooled to a temporary file
+    until the end.
+    """
+
+    def __init__(self):
+        self.offset = 0
+        self.count = 0
+        self.directory = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+
+    def entry(self, name: str, modified, blocks):
+        """
+        Yields the bytes of one entry whose data is the iterable of byte
+        blocks `blocks`; returns its `(size, crc)`.
+        """
+        name = name.encode('utf-8')
+        header_offset = self.offset
+        dos_time, dos_date = _dos_datetime(modified)
+        header = struct.pack(
+            '<IHHHHHIIIHH', LOCAL_HEADER, VERSION, FLAGS, 0, dos_time, dos_date,
+            0, 0xFFFFFFFF, 0xFFFFFFFF, len(name), 20,
+        )
+        yield self._emit(header + name + struct.pack('<HHQQ', 1, 16, 0, 0))
+
+        crc = 0
+        size = 0
+        for block in blocks:
+            crc = zlib.crc32(block, crc)
+            size += len(block)
+            yield self._emit(block)
+        yield self._emit(struct.pack('<IIQQ', DATA_DESCRIPTOR, crc, size, size))
+        self._record(name, dos_time, dos_date, crc, size, header_offset)
+        return size, crc
+
+    def skip(self, name: str, modified, size: int, crc: int):
+        """Accounts for an entry that is not sent, adding only its central directory record."""
+        name = name.encode('utf-8')
+        header_offset = self.offset
+        self.offset += LOCAL_OVERHEAD + len(name) + size
+        self._record(name, *_dos_datetime(modified), crc, size, header_offset)
+
+    def _record(self, name, dos_time, dos_date, crc, size, header_offset):
+        self.directory.write(struct.pack(
+            '<IHHHHHHIIIHHHHHII', CENTRAL_HEADER, VERSION_MADE_BY, VERSION, FLAGS, 0, dos_time, dos_date,
+            crc, 0xFFFFFFFF, 0xFFFFFFFF, len(name), 28, 0, 0, 0, FILE_ATTRIBUTES, 0xFFFFFFFF,
+        ) + name + struct.pack('<HHQQQ', 1, 24, size, size, header_offset))
+        self.count += 1
+
+    def finish(self):
+        """Yields the central directory and the end records."""
+        directory_offset = self.offset
+        self.directory.seek(0)
+        while block := self.directory.read(settings.DATA_EXPORT_CHUNK_SIZE):
+            yield self._emit(block)
+        self.directory.close()
+        directory_size = self.offset - directory_offset
+        end_offset = self.offset
+        yield self._emit(struct.pack(
+            '<IQHHIIQQQQ', ZIP64_END, 44, VERSION_MADE_BY, VERSION, 0, 0,
+            self.count, self.count, directory_size, directory_offset,
+        ))
+        yield self._emit(struct.pack('<IIQI', ZIP64_LOCATOR, 0, end_offset, 1))
+        yield self._emit(struct.pack(
+            '<IHHHHIIH', END_OF_DIRECTORY, 0, 0, 0xFFFF, 0xFFFF, 0xFFFFFFFF, 0xFFFFFFFF, 0,
+        ))
+
+    def _emit(self, data):
+        self.offset += len(data)
+        return data
+
+def _json_document(rows):
+    """Encodes `rows` (an iterable of dicts) as a JSON array, one row per line."""
+    yield b'['
+    separator = b'\n'
+    for row in rows:
+        yield separator + json.dumps(row, cls=DjangoJSONEncoder, ensure_ascii=False).encode('utf-8')
+        separator = b',\n'
+    yield b'\n]\n'
+
+def _read_file(media):
+    with media.file.storage.open(media.file.name, 'rb') as f:
+        while block := f.read(settings.DATA_EXPORT_CHUNK_SIZE):
+            yield block
+
+def _coalesce(pieces, size):
+    """Joins small byte strings into blocks of about `size` bytes."""
+    buffer = bytearray()
+    for piece in pieces:
+        buffer += piece
+        if len(buffer) >= size:
+            yield bytes(buffer)
+            buffer.clear()
+    if buffer:
+        yield bytes(buffer)
+
+class DataExport:
+    """The archive of one user's data, up to `snapshot` (by default, now)."""
+
+    def __init__(self, user, snapshot=None):
+        self.user = user
+        self.snapshot = snapshot
+        self._size = None
+        self._etag = None
+        # [name, data size, CRC or None] of every entry, in archive order.
+        self._layout = None
+
+    @classmethod
+    def cached(cls, user, etag):
+        """Returns the export of `user` measured earlier with `etag`, or None if its layout is not cached."""
+        snapshot = parse_etag(etag)
+        layout = cache.get(_layout_key(user, etag)) if snapshot else None
+        if layout is None:
+            return None
+        export = cls(user, snapshot)
+        export._etag = etag
+        export._layout = layout
+        export._size = END_SIZE + sum(entry_size(name.encode('utf-8'), size) for name, size, _ in layout)
+        return export
+
+    def _save_layout(self):
+        cache.set(_layout_key(self.user, self._etag), self._layout, settings.DATA_EXPORT_LAYOUT_TIMEOUT)
+
+    def _iterate(self, queryset):
+        return queryset.iterator(chunk_size=settings.DATA_EXPORT_QUERY_CHUNK_SIZE)
+
+    def _media(self):
+        return self._iterate(
+            Media.objects.filter(owner=self.user, pk__lte=self.snapshot['media'])
+            .prefetch_related('categories').order_by('pk')
+        )
+
+    @staticmethod
+    def archive_name(media) -> str:
+        return f'media/{media.pk}-{os.path.basename(media.file.name)}'
+
+    def _media_rows(self):
+        for media in self._media():
+            yield {
+                'id': media.pk,
+                'title': media.title,
+                'file': self.archive_name(media),
+                'is_public': media.is_public,
+                'uploaded_at': media.uploaded_at,
+                'categories': [category.name for category in media.categories.all()],
+            }
+
+    def _comment_rows(self):
+        comments = Comment.objects.filter(
+            author=self.user, pk__lte=self.snapshot['comments'],
+        ).order_by('pk').values_list('id', 'media_id', 'media__title', 'text', 'created_at')
+        for comment_id, media_id, media_title, text, created_at in self._iterate(comments):
+            yield {'id': comment_id, 'media': media_id, 'media_title': media_title, 'text': text, 'created_at': created_at}
+
+    def _like_rows(self):
+        likes = Like.objects.filter(user=self.user, pk__lte=self.snapshot['likes']).order_by('pk').values_list(
+            'media_id', 'media__title',
+        )
+        for media_id, media_title in self._iterate(likes):
+            yield {'media': media_id, 'media_title': media_title}
+
+    def _thread_rows(self):
+        threads = (
+            Thread.objects.filter(participants=self.user, pk__lte=self.snapshot['threads'])
+            .prefetch_related('participants').order_by('pk')
+        )
+        for thread in self._iterate(threads):
+            yield {
+                'id': thread.pk,
+                'participants': sorted(user.username for user in thread.participants.all()),
+                'created_at': thread.created_at,
+            }
+
+    def _message_rows(self):
+        # Archived messages are all older than recent ones (see chat/archive.py).
+        for model in (ArchivedMessage, Message):
+            messages = model.objects.filter(
+                thread__participants=self.user, pk__lte=self.snapshot['messages'],
+            ).order_by('pk').values_list(
+                'id', 'thread_id', 'sender__username', 'text', 'created_at',
+            )
+            for message_id, thread_id, sender, text, created_at in self._iterate(messages):
+                yield {'id': message_id, 'thread': thread_id, 'sender': sender, 'text': text, 'created_at': created_at}
+
+    def entries(self):
+        """
+        Yields `(name, modified, file, blocks)` for every entry, in archive
+        order: `file` is the `Media` whose upload is the entry (its data is
+        read lazily from `blocks`), or None for a JSON document.
+        """
+        documents = [
+            ('media.json', self._media_rows),
+            ('comments.json', self._comment_rows),
+            ('likes.json', self._like_rows),
+            ('threads.json', self._thread_rows),
+            ('messages.json', self._message_rows),
+        ]
+        for name, rows in documents:
+            yield name, DOS_EPOCH, None, _json_document(rows())
+        for media in self._media():
+            if media.file.storage.exists(media.file.name):
+                yield self.archive_name(media), media.uploaded_at, media, _read_file(media)
+
+    def _measure(self):
+        # One pass over everything but the files' contents.
+        if self.snapshot is None:
+            self.snapshot = take_snapshot()
+        digest = hashlib.sha256()
+        size = END_SIZE
+        layout = []
+        for name, _, media, blocks in self.entries():
+            if media is not None:
+                data_size = media.file.storage.size(media.file.name)
+                crc = None
+                digest.update(f'{name}\0{data_size}\0'.encode('utf-8'))
+            else:
+                data_size = crc = 0
+                digest.update(f'{name}\0'.encode('utf-8'))
+                for block in blocks:
+                    data_size += len(block)
+                    crc = zlib.crc32(block, crc)
+                    digest.update(block)
+            size += entry_size(name.encode('utf-8'), data_size)
+            layout.append([name, data_size, crc])
+        self._size = size
+        self._layout = layout
+        ids = '-'.join(str(self.snapshot[key]) for key in SNAPSHOT_TABLES)
+        self._etag = f'"{digest.hexdigest()[:32]}-{ids}"'
+        self._save_layout()
+
+    @property
+    def size(self) -> int:
+        if self._size is None:
+            self._measure()
+        return self._size
+
+    @property
+    def etag(self) -> str:
+        if self._etag is None:
+            self._measure()
+        return self._etag
+
+    def stream(self, start=0, end=None):
+        """
+        Yields the archive's bytes from offset `start` through `end`
+        (inclusive), in blocks. Raises `ExportChanged` if the data no longer
+        matches the measured layout.
+        """
+        # Measuring first also takes the snapshot both passes read up to.
+        size = self.size
+        stop = size if end is None else end + 1
+        zip_stream = ZipStream()
+        learned = False
+
+        def archive():
+            nonlocal learned
+            entries = iter(self._layout)
+            for name, modified, _, blocks in self.entries():
+                expected = next(entries, None)
+                if expected is None or expected[0] != name:
+                    raise ExportChanged(f"{name} is not the next entry of the export")
+                _, data_size, crc = expected
+                local_end = zip_stream.offset + LOCAL_OVERHEAD + len(name.encode('utf-8')) + data_size
+                if crc is not None and local_end <= start:
+                    zip_stream.skip(name, modified, data_size, crc)
+                    continue
+                written = yield from zip_stream.entry(name, modified, blocks)
+                if written[0] != data_size or crc not in (None, written[1]):
+                    raise ExportChanged(f"{name} changed since the export was measured")
+                if crc is None:
+                    expected[2] = written[1]
+                    learned = True
+            yield from zip_stream.finish()
+
+        def pieces():
+            for block in archive():
+                block_end = zip_stream.offset
+                block_start = block_end - len(block)
+                if block_end > start:
+                    yield block[max(0, start - block_start):stop - block_start]
+                if block_end >= stop:
+                    return
+
+        try:
+            yield from _coalesce(pieces(), settings.DATA_EXPORT_CHUNK_SIZE)
+        except ExportChanged:
+            cache.delete(_layout_key(self.user, self._etag))
+            raise
+        finally:
+            # Also when the client goes away: a resume can then skip the uploads it has.
+            if learned:
+                self._save_layout()
+
+def _layout_key(user, etag):
+    etag = etag.strip('"')
+    return f'data-export:{user.pk}:{etag}'
+
+def parse_range(header: str, size: int):
+    """
+    Returns `(start, end)` for a single `bytes=` range, None to serve the
+    whole archive (no range, or one this does not handle), or False if the
+    range cannot be satisfied.
+    """
+    unit, _, spec = header.partition('=')
+    if unit.strip() != 'bytes' or ',' in spec:
+        return None
+    first, _, last = spec.strip().partition('-')
+    try:
+        if not first:
+            # The last `last` bytes.
+            length = int(last)
+            if length <= 0:
+                return False
+            return max(0, size - length), size - 1
+        start = int(first)
+        end = int(last) if last else size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        return False
+    return start, min(end, size - 1)
+
+async def _aiterate(blocks):
+    # Steps the sync generator in the request's thread, where its database cursors live.
+    step = sync_to_async(next, thread_sensitive=True)
+    done = object()
+    try:
+        while (block := await step(blocks, done)) is not done:
+            yield block
+    finally:
+        await sync_to_async(blocks.close, thread_sensitive=True)()
+
+def export_response(request, user):
+    """
+    Serves `user`'s archive: 200 with the whole archive, 206 for a
+    satisfiable `Range` (when `If-Range`, if sent, still matches), 416 for
+    an unsatisfiable one.
+    """
+    if_range = request.headers.get('If-Range')
+    if if_range and 'Range' in request.headers:
+        # A resume rebuilds the archive it started from.
+        export = DataExport.cached(user, if_range) or DataExport(user, parse_etag(if_range))
+    else:
+        export = DataExport(user)
+    size, etag = export.size, export.etag
+    byte_range = None
+    if 'Range' in request.headers and (if_range or etag) == etag:
+        byte_range = parse_range(request.headers['Range'], size)
+    if byte_range is False:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+        return response
+
+    start, end = byte_range or (0, size - 1)
+    if request.method == 'HEAD':
+        response = HttpResponse(status=206 if byte_range else 200)
+    else:
+        blocks = export.stream(start, end)
+        # A sync iterator would be read into memory whole under ASGI.
+        content = _aiterate(blocks) if isinstance(request, ASGIRequest) else blocks
+        response = StreamingHttpResponse(content, status=206 if byte_range else 200)
+    response['Content-Type'] = 'application/zip'
+    response['Content-Length'] = str(end - start + 1)
+    if byte_range:
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, no-cache'
+    response['Content-Disposition'] = content_disposition_header(True, f'{user.username}-data.zip')
+    return response
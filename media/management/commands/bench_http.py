@@ -0,0 +1,328 @@
+import asyncio
+import gc
+import json
+import random
+import statistics
+import threading
+import time
+import tracemalloc
+from pathlib import Path
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import Client
+from django.test.utils import override_settings
+from django.urls import reverse
+
+from chat.fake_ollama import FakeOllamaServer
+from chat.models import Message, Thread
+from media.models import Category, Comment, Like, Media
+
+# Synthetic data sizes, by scale name.
+SCALES = {
+    '10k': {'media': 10_000, 'thread_messages': 1_000},
+    '100k': {'media': 100_000, 'thread_messages': 10_000},
+    '1m': {'media': 1_000_000, 'thread_messages': 100_000},
+}
+CATEGORIES = 20
+LIKES_PER_MEDIA = 3
+# Items owned by the benchmark user, and comments and likes on the item whose page is measured.
+OWN_MEDIA = 500
+DETAIL_COMMENTS = 200
+DETAIL_LIKES = 500
+BATCH_SIZE = 10_000
+
+DEFAULT_BASELINES = Path(settings.BASE_DIR) / 'perf' / 'http_baselines.json'
+
+class QueryCounter:
+    """Counts queries through `connection.execute_wrapper` (the debug query log is capped)."""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+class Command(BaseCommand):
+    help = (
+        "Measures latency percentiles, query counts and allocations of the main "
+        "media and chat views against synthetic data at the given scales, and "
+        "fails if a view needs more queries than its stored baseline. Latency "
+        "and allocations vary between runs and machines, so growth beyond the "
+        "tolerance is only reported, unless --strict is given. Runs against a "
+        "throwaway test database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scale', action='append', choices=list(SCALES), help='Data scales to run (default: 10k).')
+        parser.add_argument('--requests', type=int, default=30, help='Timed requests per view.')
+        parser.add_argument('--warmup', type=int, default=3, help='Untimed requests per view.')
+        parser.add_argument('--view', action='append', help='Measure only these views.')
+        parser.add_argument('--baselines', default=str(DEFAULT_BASELINES), help='Baseline file.')
+        parser.add_argument('--update-baselines', action='store_true', help='Store these results as the baselines.')
+        parser.add_argument(
+            '--tolerance', type=float, default=0.25,
+            help='Allowed relative growth of p50 latency and peak allocations over the baseline before warning.',
+        )
+        parser.add_argument(
+            '--strict', action='store_true',
+            help='Also fail on latency and allocation growth beyond the tolerance (for a quiet, dedicated machine).',
+        )
+        parser.add_argument('--output', help='Write the results as JSON to this file.')
+        parser.add_argument('--json', action='store_true', help='Print machine-readable results.')
+
+    def handle(self, *args, **options):
+        scales = options['scale'] or ['10k']
+        results = {}
+        with FakeOllama() as ollama, override_settings(
+            DEBUG=False,
+            # The test client's host name.
+            ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver'],
+            OLLAMA_HOST=ollama.url,
+            LLM_CACHE_ENABLED=False,
+            CHAT_MEMORY_SUMMARIZE=False,
+        ):
+            for scale in scales:
+                old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+                try:
+                    started = time.perf_counter()
+                    fixture = self.populate(SCALES[scale])
+                    if not options['json']:
+                        self.stdout.write(f"{scale}: synthetic data created in {time.perf_counter() - started:.0f}s")
+                    results[scale] = self.measure(fixture, options)
+                finally:
+                    connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+        else:
+            self.report(results)
+
+        baselines_path = Path(options['baselines'])
+        baselines = json.loads(baselines_path.read_text()) if baselines_path.exists() else {}
+        if options['update_baselines']:
+            # Views that were not measured keep their baselines.
+            for scale, views in results.items():
+                baselines.setdefault(scale, {}).update(views)
+            baselines_path.parent.mkdir(parents=True, exist_ok=True)
+            baselines_path.write_text(json.dumps(baselines, indent=2, sort_keys=True) + '\n')
+            self.stdout.write(f"Baselines written to {baselines_path}")
+            return
+
+        regressions, slowdowns = self.compare(results, baselines, options['tolerance'])
+        if options['strict']:
+            regressions += slowdowns
+        elif slowdowns:
+            self.stderr.write(
+                "Slower than the baselines (not failing without --strict):\n"
+                + '\n'.join(f'  {line}' for line in slowdowns)
+            )
+        if regressions:
+            raise CommandError("Performance regressions:\n" + '\n'.join(f'  {line}' for line in regressions))
+
+    # Synthetic data
+
+    def populate(self, scale):
+        rng = random.Random(0)
+        media_count = scale['media']
+        user_count = max(100, media_count // 10)
+        with transaction.atomic():
+            User.objects.bulk_create(
+                [User(username=f'user{i}', password='!') for i in range(user_count)], batch_size=BATCH_SIZE
+            )
+            user_ids = list(User.objects.order_by('id').values_list('id', flat=True))
+            Category.objects.bulk_create([Category(name=f'Category {i}', slug=f'category-{i}') for i in range(CATEGORIES)])
+            category_ids = list(Category.objects.values_list('id', flat=True))
+        bench_user, other_user = User.objects.get(id=user_ids[0]), User.objects.get(id=user_ids[1])
+
+        through = Media.categories.through
+        for start in range(0, media_count, BATCH_SIZE):
+            with transaction.atomic():
+                batch = Media.objects.bulk_create([
+                    Media(
+                        # The benchmark user owns the first items; the rest are spread over everyone.
+                        owner_id=user_ids[0] if i < OWN_MEDIA else rng.choice(user_ids),
+                        title=f'Synthetic item {i}',
+                        file=f'user_media/item{i}.{"jpg" if i % 4 else "mp4"}',
+                        is_public=i % 10 != 0,
+                    )
+                    for i in range(start, min(start + BATCH_SIZE, media_count))
+                ])
+                through.objects.bulk_create([
+                    through(media_id=item.id, category_id=rng.choice(category_ids)) for item in batch
+                ])
+                Like.objects.bulk_create([
+                    Like(media_id=item.id, user_id=user_id)
+                    for item in batch for user_id in rng.sample(user_ids, LIKES_PER_MEDIA)
+                ], ignore_conflicts=True)
+                Comment.objects.bulk_create([
+                    Comment(media_id=item.id, author_id=rng.choice(user_ids), text=f'Comment on item {item.id}')
+                    for item in batch if rng.random() < 0.5
+                ])
+
+        detail = Media.objects.filter(is_public=True).order_by('-id').first()
+        with transaction.atomic():
+            Comment.objects.bulk_create([
+                Comment(media=detail, author_id=rng.choice(user_ids), text=f'Detail comment {i}')
+                for i in range(DETAIL_COMMENTS)
+            ])
+            Like.objects.bulk_create(
+                [Like(media=detail, user_id=user_id) for user_id in user_ids[2:DETAIL_LIKES + 2]],
+                ignore_conflicts=True,
+            )
+
+            thread = Thread.objects.create()
+            thread.participants.add(bench_user, other_user)
+        for start in range(0, scale['thread_messages'], BATCH_SIZE):
+            Message.objects.bulk_create([
+                Message(thread=thread, sender=bench_user if i % 2 else other_user, text=f'Message {i} in a long thread')
+                for i in range(start, min(start + BATCH_SIZE, scale['thread_messages']))
+            ])
+        return {
+            'user': bench_user,
+            'other_user': other_user,
+            'detail': detail,
+            'category': Category.objects.first(),
+        }
+
+    # Measurement
+
+    def endpoints(self, fixture):
+        """`(name, method, path, json_body)` of every measured view."""
+        detail = fixture['detail']
+        return [
+            ('home', 'get', reverse('home'), None),
+            ('home_by_category', 'get', reverse('home_by_category', args=[fixture['category'].slug]), None),
+            ('media_detail', 'get', reverse('media_detail', args=[detail.pk]), None),
+            ('my_media', 'get', reverse('my_media'), None),
+            # Alternately likes and unlikes.
+            ('like_media', 'post', reverse('like_media', args=[detail.pk]), None),
+            ('private_chat_room', 'get', reverse('private_chat_room', args=[fixture['other_user'].pk]), None),
+            ('chat_inbox', 'get', reverse('chat_inbox'), None),
+            ('chat_search', 'get', reverse('chat_search') + '?q=thread', None),
+            ('api_chat', 'post', reverse('chat_api'), {'message': 'Hello', 'stream': False, 'cache': False}),
+            ('api_ai_chat', 'post', reverse('ai_chat_api'), {'message': 'Hello', 'stream': False, 'cache': False}),
+        ]
+
+    def measure(self, fixture, options):
+        client = Client()
+        client.force_login(fixture['user'])
+        results = {}
+        for name, method, path, body in self.endpoints(fixture):
+            if options['view'] and name not in options['view']:
+                continue
+
+            def request():
+                if body is None:
+                    response = getattr(client, method)(path)
+                else:
+                    response = getattr(client, method)(path, json.dumps(body), content_type='application/json')
+                if response.status_code >= 400:
+                    raise CommandError(f"{name}: {method.upper()} {path} returned {response.status_code}")
+                if response.streaming:
+                    b''.join(response.streaming_content)
+
+            for _ in range(options['warmup']):
+                request()
+
+            queries = QueryCounter()
+            with connection.execute_wrapper(queries):
+                request()
+
+            latencies = []
+            for _ in range(options['requests']):
+                started = time.perf_counter()
+                request()
+                latencies.append(time.perf_counter() - started)
+
+            # Tracing slows requests down, so allocations are measured separately.
+            allocations = []
+            tracemalloc.start()
+            try:
+                for _ in range(5):
+                    # Garbage left by earlier requests would otherwise be
+                    # collected, or not, in the middle of this one.
+                    gc.collect()
+                    tracemalloc.reset_peak()
+                    before = tracemalloc.get_traced_memory()[0]
+                    request()
+                    allocations.append(tracemalloc.get_traced_memory()[1] - before)
+            finally:
+                tracemalloc.stop()
+
+            results[name] = {
+                'queries': queries.count,
+                'p50_ms': statistics.median(latencies) * 1000,
+                'p95_ms': percentile(latencies, 0.95) * 1000,
+                'p99_ms': percentile(latencies, 0.99) * 1000,
+                'peak_alloc_kib': statistics.median(allocations) / 1024,
+            }
+        return results
+
+    def report(self, results):
+        for scale, views in results.items():
+            self.stdout.write(f"{scale}:")
+            for name, result in views.items():
+                self.stdout.write(
+                    f"  {name:>18}: {result['queries']:>4} queries, p50 {result['p50_ms']:7.1f}ms "
+                    f"p95 {result['p95_ms']:7.1f}ms p99 {result['p99_ms']:7.1f}ms, "
+                    f"peak alloc {result['peak_alloc_kib']:8.0f} KiB"
+                )
+
+    def compare(self, results, baselines, tolerance):
+        """Returns `(query count regressions, latency and allocation regressions)`."""
+        # Tiny measurements are noisy; allow this much absolute slack on top of the tolerance.
+        slack_ms = 2.0
+        slack_kib = 64
+        regressions = []
+        slowdowns = []
+        for scale, views in results.items():
+            for name, result in views.items():
+                baseline = baselines.get(scale, {}).get(name)
+                if baseline is None:
+                    continue
+                if result['queries'] > baseline['queries']:
+                    regressions.append(f"{scale} {name}: {result['queries']} queries, baseline {baseline['queries']}")
+                limit = baseline['p50_ms'] * (1 + tolerance) + slack_ms
+                if result['p50_ms'] > limit:
+                    slowdowns.append(
+                        f"{scale} {name}: p50 {result['p50_ms']:.1f}ms, baseline {baseline['p50_ms']:.1f}ms"
+                    )
+                if result['peak_alloc_kib'] > baseline['peak_alloc_kib'] * (1 + tolerance) + slack_kib:
+                    slowdowns.append(
+                        f"{scale} {name}: peak alloc {result['peak_alloc_kib']:.0f} KiB, "
+                        f"baseline {baseline['peak_alloc_kib']:.0f} KiB"
+                    )
+        return regressions, slowdowns
+
+class FakeOllama:
+    """Runs a `FakeOllamaServer` on its own event loop in a background thread."""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='fake-ollama', daemon=True)
+        self.server = FakeOllamaServer(tokens=5, token_delay=0)
+
+    @property
+    def url(self):
+        return self.server.url
+
+    def __enter__(self):
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self.server.start(), self.loop).result()
+        return self
+
+    def __exit__(self, *exc_info):
+        asyncio.run_coroutine_threadsafe(self.server.stop(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
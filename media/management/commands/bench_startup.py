@@ -0,0 +1,94 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# Run in a fresh interpreter per measurement: loads what an ASGI worker loads
+# before serving its first request, then prints timings and memory as JSON.
+PROBE = '''
+import json, os, sys, time
+started = time.perf_counter()
+from media_sharing_project.asgi import application
+from django.urls import get_resolver
+get_resolver().url_patterns  # imports every view module
+booted = time.perf_counter()
+if sys.argv[1] == 'warm':
+    import chat.conversation
+finished = time.perf_counter()
+with open('/proc/self/status') as status:
+    rss_kb = next(int(line.split()[1]) for line in status if line.startswith('VmRSS:'))
+print(json.dumps({
+    'boot_s': booted - started,
+    'total_s': finished - started,
+    'rss_mb': rss_kb / 1024,
+    'modules': len(sys.modules),
+    'langchain': any(name.split('.')[0] in ('langchain', 'langchain_community') for name in sys.modules),
+    'numpy': 'numpy' in sys.modules,
+}))
+'''
+
+# Scenario name -> (probe mode, description).
+SCENARIOS = {
+    'media': ('cold', 'what every worker loads; neither LangChain nor numpy is imported'),
+    'warm': ('warm', 'plus LangChain, as preloaded by CHAT_LANGCHAIN_WARMUP'),
+}
+
+class Command(BaseCommand):
+    help = (
+        "Measures how long a worker takes to load the ASGI application and "
+        "every view, and its resident memory afterwards, with and without "
+        "LangChain loaded. Each run uses a fresh interpreter."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runs', type=int, default=5, help='Interpreters started per scenario.')
+        parser.add_argument('--scenario', action='append', choices=list(SCENARIOS), help='Scenarios to run (default: all).')
+        parser.add_argument('--json', action='store_true', help='Print machine-readable results.')
+
+    def handle(self, *args, **options):
+        if not os.path.exists('/proc/self/status'):
+            raise CommandError("Memory is read from /proc, which this platform does not have.")
+        env = {**os.environ, 'DJANGO_SETTINGS_MODULE': os.environ.get('DJANGO_SETTINGS_MODULE', 'media_sharing_project.settings')}
+        results = {}
+        for name in options['scenario'] or list(SCENARIOS):
+            mode, description = SCENARIOS[name]
+            runs = []
+            for _ in range(options['runs']):
+                started = time.perf_counter()
+                completed = subprocess.run(
+                    [sys.executable, '-c', PROBE, mode],
+                    cwd=settings.BASE_DIR, env=env, capture_output=True, text=True,
+                )
+                elapsed = time.perf_counter() - started
+                if completed.returncode != 0:
+                    raise CommandError(f"{name}: the probe failed:\n{completed.stderr}")
+                run = json.loads(completed.stdout.strip().splitlines()[-1])
+                run['process_s'] = elapsed
+                runs.append(run)
+            results[name] = {
+                'description': description,
+                'runs': len(runs),
+                'boot_s': statistics.median(run['boot_s'] for run in runs),
+                'total_s': statistics.median(run['total_s'] for run in runs),
+                'process_s': statistics.median(run['process_s'] for run in runs),
+                'rss_mb': statistics.median(run['rss_mb'] for run in runs),
+                'modules': runs[-1]['modules'],
+                'langchain': runs[-1]['langchain'],
+                'numpy': runs[-1]['numpy'],
+            }
+
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+        self.stdout.write(f"{'scenario':<8} {'load':>8} {'process':>8} {'RSS':>9} {'modules':>8}  langchain  numpy")
+        for name, result in results.items():
+            self.stdout.write(
+                f"{name:<8} {result['total_s'] * 1000:>6.0f}ms {result['process_s'] * 1000:>6.0f}ms "
+                f"{result['rss_mb']:>7.1f}MB {result['modules']:>8}  {'yes' if result['langchain'] else 'no':<9}  {'yes' if result['numpy'] else 'no'}"
+            )
+            self.stdout.write(f"         {result['description']}")
@@ -0,0 +1,21 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from media.related import build_related
+
+class Command(BaseCommand):
+    help = (
+        "Recomputes the stored related items of media queued for a refresh "
+        "(likes, uploads, privacy changes), or of every media item with --all. "
+        "Meant to run periodically, e.g. from cron."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Rebuild the related items of every media item.')
+        parser.add_argument('--batch-size', type=int, default=500, help='Media items scored per batch.')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        refreshed = build_related(full=options['all'], batch_size=options['batch_size'])
+        self.stdout.write(f"Refreshed related media for {refreshed} items in {time.perf_counter() - started:.1f}s")
@@ -0,0 +1,19 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from media.deletion import purge_pending
+
+class Command(BaseCommand):
+    help = (
+        "Removes users and media items that were marked deleted but not removed "
+        "yet, e.g. because the server restarted, in batches of DELETION_BATCH_SIZE rows."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, help='Rows deleted per transaction (default: DELETION_BATCH_SIZE).')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        purged = purge_pending(options['batch_size'])
+        self.stdout.write(f"Purged {purged} deleted users and media items in {time.perf_counter() - started:.1f}s")
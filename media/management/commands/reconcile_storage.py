@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from media.quota import reconcile
+
+class Command(BaseCommand):
+    help = (
+        "Measures every stored media file, in parallel, and corrects the stored "
+        "file sizes and per-user storage totals. Best run when few uploads happen."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, help='Files measured at once (default: STORAGE_RECONCILE_WORKERS).')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Media items read per query.')
+        parser.add_argument('--dry-run', action='store_true', help='Report differences without correcting them.')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        stats = reconcile(options['workers'], options['batch_size'], options['dry_run'])
+        verb = 'would be corrected' if options['dry_run'] else 'corrected'
+        self.stdout.write(
+            f"Checked {stats['items']} media items in {time.perf_counter() - started:.1f}s: "
+            f"{stats['sizes_corrected']} file sizes and {stats['users_corrected']} users' totals {verb}, "
+            f"{stats['missing_files']} files missing"
+        )
@@ -0,0 +1,36 @@
+# Generated by Django 5.2.18 on 2026-10-19 03:28
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('media', '0003_category_media_categories'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RelatedMediaRefresh',
+            fields=[
+                ('media', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='+', serialize=False, to='media.media')),
+                ('requested_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='RelatedMedia',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('score', models.FloatField()),
+                ('rank', models.PositiveSmallIntegerField()),
+                ('media', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='related_entries', to='media.media')),
+                ('related', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='media.media')),
+            ],
+            options={
+                'verbose_name_plural': 'related media',
+                'indexes': [models.Index(fields=['media', 'rank'], name='media_related_rank')],
+                'unique_together': {('media', 'related')},
+            },
+        ),
+    ]
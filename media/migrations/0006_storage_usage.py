@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-19 04:31
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('media', '0005_media_deletion'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StorageUsage',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='storage_usage', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('bytes', models.BigIntegerField(default=0)),
+                ('image_count', models.IntegerField(default=0)),
+                ('video_count', models.IntegerField(default=0)),
+                ('quota_bytes', models.BigIntegerField(blank=True, null=True)),
+            ],
+            options={
+                'verbose_name_plural': 'storage usage',
+            },
+        ),
+        migrations.AddField(
+            model_name='media',
+            name='file_size',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+    ]
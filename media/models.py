@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.db import models
 from django.contrib.auth.models import User
 from django.utils.text import slugify
@@ -20,6 +21,18 @@ class Category(models.Model):
     def __str__(self):
         return self.name
 
+IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.gif', '.webp']
+
+def is_image_file(name):
+    """Checks if a file is an image based on its extension; other media are videos."""
+    return os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS
+
+class MediaManager(models.Manager):
+    """Hides media items marked deleted but not removed yet (see media/deletion.py)."""
+
+    def get_queryset(self):
+        return super().get_queryset().filter(deleted_at__isnull=True)
+
 class Media(models.Model):
     """
     Represents an uploaded image or video file.
@@ -30,18 +43,23 @@ class Media(models.Model):
     is_public = models.BooleanField(default=True)
     uploaded_at = models.DateTimeField(auto_now_add=True)
     categories = models.ManyToManyField(Category, related_name='media_files', blank=True)
+    # Set when the item is deleted; the row and file are removed in the background.
+    deleted_at = models.DateTimeField(null=True, blank=True, editable=False)
+    # Counted in the owner's storage usage (see media/quota.py).
+    file_size = models.BigIntegerField(default=0, editable=False)
+
+    objects = MediaManager()
+    all_objects = models.Manager()
 
     @property
     def is_image(self):
         """Checks if the file is an image based on its extension."""
-        image_extensions = ['.jpg', '.jpeg', '.png', '.gif', '.webp']
-        ext = os.path.splitext(self.file.name)[1]
-        return ext.lower() in image_extensions
+        return is_image_file(self.file.name)
 
     @property
     def like_count(self):
-        """Returns the total number of likes for this media item."""
-        return self.likes.count()
+        """Returns the number of likes for this media item, not counting deactivated users'."""
+        return self.likes.filter(user__is_active=True).count()
 
     def __str__(self):
         return f'"{self.title}" by {self.owner.username}'
@@ -73,4 +91,63 @@ class Like(models.Model):
         unique_together = ('media', 'user')
 
     def __str__(self):
-        return f'{self.user.username} likes {self.media.title}'
\ No newline at end of file
+        return f'{self.user.username} likes {self.media.title}'
+
+class RelatedMedia(models.Model):
+    """
+    One of the precomputed nearest neighbours of a media item, ranked by
+    score (see media/related.py), so the related-items panel is a single
+    indexed query.
+    """
+    media = models.ForeignKey(Media, on_delete=models.CASCADE, related_name='related_entries')
+    related = models.ForeignKey(Media, on_delete=models.CASCADE, related_name='+')
+    score = models.FloatField()
+    rank = models.PositiveSmallIntegerField()
+
+    class Meta:
+        unique_together = ('media', 'related')
+        indexes = [models.Index(fields=['media', 'rank'], name='media_related_rank')]
+        verbose_name_plural = "related media"
+
+class RelatedMediaRefresh(models.Model):
+    """A media item whose related items are due to be recomputed."""
+    media = models.OneToOneField(Media, on_delete=models.CASCADE, primary_key=True, related_name='+')
+    requested_at = models.DateTimeField(auto_now_add=True)
+
+class PendingDeletion(models.Model):
+    """
+    A user or media item marked deleted, whose rows and files are still to
+    be removed (see media/deletion.py).
+    """
+    USER = 'user'
+    MEDIA = 'media'
+    KIND_CHOICES = [(USER, 'User'), (MEDIA, 'Media')]
+
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    object_id = models.BigIntegerField()
+    requested_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('kind', 'object_id')
+
+class StorageUsage(models.Model):
+    """
+    The bytes and number of items a user stores, kept up to date as media
+    is uploaded and deleted (see media/quota.py).
+    """
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='storage_usage')
+    bytes = models.BigIntegerField(default=0)
+    image_count = models.IntegerField(default=0)
+    video_count = models.IntegerField(default=0)
+    # Overrides STORAGE_QUOTA_BYTES for this user.
+    quota_bytes = models.BigIntegerField(null=True, blank=True)
+
+    class Meta:
+        verbose_name_plural = "storage usage"
+
+    def __str__(self):
+        return f'Storage used by {self.user.username}'
+
+    @property
+    def quota(self):
+        return settings.STORAGE_QUOTA_BYTES if self.quota_bytes is None else self.quota_bytes
@@ -0,0 +1,127 @@
+"""
+Per-user storage accounting and quotas.
+
+Each user's `StorageUsage` row holds the bytes they store and how many
+images and videos. It changes in the transaction that changes what it
+counts: `reserve` on upload, `release` when media items are marked deleted
+(see media/deletion.py). So the quota check on upload is one conditional
+UPDATE of that row, however many items the user has, and two concurrent
+uploads cannot both squeeze under the quota.
+
+`reconcile` (`manage.py reconcile_storage`) measures every stored file
+again, STORAGE_RECONCILE_WORKERS at a time, and rewrites the sizes and
+totals. That corrects any drift, e.g. files replaced on disk, and fills in
+uploads made before accounting existed.
+"""
+import logging
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Value
+from django.db.models.functions import Coalesce, Greatest
+
+from .models import Media, StorageUsage, is_image_file
+
+logger = logging.getLogger(__name__)
+
+def _count_field(is_image):
+    return 'image_count' if is_image else 'video_count'
+
+def get_usage(user) -> StorageUsage:
+    """Returns `user`'s usage (unsaved and empty if they have never uploaded), in one query."""
+    return StorageUsage.objects.filter(user=user).first() or StorageUsage(user=user)
+
+def reserve(user, size, is_image) -> bool:
+    """
+    Adds an item of `size` bytes to `user`'s usage if it fits in their quota.
+    Returns False, changing nothing, if it does not. Call it in the
+    transaction that saves the item.
+    """
+    count_field = _count_field(is_image)
+    for _ in range(2):
+        updated = StorageUsage.objects.filter(
+            user=user, bytes__lte=Coalesce(F('quota_bytes'), Value(settings.STORAGE_QUOTA_BYTES)) - size,
+        ).update(bytes=F('bytes') + size, **{count_field: F(count_field) + 1})
+        if updated:
+            return True
+        # No row yet (first upload), or over quota.
+        _, created = StorageUsage.objects.get_or_create(user=user)
+        if not created:
+            return False
+    return False
+
+def release(items):
+    """
+    Removes `(owner_id, file_size, file_name)` items from their owners'
+    usage. Call it in the transaction that marks them deleted. Totals stop
+    at zero: items uploaded before accounting existed were never counted.
+    """
+    totals = defaultdict(lambda: {'bytes': 0, 'image_count': 0, 'video_count': 0})
+    for owner_id, size, name in items:
+        totals[owner_id]['bytes'] += size
+        totals[owner_id][_count_field(is_image_file(name))] += 1
+    for owner_id, total in totals.items():
+        StorageUsage.objects.filter(user_id=owner_id).update(**{
+            field: Greatest(F(field) - amount, 0) for field, amount in total.items()
+        })
+
+def _measure(storage, name):
+    try:
+        return storage.size(name)
+    except (OSError, NotImplementedError) as e:
+        logger.warning(f"Could not measure media file {name}: {e}")
+        return None
+
+def reconcile(workers=None, batch_size=1000, dry_run=False) -> dict:
+    """
+    Measures every stored media file and rewrites the file sizes and usage
+    totals that differ. Returns counts of what was checked and corrected.
+    Uploads made while it runs may be miscounted; run it when quiet.
+    """
+    workers = workers or settings.STORAGE_RECONCILE_WORKERS
+    storage = Media._meta.get_field('file').storage
+    totals = defaultdict(lambda: {'bytes': 0, 'image_count': 0, 'video_count': 0})
+    stats = {'items': 0, 'missing_files': 0, 'sizes_corrected': 0, 'users_corrected': 0}
+
+    last_pk = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while True:
+            batch = list(Media.objects.filter(pk__gt=last_pk).order_by('pk').only('pk', 'owner_id', 'file', 'file_size')[:batch_size])
+            if not batch:
+                break
+            last_pk = batch[-1].pk
+            sizes = pool.map(lambda item: _measure(storage, item.file.name), batch)
+            changed = []
+            for item, size in zip(batch, sizes):
+                if size is None:
+                    stats['missing_files'] += 1
+                    size = 0
+                if size != item.file_size:
+                    item.file_size = size
+                    changed.append(item)
+                totals[item.owner_id]['bytes'] += size
+                totals[item.owner_id][_count_field(item.is_image)] += 1
+            stats['items'] += len(batch)
+            stats['sizes_corrected'] += len(changed)
+            if changed and not dry_run:
+                Media.all_objects.bulk_update(changed, ['file_size'])
+
+    with transaction.atomic():
+        usages = {usage.user_id: usage for usage in StorageUsage.objects.all()}
+        stale = []
+        for user_id in usages.keys() | totals.keys():
+            usage = usages.get(user_id) or StorageUsage(user_id=user_id)
+            expected = totals.get(user_id, {'bytes': 0, 'image_count': 0, 'video_count': 0})
+            if user_id not in usages or any(getattr(usage, field) != value for field, value in expected.items()):
+                for field, value in expected.items():
+                    setattr(usage, field, value)
+                stale.append(usage)
+        stats['users_corrected'] = len(stale)
+        if stale and not dry_run:
+            StorageUsage.objects.bulk_create(
+                stale, update_conflicts=True, unique_fields=['user'],
+                update_fields=['bytes', 'image_count', 'video_count'],
+            )
+    return stats
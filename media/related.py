@@ -0,0 +1,199 @@
+"""
+"Related media" recommendations.
+
+The neighbours of every media item are computed offline by
+`manage.py build_related_media` and stored, best first, in `RelatedMedia`,
+so the panel on `media_detail` is one indexed query. Candidates are scored by
+
+- co-likes: the cosine similarity of the sets of users who liked each item,
+- categories: the Jaccard similarity of their category sets (of the
+  candidates found by the other signals and the newest items in the same
+  categories),
+- embeddings: the cosine similarity of their title embeddings, when the
+  assistant's site content index is available (see `chat.retrieval`),
+
+weighted by `settings.MEDIA_RELATED_WEIGHTS`. Only public items are ever
+stored as neighbours, and they are checked again when read, so an item made
+private drops out of every panel at once.
+
+Likes, uploads and privacy changes queue the item in `RelatedMediaRefresh`;
+running the command without `--all` recomputes just the queued items.
+Co-like scores are symmetric, but a refresh only rewrites the queued item's
+own list; a periodic `--all` run catches up the others.
+
+`chat.retrieval` (and numpy with it) is only imported by the build, so
+serving pages never loads it.
+"""
+import math
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count
+from django.utils import timezone
+
+from .models import Category, Like, Media, RelatedMedia, RelatedMediaRefresh
+
+def related_media(media, limit=None):
+    """Returns up to `limit` public media items related to `media`, best first."""
+    limit = limit or settings.MEDIA_RELATED_COUNT
+    entries = (
+        RelatedMedia.objects.filter(media=media, related__is_public=True, related__deleted_at__isnull=True)
+        .select_related('related__owner').order_by('rank')[:limit]
+    )
+    return [entry.related for entry in entries]
+
+def request_refresh(media):
+    """Queues `media` for the next incremental refresh of related items."""
+    RelatedMediaRefresh.objects.bulk_create(
+        [RelatedMediaRefresh(media=media)],
+        update_conflicts=True, unique_fields=['media'], update_fields=['requested_at'],
+    )
+
+def _counts(queryset, field):
+    return {row[field]: row['n'] for row in queryset.values(field).annotate(n=Count('pk'))}
+
+def _colike_scores(batch, scores):
+    shared = (
+        Like.objects.filter(
+            user__like__media_id__in=batch, user__is_active=True, media__is_public=True, media__deleted_at__isnull=True,
+        )
+        .values('user__like__media_id', 'media_id').annotate(n=Count('pk'))
+    )
+    rows = [(row['user__like__media_id'], row['media_id'], row['n']) for row in shared]
+    likes = _counts(
+        Like.objects.filter(media_id__in={media_id for row in rows for media_id in row[:2]}, user__is_active=True),
+        'media_id',
+    )
+    for source, candidate, n in rows:
+        if source != candidate:
+            scores[source][candidate]['likes'] = n / math.sqrt(likes[source] * likes[candidate])
+
+def _categories_of(media_ids):
+    categories = defaultdict(set)
+    rows = Media.categories.through.objects.filter(media_id__in=media_ids).values_list('media_id', 'category_id')
+    for media_id, category_id in rows:
+        categories[media_id].add(category_id)
+    return categories
+
+def newest_by_category(count):
+    """Returns `{category_id: [media_id, ...]}` of the newest `count` public items per category."""
+    return {
+        category_id: list(
+            Media.objects.filter(categories=category_id, is_public=True)
+            .order_by('-uploaded_at').values_list('id', flat=True)[:count]
+        )
+        for category_id in Category.objects.values_list('id', flat=True)
+    }
+
+def _category_scores(batch, scores, newest):
+    # A popular category is shared by a large part of the site, so rather
+    # than scoring every pair, shared categories rank the candidates found
+    # by the other signals, topped up with the newest items of each category.
+    source_categories = _categories_of(batch)
+    for source in batch:
+        for category_id in source_categories[source]:
+            for candidate in newest.get(category_id, ()):
+                if candidate != source:
+                    scores[source].setdefault(candidate, {})
+    candidates = {candidate for source in batch for candidate in scores[source]}
+    categories = _categories_of(candidates)
+    for source in batch:
+        mine = source_categories[source]
+        if not mine:
+            continue
+        for candidate, signals in scores[source].items():
+            shared = len(mine & categories[candidate])
+            if shared:
+                signals['categories'] = shared / len(mine | categories[candidate])
+
+def _embedding_scores(batch, scores, embeddings):
+    from chat.retrieval import np
+
+    ids, vectors = embeddings
+    positions = {media_id: position for position, media_id in enumerate(ids.tolist())}
+    sources = [media_id for media_id in batch if media_id in positions]
+    if not sources or len(ids) < 2:
+        return
+    source_positions = np.array([positions[media_id] for media_id in sources])
+    similarities = vectors[source_positions] @ vectors.T
+    similarities[np.arange(len(sources)), source_positions] = -np.inf
+    count = min(settings.MEDIA_RELATED_EMBEDDING_CANDIDATES, len(ids) - 1)
+    top = np.argpartition(-similarities, count - 1, axis=1)[:, :count]
+
+    candidates = {int(ids[position]) for position in top.ravel()}
+    public = set(Media.objects.filter(id__in=candidates, is_public=True).values_list('id', flat=True))
+    for row, source in enumerate(sources):
+        for position in top[row]:
+            candidate = int(ids[position])
+            if candidate in public and similarities[row, position] > 0:
+                scores[source][candidate]['embeddings'] = float(similarities[row, position])
+
+def compute_related(batch, embeddings=None, newest=None):
+    """
+    Returns `{media_id: [(related_id, score), ...]}` for `batch`, best first.
+    `embeddings` are the `(ids, vectors)` of media titles and `newest` is
+    the result of `newest_by_category`.
+    """
+    weights = settings.MEDIA_RELATED_WEIGHTS
+    scores = defaultdict(lambda: defaultdict(dict))
+    if weights.get('likes'):
+        _colike_scores(batch, scores)
+    if weights.get('embeddings') and embeddings is not None:
+        _embedding_scores(batch, scores, embeddings)
+    if weights.get('categories'):
+        _category_scores(batch, scores, newest or {})
+
+    related = {}
+    for source in batch:
+        ranked = sorted(
+            ((candidate, sum(weights.get(signal, 0) * value for signal, value in signals.items()))
+             for candidate, signals in scores[source].items()),
+            key=lambda pair: (-pair[1], pair[0]),
+        )
+        related[source] = ranked[:settings.MEDIA_RELATED_STORED]
+    return related
+
+def _store(related, started):
+    # One short transaction per batch, so readers and writers are never held up for long.
+    with transaction.atomic():
+        RelatedMedia.objects.filter(media_id__in=list(related)).delete()
+        RelatedMedia.objects.bulk_create([
+            RelatedMedia(media_id=source, related_id=candidate, score=score, rank=rank)
+            for source, ranked in related.items() for rank, (candidate, score) in enumerate(ranked)
+        ])
+        # Requests made while this batch was computed stay queued.
+        RelatedMediaRefresh.objects.filter(media_id__in=list(related), requested_at__lte=started).delete()
+
+def _embeddings():
+    if not settings.MEDIA_RELATED_WEIGHTS.get('embeddings'):
+        return None
+    from chat.retrieval import MEDIA, get_index
+
+    index = get_index()
+    return index.vectors_of(MEDIA) if index is not None else None
+
+def build_related(full=False, batch_size=500):
+    """
+    Recomputes the related items of every media item (`full`) or of the
+    queued ones. Returns the number of items refreshed.
+    """
+    started = timezone.now()
+    embeddings = _embeddings()
+    newest = newest_by_category(settings.MEDIA_RELATED_STORED)
+    if full:
+        media_ids = Media.objects.values_list('id', flat=True)
+        key = 'id'
+    else:
+        media_ids = RelatedMediaRefresh.objects.values_list('media_id', flat=True)
+        key = 'media_id'
+
+    refreshed = 0
+    last = 0
+    while True:
+        batch = list(media_ids.filter(**{f'{key}__gt': last}).order_by(key)[:batch_size])
+        if not batch:
+            return refreshed
+        _store(compute_related(batch, embeddings, newest), started)
+        refreshed += len(batch)
+        last = batch[-1]
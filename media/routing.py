@@ -0,0 +1,7 @@
+from django.urls import re_path
+from . import consumers
+
+websocket_urlpatterns = [
+    re_path(r'ws/media/feed/$', consumers.MediaActivityConsumer.as_asgi()),
+    re_path(r'ws/media/(?P<pk>\d+)/$', consumers.MediaActivityConsumer.as_asgi()),
+]
@@ -1,3 +1,518 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.cache import cache
+from django.contrib.auth.models import User
+from django.core.files.storage import FileSystemStorage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connections, router, transaction
+from django.test.utils import CaptureQueriesContext
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from chat.models import Message, Thread
+from chat.retrieval import np
+from media_sharing_project import db_router
+from media_sharing_project.metrics import CallbackGauge, Counter, Histogram, Registry
+from media_sharing_project.db_router import (
+    PRIMARY, STICKY_COOKIE, ReplicaRoutingMiddleware, SQLiteReplicator, use_primary,
+)
+from .export import DataExport, ExportChanged
+from .management.commands.bench_startup import PROBE
+from .activity import media_group
+from .deletion import mark_media_deleted, mark_users_deleted, purge_pending
+from .models import Category, Comment, Like, Media, PendingDeletion, RelatedMedia, StorageUsage
+from .quota import release
+from .related import build_related, related_media
+
+REPLICA = 'replica'
+
+class ReplicaMixin:
+    """
+    Adds a `replica` database: a SQLite file that `SQLiteReplicator` copies
+    the primary into `replica_delay` seconds after each write.
+    """
+    replica_delay = 0.5
+
+    @classmethod
+    def setUpClass(cls):
+        fd, cls.replica_path = tempfile.mkstemp(suffix='.sqlite3')
+        os.close(fd)
+        connections.settings[REPLICA] = {**connections[PRIMARY].settings_dict, 'NAME': cls.replica_path}
+        # Added here, not in `databases`: the test runner would try to create it.
+        cls.databases = {*cls.databases, REPLICA}
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.databases = cls.databases - {REPLICA}
+        connections[REPLICA].close()
+        del connections[REPLICA]
+        del connections.settings[REPLICA]
+        os.remove(cls.replica_path)
+
+    def setUp(self):
+        super().setUp()
+        settings_override = override_settings(
+            DATABASE_REPLICAS=[REPLICA], DATABASE_REPLICA_MAX_LAG=5.0, DATABASE_REPLICA_LAG_CHECK_INTERVAL=0,
+            DATABASE_REPLICA_STICKY_SECONDS=10,
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.replicator = SQLiteReplicator(PRIMARY, REPLICA, self.replica_delay)
+        self.replicator.copy()
+        self.addCleanup(self.wait_for_replica)
+        patcher = mock.patch.object(db_router, '_replicator', self.replicator)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        connections[PRIMARY].execute_wrappers.append(self.replicator.execute)
+        self.addCleanup(connections[PRIMARY].execute_wrappers.remove, self.replicator.execute)
+        db_router._lags.clear()
+
+    def wait_for_replica(self):
+        deadline = time.monotonic() + self.replica_delay + 5
+        while self.replicator.lag() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        db_router._lags.clear()
+
+    def in_request(self, view, cookies=None):
+        """Runs `view()` as the body of a request; returns its result and the response."""
+        result = []
+
+        def get_response(request):
+            result.append(view())
+            return HttpResponse()
+
+        request = RequestFactory().get('/')
+        request.COOKIES.update(cookies or {})
+        response = ReplicaRoutingMiddleware(get_response)(request)
+        return result[0], response
+
+class ReplicaRoutingTests(ReplicaMixin, TransactionTestCase):
+    def read_alias(self):
+        return router.db_for_read(User)
+
+    def test_request_reads_use_the_replica(self):
+        self.assertEqual(self.in_request(self.read_alias)[0], REPLICA)
+
+    def test_reads_outside_requests_use_the_primary(self):
+        self.assertEqual(self.read_alias(), PRIMARY)
+
+    def test_transactions_and_use_primary_read_from_the_primary(self):
+        def in_transaction():
+            with transaction.atomic():
+                return self.read_alias()
+
+        def pinned():
+            with use_primary():
+                return self.read_alias()
+
+        self.assertEqual(self.in_request(in_transaction)[0], PRIMARY)
+        self.assertEqual(self.in_request(pinned)[0], PRIMARY)
+
+    def test_replicator_copies_writes_after_the_delay(self):
+        User.objects.create_user('alice')
+        self.assertFalse(User.objects.using(REPLICA).filter(username='alice').exists())
+        self.assertGreater(self.replicator.lag(), 0)
+        self.wait_for_replica()
+        self.assertTrue(User.objects.using(REPLICA).filter(username='alice').exists())
+        self.assertEqual(self.replicator.lag(), 0)
+
+    def test_request_reads_its_own_writes(self):
+        def write_then_read():
+            User.objects.create_user('alice')
+            return User.objects.filter(username='alice').exists(), self.read_alias()
+
+        (found, alias), response = self.in_request(write_then_read)
+        self.assertTrue(found)
+        self.assertEqual(alias, PRIMARY)
+        self.assertIn(STICKY_COOKIE, response.cookies)
+
+    def test_sticky_cookie_keeps_the_next_requests_on_the_primary(self):
+        _, response = self.in_request(lambda: User.objects.create_user('alice'))
+        cookie = response.cookies[STICKY_COOKIE].value
+        self.assertEqual(self.in_request(self.read_alias, {STICKY_COOKIE: cookie})[0], PRIMARY)
+        # Other browsers, and this one once the cookie has expired, use the replica.
+        self.assertEqual(self.in_request(self.read_alias)[0], REPLICA)
+        self.assertEqual(self.in_request(self.read_alias, {STICKY_COOKIE: str(time.time() - 1)})[0], REPLICA)
+        # Requests that only read set no cookie.
+        self.assertNotIn(STICKY_COOKIE, self.in_request(self.read_alias)[1].cookies)
+
+    @override_settings(DATABASE_REPLICA_MAX_LAG=0.1)
+    def test_lagging_replica_falls_back_to_the_primary(self):
+        User.objects.create_user('alice')
+        time.sleep(0.2)
+        with self.assertLogs('media_sharing_project.db_router', 'WARNING'):
+            self.assertEqual(self.in_request(self.read_alias)[0], PRIMARY)
+        self.wait_for_replica()
+        self.assertEqual(self.in_request(self.read_alias)[0], REPLICA)
+
+    @override_settings(CHAT_RAG_ENABLED=False)
+    def test_page_after_commenting_shows_the_comment(self):
+        user = User.objects.create_user('alice', password='x')
+        media = Media.objects.create(owner=user, title='beach', file='user_media/beach.jpg')
+        self.client.force_login(user)
+        self.replicator.copy()
+
+        response = self.client.post(reverse('media_detail', args=[media.pk]), {'text': 'Lovely light'}, follow=True)
+        self.assertContains(response, 'Lovely light')
+        self.assertFalse(Comment.objects.using(REPLICA).exists())
+
+class DataExportTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.user = User.objects.create_user('alice', password='x')
+        self.other = User.objects.create_user('bob', password='x')
+        self.media = self.upload('beach')
+        self.thread = Thread.objects.create()
+        self.thread.participants.add(self.user, self.other)
+        Message.objects.create(thread=self.thread, sender=self.user, text='hello')
+        self.client.force_login(self.user)
+
+    def upload(self, title):
+        return Media.objects.create(
+            owner=self.user, title=title, file=SimpleUploadedFile(f'{title}.jpg', title.encode() * 1000),
+        )
+
+    def add_rows(self):
+        self.upload('sunset')
+        Comment.objects.create(media=self.media, author=self.user, text='nice')
+        Message.objects.create(thread=self.thread, sender=self.other, text='hi')
+
+    def test_rows_added_while_streaming_are_left_out(self):
+        export = DataExport(self.user)
+        size = export.size
+        self.add_rows()
+        archive = b''.join(export.stream())
+        self.assertEqual(len(archive), size)
+        with zipfile.ZipFile(io.BytesIO(archive)) as zip_file:
+            self.assertIsNone(zip_file.testzip())
+            self.assertEqual(len([name for name in zip_file.namelist() if name.startswith('media/')]), 1)
+            self.assertNotIn(b'"hi"', zip_file.read('messages.json'))
+
+    def test_resume_after_rows_were_added(self):
+        url = reverse('export_data')
+        response = self.client.get(url)
+        archive = b''.join(response.streaming_content)
+        self.add_rows()
+
+        resumed = self.client.get(url, headers={'Range': 'bytes=100-', 'If-Range': response['ETag']})
+        self.assertEqual(resumed.status_code, 206)
+        self.assertEqual(resumed['ETag'], response['ETag'])
+        self.assertEqual(b''.join(resumed.streaming_content), archive[100:])
+
+        # A new download includes the new rows.
+        fresh = self.client.get(url)
+        self.assertNotEqual(fresh['ETag'], response['ETag'])
+        self.assertGreater(int(fresh['Content-Length']), len(archive))
+
+    def test_resume_after_a_change_starts_over(self):
+        url = reverse('export_data')
+        response = self.client.get(url)
+        Message.objects.filter(thread=self.thread).update(text='edited')
+        headers = {'Range': 'bytes=100-', 'If-Range': response['ETag']}
+        # The cached layout no longer matches once the stream reaches the change.
+        resumed = self.client.get(url, headers=headers)
+        with self.assertRaises(ExportChanged):
+            b''.join(resumed.streaming_content)
+        self.assertEqual(self.client.get(url, headers=headers).status_code, 200)
+
+    def test_resume_seeks_with_the_cached_layout(self):
+        second = self.upload('sunset')
+        export = DataExport(self.user)
+        archive = b''.join(export.stream())
+        # Past the JSON documents and the first upload.
+        start = archive.index(b'sunset' * 100)
+
+        resumed = DataExport.cached(self.user, export.etag)
+        self.assertEqual(resumed.size, len(archive))
+        with mock.patch.object(FileSystemStorage, 'open', autospec=True, side_effect=FileSystemStorage.open) as open_file:
+            with self.assertNumQueries(2):
+                self.assertEqual(b''.join(resumed.stream(start)), archive[start:])
+        self.assertEqual([call.args[1] for call in open_file.call_args_list], [second.file.name])
+        self.assertEqual(b''.join(DataExport.cached(self.user, export.etag).stream(100, 199)), archive[100:200])
+
+class StorageUsageTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('alice', password='x')
+        self.client.force_login(self.user)
+
+    def test_usage_is_read_once(self):
+        for n in range(3):
+            Media.objects.create(owner=self.user, title=f'beach {n}', file=f'user_media/beach{n}.jpg')
+        StorageUsage.objects.create(user=self.user, bytes=2048, image_count=1, quota_bytes=1024 * 1024)
+        # The session, the user, the usage and the items.
+        with self.assertNumQueries(4):
+            response = self.client.get(reverse('my_media'))
+        self.assertContains(response, 'Storage used: 2.0\xa0KB of 1.0\xa0MB (1 image, 0 videos)')
+
+    def test_usage_without_items(self):
+        StorageUsage.objects.create(user=self.user, quota_bytes=1024 * 1024)
+        response = self.client.get(reverse('my_media'))
+        self.assertContains(response, 'Storage used: 0\xa0bytes of 1.0\xa0MB (0 images, 0 videos)')
+
+    def test_release_stops_at_zero(self):
+        StorageUsage.objects.create(user=self.user, bytes=100, image_count=1)
+        # The second item was uploaded before accounting existed.
+        release([(self.user.pk, 100, 'user_media/a.jpg'), (self.user.pk, 50, 'user_media/b.jpg')])
+        usage = StorageUsage.objects.get(user=self.user)
+        self.assertEqual((usage.bytes, usage.image_count, usage.video_count), (0, 0, 0))
+
+class DeletionTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=media_root, CHAT_RAG_ENABLED=False)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.user = User.objects.create_user('alice', password='x')
+        self.other = User.objects.create_user('bob', password='x')
+        self.media = self.upload(self.other, 'beach')
+
+    def upload(self, owner, title):
+        return Media.objects.create(
+            owner=owner, title=title, file=SimpleUploadedFile(f'{title}.jpg', title.encode()),
+        )
+
+    def file_exists(self, media):
+        return media.file.storage.exists(media.file.name)
+
+    def test_deleted_media_is_hidden_until_purged(self):
+        items = [self.upload(self.user, f'item{n}') for n in range(3)]
+        for item in items:
+            Like.objects.create(media=item, user=self.other)
+        for n in range(5):
+            Comment.objects.create(media=items[0], author=self.other, text=f'nice {n}')
+        with self.captureOnCommitCallbacks() as callbacks:
+            mark_media_deleted(items)
+        self.assertEqual(len(callbacks), 1)
+        self.assertFalse(Media.objects.filter(owner=self.user).exists())
+        self.client.force_login(self.other)
+        self.assertEqual(self.client.get(reverse('media_detail', args=[items[0].pk])).status_code, 404)
+        self.assertTrue(all(self.file_exists(item) for item in items))
+
+        with CaptureQueriesContext(connections[PRIMARY]) as queries:
+            self.assertEqual(purge_pending(batch_size=2), 3)
+        # Five comments, at most two per transaction.
+        comment_batches = [
+            query for query in queries if query['sql'].startswith('DELETE FROM "media_comment" WHERE "media_comment"."id" IN')
+        ]
+        self.assertEqual(len(comment_batches), 3)
+        self.assertFalse(Media.all_objects.filter(owner=self.user).exists())
+        self.assertFalse(Comment.objects.filter(media__owner=self.user).exists())
+        self.assertFalse(Like.objects.filter(media__owner=self.user).exists())
+        self.assertFalse(any(self.file_exists(item) for item in items))
+        self.assertFalse(PendingDeletion.objects.exists())
+        self.assertTrue(self.file_exists(self.media))
+
+    def test_deleted_user_is_hidden_until_purged(self):
+        own = self.upload(self.user, 'sunset')
+        Comment.objects.create(media=self.media, author=self.user, text='from alice')
+        Like.objects.create(media=self.media, user=self.user)
+        Like.objects.create(media=self.media, user=self.other)
+        mark_users_deleted([self.user])
+
+        self.assertFalse(User.objects.get(pk=self.user.pk).is_active)
+        self.assertFalse(Media.objects.filter(pk=own.pk).exists())
+        self.assertEqual(self.media.like_count, 1)
+        self.client.force_login(self.other)
+        response = self.client.get(reverse('media_detail', args=[self.media.pk]))
+        self.assertNotContains(response, 'from alice')
+
+        self.assertEqual(purge_pending(), 1)
+        self.assertFalse(User.objects.filter(pk=self.user.pk).exists())
+        self.assertFalse(Comment.objects.filter(author_id=self.user.pk).exists())
+        self.assertEqual(Like.objects.filter(media=self.media).count(), 1)
+        self.assertFalse(self.file_exists(own))
+        self.assertTrue(self.file_exists(self.media))
+
+    def test_admin_bulk_delete_marks_instead_of_deleting(self):
+        admin = User.objects.create_superuser('admin', password='x')
+        self.client.force_login(admin)
+        own = self.upload(self.user, 'sunset')
+        self.client.post(reverse('admin:media_media_changelist'), {
+            'action': 'delete_selected', '_selected_action': [own.pk], 'post': 'yes',
+        })
+        self.client.post(reverse('admin:auth_user_changelist'), {
+            'action': 'delete_selected', '_selected_action': [self.other.pk], 'post': 'yes',
+        })
+        # Hidden, but left for the purge.
+        self.assertIsNotNone(Media.all_objects.get(pk=own.pk).deleted_at)
+        self.assertFalse(User.objects.get(pk=self.other.pk).is_active)
+        self.assertEqual(
+            set(PendingDeletion.objects.values_list('kind', 'object_id')),
+            {(PendingDeletion.MEDIA, own.pk), (PendingDeletion.USER, self.other.pk)},
+        )
+        self.assertNotContains(self.client.get(reverse('admin:auth_user_changelist')), '>bob<')
+
+@override_settings(CHAT_RAG_ENABLED=False)
+class ActivityTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('alice', password='x')
+        self.media = Media.objects.create(owner=self.user, title='beach', file='user_media/beach.jpg')
+        self.client.force_login(self.user)
+        self.channel_layer = get_channel_layer()
+        self.channel = async_to_sync(self.channel_layer.new_channel)()
+        async_to_sync(self.channel_layer.group_add)(media_group(self.media.pk), self.channel)
+        self.addCleanup(async_to_sync(self.channel_layer.flush))
+
+    def receive(self):
+        async def receive():
+            return await asyncio.wait_for(self.channel_layer.receive(self.channel), 5)
+        return async_to_sync(receive)()
+
+    def test_like_from_a_sync_view_reaches_the_group(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('like_media', args=[self.media.pk]))
+        self.assertIn('"likes":1', self.receive()['frame'].replace(' ', ''))
+
+    def test_comment_from_a_sync_view_reaches_the_group(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('media_detail', args=[self.media.pk]), {'text': 'Lovely light'})
+        self.assertIn('Lovely light', self.receive()['frame'])
+
+class StartupTests(SimpleTestCase):
+    def test_serving_pages_loads_neither_langchain_nor_numpy(self):
+        env = {**os.environ, 'DJANGO_SETTINGS_MODULE': 'media_sharing_project.settings'}
+        completed = subprocess.run(
+            [sys.executable, '-c', PROBE, 'cold'], cwd=settings.BASE_DIR, env=env, capture_output=True, text=True,
+        )
+        self.assertEqual(completed.returncode, 0, completed.stderr)
+        loaded = json.loads(completed.stdout.strip().splitlines()[-1])
+        self.assertFalse(loaded['langchain'])
+        self.assertFalse(loaded['numpy'])
+
+@override_settings(CHAT_RAG_ENABLED=False)
+class RelatedMediaTests(TestCase):
+    def setUp(self):
+        owner = User.objects.create_user('owner', password='x')
+        category = Category.objects.create(name='Beaches', slug='beaches')
+        self.items = {}
+        for name, fields in [
+            ('source', {}), ('public', {}), ('private', {'is_public': False}), ('deleted', {'deleted_at': timezone.now()}),
+        ]:
+            media = Media.all_objects.create(owner=owner, title=name, file=f'user_media/{name}.jpg', **fields)
+            media.categories.add(category)
+            self.items[name] = media
+        # Every signal links all four items: the same likers, category and title embedding.
+        for n in range(3):
+            fan = User.objects.create_user(f'fan{n}', password='x')
+            Like.objects.bulk_create([Like(user=fan, media=media) for media in self.items.values()])
+        ids = [media.pk for media in self.items.values()]
+        embeddings = (np.array(ids), np.full((len(ids), 4), 0.5, dtype=np.float32)) if np is not None else None
+        patcher = mock.patch('media.related._embeddings', return_value=embeddings)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_private_and_deleted_items_are_never_related(self):
+        build_related(full=True)
+        source, public = self.items['source'], self.items['public']
+        stored = set(RelatedMedia.objects.filter(media=source).values_list('related_id', flat=True))
+        self.assertEqual(stored, {public.pk})
+        self.assertEqual(related_media(source), [public])
+
+    def test_items_made_private_or_deleted_drop_out_at_once(self):
+        build_related(full=True)
+        source, public = self.items['source'], self.items['public']
+        Media.objects.filter(pk=public.pk).update(is_public=False)
+        self.assertEqual(related_media(source), [])
+        Media.objects.filter(pk=public.pk).update(is_public=True, deleted_at=timezone.now())
+        self.assertEqual(related_media(source), [])
+
+class MetricsRenderingTests(SimpleTestCase):
+    def test_text_format(self):
+        registry = Registry()
+        requests = Counter('requests_total', "Requests.", ['view', 'status'], registry=registry)
+        requests.labels('home', 200).inc()
+        requests.labels('home', 200).inc(2)
+        requests.labels('say "hi"\\now\n', 500).inc()
+        latency = Histogram('latency_seconds', "Latency.", buckets=(0.1, 1.0), registry=registry)
+        for value in (0.05, 0.1, 0.5, 3.0):
+            latency.observe(value)
+        CallbackGauge('queued', "Queued.", [], lambda: [((), 4)], registry=registry)
+
+        self.assertEqual(registry.render(), (
+            '# HELP requests_total Requests.\n'
+            '# TYPE requests_total counter\n'
+            'requests_total{view="home",status="200"} 3\n'
+            'requests_total{view="say \\"hi\\"\\\\now\\n",status="500"} 1\n'
+            '# HELP latency_seconds Latency.\n'
+            '# TYPE latency_seconds histogram\n'
+            'latency_seconds_bucket{le="0.1"} 2\n'
+            'latency_seconds_bucket{le="1.0"} 3\n'
+            'latency_seconds_bucket{le="+Inf"} 4\n'
+            'latency_seconds_sum 3.65\n'
+            'latency_seconds_count 4\n'
+            '# HELP queued Queued.\n'
+            '# TYPE queued gauge\n'
+            'queued 4\n'
+        ))
+
+    def test_a_failing_callback_does_not_break_the_scrape(self):
+        registry = Registry()
+        CallbackGauge('broken', "Broken.", [], lambda: 1 / 0, registry=registry)
+        Counter('ok_total', "OK.", registry=registry).inc()
+        with self.assertLogs('media_sharing_project.metrics', 'WARNING'):
+            rendered = registry.render()
+        self.assertIn('# TYPE broken gauge\n', rendered)
+        self.assertIn('ok_total 1\n', rendered)
+
+    def test_names_are_unique(self):
+        registry = Registry()
+        Counter('twice_total', "Twice.", registry=registry)
+        with self.assertRaises(ValueError):
+            Counter('twice_total', "Twice.", registry=registry)
+
+@override_settings(METRICS_TOKEN='secret')
+class MetricsAccessTests(TestCase):
+    urls = ['/metrics/', '/metrics/profiles/']
+
+    def test_anonymous_and_regular_users_are_refused(self):
+        for url in self.urls:
+            self.assertEqual(self.client.get(url).status_code, 403)
+        self.client.force_login(User.objects.create_user('alice', password='x'))
+        for url in self.urls:
+            self.assertEqual(self.client.get(url).status_code, 403)
+            self.assertEqual(self.client.get(url, headers={'Authorization': 'Bearer wrong'}).status_code, 403)
+
+    def test_staff(self):
+        self.client.force_login(User.objects.create_user('admin', password='x', is_staff=True))
+        response = self.client.get('/metrics/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+        self.assertIn(b'# TYPE http_requests_total counter', response.content)
+        self.assertEqual(self.client.get('/metrics/profiles/').status_code, 200)
+        self.assertEqual(self.client.get('/metrics/profiles/', {'n': 99}).status_code, 404)
+
+    def test_bearer_token(self):
+        for url in self.urls:
+            self.assertEqual(self.client.get(url, headers={'Authorization': 'Bearer secret'}).status_code, 200)
+
+    @override_settings(METRICS_TOKEN='')
+    def test_no_token_configured(self):
+        for url in self.urls:
+            self.assertEqual(self.client.get(url, headers={'Authorization': 'Bearer '}).status_code, 403)
@@ -8,6 +8,8 @@ urlpatterns = [
     path('category/<slug:category_slug>/', views.home, name='home_by_category'),
     # e.g., /my-media/
     path('my-media/', views.my_media, name='my_media'),
+    # e.g., /my-media/export/
+    path('my-media/export/', views.export_data, name='export_data'),
     # e.g., /upload/
     path('upload/', views.upload_media, name='upload_media'),
     # e.g., /accounts/signup/
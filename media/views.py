@@ -1,11 +1,19 @@
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth import login
 from django.contrib.auth.decorators import login_required
+from django.views.decorators.http import require_safe
 from django.contrib.auth.forms import UserCreationForm
 from .models import Media, Like, Comment, Category
 from .forms import MediaUploadForm, CommentForm
+from django.db import transaction
 from django.http import Http404
+from django.template.defaultfilters import filesizeformat
 from django.core.exceptions import PermissionDenied
+from .activity import publish_comment, publish_like, publish_upload
+from .deletion import mark_media_deleted
+from .quota import get_usage, reserve
+from .export import export_response
+from .related import related_media, request_refresh
 
 def home(request, category_slug=None):
     """
@@ -33,8 +41,18 @@ def my_media(request):
     """
     Displays all media items owned by the currently logged-in user.
     """
+    # The usage comes with the items; only users without any need another query.
     user_media = Media.objects.filter(owner=request.user).order_by('-uploaded_at')
-    return render(request, 'media/my_media.html', {'media_items': user_media})
+    return render(request, 'media/my_media.html', {'media_items': user_media, 'usage': get_usage(request.user)})
+
+@login_required
+@require_safe
+def export_data(request):
+    """
+    Streams a ZIP archive of the user's uploads, comments, likes and private
+    messages. Interrupted downloads can be resumed with range requests.
+    """
+    return export_response(request, request.user)
 
 def signup(request):
     """
@@ -60,7 +78,25 @@ def upload_media(request):
         if form.is_valid():
             media_instance = form.save(commit=False)
             media_instance.owner = request.user
-            media_instance.save()
+            media_instance.file_size = media_instance.file.size
+            with transaction.atomic():
+                # Counts the upload towards the user's quota, if it fits.
+                stored = reserve(request.user, media_instance.file_size, media_instance.is_image)
+                if stored:
+                    media_instance.save()
+            if not stored:
+                usage = get_usage(request.user)
+                form.add_error('file', (
+                    f"This file would exceed your storage quota: {filesizeformat(usage.bytes)} "
+                    f"of {filesizeformat(usage.quota)} used."
+                ))
+                return render(request, 'media/upload.html', {'form': form})
+            # Imported here: the retrieval index loads numpy.
+            from chat.retrieval import index_media
+            index_media(media_instance)
+            request_refresh(media_instance)
+            if media_instance.is_public:
+                publish_upload(media_instance)
             return redirect('my_media')
     else:
         form = MediaUploadForm()
@@ -72,7 +108,8 @@ def media_detail(request, pk):
     Enforces privacy rules: only owner can see private media.
     """
     media_item = get_object_or_404(Media, pk=pk)
-    comments = media_item.comments.select_related('author').all()
+    # Comments of deleted (deactivated) users are hidden.
+    comments = media_item.comments.filter(author__is_active=True).select_related('author')
     comment_form = CommentForm()
 
     # Check for permissions
@@ -88,6 +125,9 @@ def media_detail(request, pk):
             new_comment.media = media_item
             new_comment.author = request.user
             new_comment.save()
+            from chat.retrieval import index_comment
+            index_comment(new_comment)
+            publish_comment(new_comment)
             return redirect('media_detail', pk=pk) # Redirect to the same page to prevent form resubmission
 
     user_has_liked = False
@@ -99,6 +139,7 @@ def media_detail(request, pk):
         'comments': comments,
         'comment_form': comment_form,
         'user_has_liked': user_has_liked,
+        'related_items': related_media(media_item),
     }
     return render(request, 'media/media_detail.html', context)
 
@@ -114,10 +155,8 @@ def delete_media(request, pk):
         raise PermissionDenied
 
     if request.method == 'POST':
-        # Delete the file from storage
-        media_item.file.delete(save=False)
-        # Delete the database record
-        media_item.delete()
+        # Hidden at once; the record and file are removed in the background.
+        mark_media_deleted([media_item])
         return redirect('my_media')
 
     # If it's a GET request, just show the detail page (or a confirmation page)
@@ -137,6 +176,10 @@ def toggle_privacy(request, pk):
     if request.method == 'POST':
         media_item.is_public = not media_item.is_public
         media_item.save()
+        request_refresh(media_item)
+        if media_item.is_public:
+            # Newly public items show up in the live feed like new uploads.
+            publish_upload(media_item)
 
     return redirect('media_detail', pk=pk)
 
@@ -151,4 +194,6 @@ def like_media(request, pk):
         if not created:
             # The like already existed, so we delete it (unlike)
             like.delete()
+        publish_like(media_item, 1 if created else -1)
+        request_refresh(media_item)
     return redirect('media_detail', pk=pk)
@@ -4,15 +4,27 @@ from channels.auth import AuthMiddlewareStack
 from channels.routing import ProtocolTypeRouter, URLRouter
 from django.core.asgi import get_asgi_application
 
-import chat.routing
-
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "media_sharing_project.settings")
 
+# Set up Django before importing anything that uses models.
+django_asgi_app = get_asgi_application()
+
+import chat.routing
+import media.routing
+from chat.channel_layer import close_channel_layer
+from chat.ollama_client import aclose_clients
+from chat.utils import warm_langchain, warm_model_catalogue
+from media_sharing_project.lifespan import LifespanApp
+
 application = ProtocolTypeRouter(
     {
-        "http": get_asgi_application(),
+        "http": django_asgi_app,
         "websocket": AuthMiddlewareStack(
-            URLRouter(chat.routing.websocket_urlpatterns)
+            URLRouter(chat.routing.websocket_urlpatterns + media.routing.websocket_urlpatterns)
+        ),
+        "lifespan": LifespanApp(
+            on_startup=[warm_model_catalogue, warm_langchain],
+            on_shutdown=[aclose_clients, close_channel_layer],
         ),
     }
-)
\ No newline at end of file
+)
@@ -0,0 +1,262 @@
+"""
+Read replicas: reads go to a replica, writes to the primary (`default`).
+
+`ReplicaRouter` sends the reads of requests to one of `DATABASE_REPLICAS`,
+except:
+
+- inside a transaction on the primary, so a transaction sees its own writes;
+- for the rest of a request once it has written anything, and for
+  `DATABASE_REPLICA_STICKY_SECONDS` after that for the same browser:
+  `ReplicaRoutingMiddleware` sets a cookie, so the page shown after liking,
+  commenting or uploading already includes the change (read-your-writes);
+- when a replica is more than `DATABASE_REPLICA_MAX_LAG` seconds behind.
+  Lag is checked at most every `DATABASE_REPLICA_LAG_CHECK_INTERVAL` seconds
+  per process; a replica whose lag cannot be read counts as unavailable.
+  With no replica available, reads fall back to the primary.
+
+Everything outside a request (WebSocket consumers, management commands,
+background threads) reads from the primary. Such code often reads rows and
+then writes based on them, e.g. finding a chat thread before creating it,
+and a lagging replica would make it act on stale rows.
+
+For local testing, point `DATABASE_REPLICA_PATH` at a second SQLite file:
+`install_sqlite_replication` then copies the primary into it after every
+committed write, `DATABASE_REPLICA_SQLITE_DELAY` seconds later (to try out
+lag), with SQLite's online backup.
+"""
+import contextlib
+import contextvars
+import logging
+import math
+import random
+import sqlite3
+import threading
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.backends.signals import connection_created
+
+logger = logging.getLogger(__name__)
+
+PRIMARY = 'default'
+
+STICKY_COOKIE = 'db_primary_until'
+
+class _RoutingState:
+    """Whether the current request reads from the primary, and whether it wrote."""
+    __slots__ = ('pinned', 'wrote')
+
+    def __init__(self, pinned=False):
+        self.pinned = pinned
+        self.wrote = False
+
+_state = contextvars.ContextVar('db_routing', default=None)
+
+@contextlib.contextmanager
+def use_primary():
+    """Sends the reads in this block to the primary."""
+    token = _state.set(_RoutingState(pinned=True))
+    try:
+        yield
+    finally:
+        _state.reset(token)
+
+# alias -> (checked at, lag in seconds), per process.
+_lags = {}
+
+def _measure_lag(alias):
+    if _replicator is not None and _replicator.replica == alias:
+        return _replicator.lag()
+    connection = connections[alias]
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            # Also grows while the primary is idle, which only costs a few primary reads.
+            cursor.execute('SELECT COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)')
+            return float(cursor.fetchone()[0])
+        if connection.vendor == 'mysql':
+            cursor.execute('SHOW REPLICA STATUS')
+            row = cursor.fetchone()
+            if row is None:
+                return math.inf
+            lag = dict(zip([column[0] for column in cursor.description], row))['Seconds_Behind_Source']
+            return math.inf if lag is None else float(lag)
+    return 0.0
+
+def replica_lag(alias) -> float:
+    """How many seconds the replica is behind the primary (inf if unknown)."""
+    now = time.monotonic()
+    checked = _lags.get(alias)
+    if checked is not None and now - checked[0] < settings.DATABASE_REPLICA_LAG_CHECK_INTERVAL:
+        return checked[1]
+    try:
+        lag = _measure_lag(alias)
+    except Exception as e:
+        logger.warning(f"Could not read the lag of replica {alias!r}: {e}")
+        lag = math.inf
+    if lag > settings.DATABASE_REPLICA_MAX_LAG and (checked is None or checked[1] <= settings.DATABASE_REPLICA_MAX_LAG):
+        logger.warning(f"Replica {alias!r} is {lag:.1f}s behind; reading from the primary")
+    _lags[alias] = (now, lag)
+    return lag
+
+class ReplicaRouter:
+    def __init__(self):
+        if settings.DATABASE_REPLICA_SQLITE_SYNC:
+            install_sqlite_replication()
+
+    def db_for_read(self, model, **hints):
+        replicas = settings.DATABASE_REPLICAS
+        if not replicas:
+            return PRIMARY
+        state = _state.get()
+        # Only requests, which `ReplicaRoutingMiddleware` gives a state, use replicas.
+        if state is None or state.pinned or state.wrote:
+            return PRIMARY
+        if connections[PRIMARY].in_atomic_block:
+            return PRIMARY
+        available = [alias for alias in replicas if replica_lag(alias) <= settings.DATABASE_REPLICA_MAX_LAG]
+        return random.choice(available) if available else PRIMARY
+
+    def db_for_write(self, model, **hints):
+        state = _state.get()
+        if state is not None:
+            state.wrote = True
+        return PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same data as the primary.
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas get the schema through replication.
+        return db == PRIMARY
+
+class ReplicaRoutingMiddleware:
+    """
+    Routes the reads of each request, and keeps the reads of a browser that
+    just wrote something on the primary for `DATABASE_REPLICA_STICKY_SECONDS`.
+    Put it before `SessionMiddleware`, so session reads and writes count too.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        state = self.request_state(request)
+        token = _state.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            _state.reset(token)
+        return self.stick(response, state)
+
+    async def __acall__(self, request):
+        state = self.request_state(request)
+        token = _state.set(state)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _state.reset(token)
+        return self.stick(response, state)
+
+    def request_state(self, request):
+        try:
+            until = float(request.COOKIES.get(STICKY_COOKIE, 0))
+        except ValueError:
+            until = 0
+        return _RoutingState(pinned=until > time.time())
+
+    def stick(self, response, state):
+        if state.wrote and settings.DATABASE_REPLICAS:
+            seconds = settings.DATABASE_REPLICA_STICKY_SECONDS
+            response.set_cookie(STICKY_COOKIE, f'{time.time() + seconds:.0f}', max_age=seconds, httponly=True, samesite='Lax')
+        return response
+
+# Statements that do not change the database.
+_READ_ONLY = ('SELECT', 'PRAGMA', 'SAVEPOINT', 'RELEASE', 'BEGIN', 'EXPLAIN')
+
+class SQLiteReplicator:
+    """
+    Test replication between two SQLite files: copies the primary over the
+    replica after every committed write, `delay` seconds later. Writes made
+    while a copy is pending are included in it.
+    """
+
+    def __init__(self, primary, replica, delay=0.0):
+        self.primary = primary
+        self.replica = replica
+        self.delay = delay
+        self._lock = threading.Lock()
+        # When the oldest change not yet on the replica was committed.
+        self._pending_since = None
+
+    def lag(self) -> float:
+        pending_since = self._pending_since
+        return 0.0 if pending_since is None else time.monotonic() - pending_since
+
+    def execute(self, execute, sql, params, many, context):
+        result = execute(sql, params, many, context)
+        if not sql.lstrip().upper().startswith(_READ_ONLY):
+            connection = context['connection']
+            if connection.in_atomic_block:
+                transaction.on_commit(self.schedule, using=connection.alias)
+            else:
+                self.schedule()
+        return result
+
+    def schedule(self):
+        with self._lock:
+            if self._pending_since is not None:
+                return
+            self._pending_since = time.monotonic()
+        if self.delay:
+            timer = threading.Timer(self.delay, self.copy)
+            timer.daemon = True
+            timer.start()
+        else:
+            self.copy()
+
+    def copy(self):
+        with self._lock:
+            self._pending_since = None
+        source_name = connections[self.primary].settings_dict['NAME']
+        target_name = connections[self.replica].settings_dict['NAME']
+        if source_name == target_name:
+            # Test databases: the replica mirrors the primary.
+            return
+        # Names may be URIs, e.g. of in-memory test databases.
+        source = sqlite3.connect(source_name, uri=True)
+        target = sqlite3.connect(target_name, uri=True)
+        try:
+            source.backup(target)
+        except sqlite3.Error as e:
+            logger.warning(f"Could not copy the primary database to {self.replica!r}: {e}")
+        finally:
+            source.close()
+            target.close()
+
+    def install(self, sender=None, connection=None, **kwargs):
+        if connection.alias == self.primary and self.execute not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self.execute)
+
+_replicator = None
+
+def install_sqlite_replication():
+    """Keeps the SQLite replica in `DATABASE_REPLICAS` in sync with the primary."""
+    global _replicator
+    if _replicator is not None:
+        return
+    _replicator = SQLiteReplicator(PRIMARY, settings.DATABASE_REPLICAS[0], settings.DATABASE_REPLICA_SQLITE_DELAY)
+    connection_created.connect(_replicator.install, weak=False)
+    if connections[PRIMARY].connection is not None:
+        _replicator.install(connection=connections[PRIMARY])
+    # Start from an up-to-date replica.
+    _replicator.schedule()
@@ -0,0 +1,37 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+class LifespanApp:
+    """
+    Handles the ASGI `lifespan` protocol, running the given coroutine
+    functions on server startup and shutdown.
+
+    Servers that do not implement lifespan (e.g. daphne) simply never call it.
+    """
+
+    def __init__(self, on_startup=(), on_shutdown=()):
+        self.on_startup = list(on_startup)
+        self.on_shutdown = list(on_shutdown)
+
+    async def __call__(self, scope, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    for hook in self.on_startup:
+                        await hook()
+                except Exception as e:
+                    logger.error(f"ASGI startup hook failed: {e}", exc_info=True)
+                    await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                for hook in self.on_shutdown:
+                    try:
+                        await hook()
+                    except Exception as e:
+                        # Keep shutting down the remaining resources.
+                        logger.error(f"ASGI shutdown hook failed: {e}", exc_info=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
@@ -0,0 +1,507 @@
+"""
+Process metrics in the Prometheus text format, served at `/metrics/`.
+
+Metrics are plain in-process counters, gauges and histograms (no client
+library needed), cheap enough to update on every request: a dict lookup and
+a lock per update. Each worker process keeps its own values, so scrape every
+worker (Prometheus adds the `instance` label).
+
+- `MetricsMiddleware` times every request by view and counts the database
+  queries its view runs, and their time.
+- `ConsumerMetricsMixin` counts open WebSockets and frames per consumer.
+- The LLM scheduler records queue waits, time to first token, generation
+  time and tokens per second (see `chat.scheduler`).
+- Channel layer queue depths and LLM queue lengths are read at scrape time.
+
+Slow requests can be profiled on demand: a `METRICS_PROFILE_SAMPLE_RATE`
+fraction of requests, and staff requests sent with an `X-Profile: 1` header,
+have the stack of the thread running their view sampled every
+`METRICS_PROFILE_INTERVAL` seconds. Profiles of requests slower than
+`METRICS_SLOW_REQUEST_SECONDS` (and of every explicitly requested one) are
+kept at `/metrics/profiles/` in the collapsed-stack format read by
+flamegraph tools. Async views mostly wait on the event loop, so only the
+synchronous part of a request shows up in its profile.
+"""
+import contextvars
+import logging
+import math
+import os
+import random
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter as StackCounter, deque
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.http import HttpResponse, HttpResponseForbidden
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+def _format_value(value) -> str:
+    if isinstance(value, float):
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+    return str(value)
+
+def _escape(value) -> str:
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+def _format_labels(pairs) -> str:
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            try:
+                for suffix, pairs, value in metric.samples():
+                    lines.append(f'{metric.name}{suffix}{_format_labels(pairs)} {_format_value(value)}')
+            except Exception as e:
+                logger.warning(f"Could not collect metric {metric.name}: {e}")
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def labels(self, *values):
+        """Returns the child for these label values, in `labelnames` order."""
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}")
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _label_pairs(self, values):
+        return list(zip(self.labelnames, values))
+
+    def samples(self):
+        for values, child in list(self._children.items()):
+            yield from child.samples(self._label_pairs(values))
+
+class _CounterChild:
+    __slots__ = ('value', '_lock')
+
+    def __init__(self, lock):
+        self.value = 0
+        self._lock = lock
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self, pairs):
+        yield '', pairs, self.value
+
+class _GaugeChild(_CounterChild):
+    __slots__ = ()
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set(self, value):
+        self.value = value
+
+class _HistogramChild:
+    __slots__ = ('bounds', 'counts', 'sum', '_lock')
+
+    def __init__(self, lock, bounds):
+        self.bounds = bounds
+        self.counts = [0] * len(bounds)
+        self.sum = 0.0
+        self._lock = lock
+
+    def observe(self, value):
+        # Buckets are inclusive upper bounds; the last one is +Inf.
+        index = bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def samples(self, pairs):
+        with self._lock:
+            counts, total = list(self.counts), self.sum
+        cumulative = 0
+        for bound, count in zip(self.bounds, counts):
+            cumulative += count
+            yield '_bucket', pairs + [('le', _format_value(float(bound)))], cumulative
+        yield '_sum', pairs, total
+        yield '_count', pairs, cumulative
+
+class Counter(_Metric):
+    """A monotonically increasing count; by convention its name ends in `_total`."""
+    type = 'counter'
+
+    def _new_child(self):
+        return _CounterChild(self._lock)
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def _new_child(self):
+        return _GaugeChild(self._lock)
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def dec(self, amount=1):
+        self.labels().dec(amount)
+
+    def set(self, value):
+        self.labels().set(value)
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS, registry=REGISTRY):
+        self.bounds = tuple(sorted(buckets)) + (math.inf,)
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramChild(self._lock, self.bounds)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+class CallbackGauge(_Metric):
+    """A gauge read at scrape time: `function()` returns `[(label_values, value), ...]`."""
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labelnames, function, registry=REGISTRY):
+        self.function = function
+        super().__init__(name, documentation, labelnames, registry)
+
+    def samples(self):
+        for values, value in self.function():
+            yield '', self._label_pairs(values), value
+
+# HTTP requests
+
+http_requests = Counter('http_requests_total', "HTTP requests by view, method and status.", ['view', 'method', 'status'])
+http_request_duration = Histogram(
+    'http_request_duration_seconds',
+    "Time to the response (its headers, for streaming responses) by view.", ['view', 'method'],
+)
+http_slow_requests = Counter(
+    'http_slow_requests_total', "Requests slower than METRICS_SLOW_REQUEST_SECONDS by view.", ['view'],
+)
+db_queries_per_request = Histogram(
+    'http_request_db_queries', "Database queries run by each request's view.", ['view'],
+    buckets=QUERY_COUNT_BUCKETS,
+)
+db_query_duration = Counter('db_query_seconds_total', "Time spent in database queries by view.", ['view'])
+
+# WebSockets
+
+websocket_connections = Gauge('websocket_connections', "Open WebSocket connections by consumer.", ['consumer'])
+websocket_connections_accepted = Counter(
+    'websocket_connections_accepted_total', "Accepted WebSocket connections by consumer.", ['consumer'],
+)
+websocket_frames_received = Counter(
+    'websocket_frames_received_total', "WebSocket frames received from clients by consumer.", ['consumer'],
+)
+websocket_frames_sent = Counter('websocket_frames_sent_total', "WebSocket frames sent to clients by consumer.", ['consumer'])
+
+def _channel_queue_depths():
+    layer = get_channel_layer()
+    if layer is None:
+        return []
+    if hasattr(layer, 'queue_depths'):
+        return layer.queue_depths()
+    # The in-memory layer keeps one queue per channel with pending messages.
+    return [queue.qsize() for queue in list(getattr(layer, 'channels', {}).values())]
+
+CallbackGauge(
+    'channel_layer_channels', "Channels with a local receive queue.", [],
+    lambda: [((), len(_channel_queue_depths()))],
+)
+CallbackGauge(
+    'channel_layer_queued_messages', "Messages waiting in local channel queues.", [],
+    lambda: [((), sum(_channel_queue_depths()))],
+)
+CallbackGauge(
+    'channel_layer_max_queue_depth', "Length of the longest local channel queue.", [],
+    lambda: [((), max(_channel_queue_depths(), default=0))],
+)
+
+# Request instrumentation
+
+class _RequestStats:
+    __slots__ = ('queries', 'query_time', 'profile')
+
+    def __init__(self):
+        self.queries = 0
+        self.query_time = 0.0
+        self.profile = None
+
+_current_request = contextvars.ContextVar('metrics_request', default=None)
+
+def _record_query(execute, sql, params, many, context):
+    stats = _current_request.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.queries += 1
+        stats.query_time += time.perf_counter() - started
+
+def _install_query_recorder():
+    # Connections are per thread; this runs in the thread executing the view.
+    for connection in connections.all():
+        if _record_query not in connection.execute_wrappers:
+            connection.execute_wrappers.append(_record_query)
+
+class Profile:
+    """The sampled stacks of one request."""
+
+    def __init__(self, request, thread_id, requested):
+        self.method = request.method
+        self.path = request.path
+        self.thread_id = thread_id
+        # Asked for with `X-Profile`, so kept however fast the request was.
+        self.requested = requested
+        self.started_at = time.time()
+        self.view = None
+        self.duration = None
+        self.stacks = StackCounter()
+
+    def collapsed(self) -> str:
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})'
+
+class SamplingProfiler:
+    """
+    Samples the stacks of the threads running profiled requests from one
+    background thread, which runs only while some request is profiled.
+    """
+
+    def __init__(self, interval, keep):
+        self.interval = interval
+        # The most recent profiles kept, newest last.
+        self.kept = deque(maxlen=keep)
+        self._active = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self, profile):
+        with self._lock:
+            self._active[profile.thread_id] = profile
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='metrics-profiler', daemon=True)
+                self._thread.start()
+
+    def stop(self, profile):
+        with self._lock:
+            if self._active.get(profile.thread_id) is profile:
+                del self._active[profile.thread_id]
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._active:
+                    self._thread = None
+                    return
+                active = list(self._active.values())
+            frames = sys._current_frames()
+            for profile in active:
+                frame = frames.get(profile.thread_id)
+                names = []
+                while frame is not None:
+                    names.append(_frame_name(frame))
+                    frame = frame.f_back
+                if names:
+                    profile.stacks[';'.join(reversed(names))] += 1
+
+_profiler = None
+
+def get_profiler() -> SamplingProfiler:
+    global _profiler
+    if _profiler is None:
+        _profiler = SamplingProfiler(settings.METRICS_PROFILE_INTERVAL, settings.METRICS_PROFILE_KEEP)
+    return _profiler
+
+class MetricsMiddleware:
+    """
+    Records latency, status and database queries of every request, labelled
+    with the URL name of its view. Put it first in `MIDDLEWARE` so the
+    latency covers the other middleware too.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.METRICS_ENABLED:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        stats = _RequestStats()
+        token = _current_request.set(stats)
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _current_request.reset(token)
+        self.record(request, response, stats, time.perf_counter() - started)
+        return response
+
+    async def __acall__(self, request):
+        stats = _RequestStats()
+        token = _current_request.set(stats)
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current_request.reset(token)
+        self.record(request, response, stats, time.perf_counter() - started)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        # Called in the thread that runs a sync view, also under ASGI.
+        stats = _current_request.get()
+        if stats is None:
+            return None
+        _install_query_recorder()
+        rate = settings.METRICS_PROFILE_SAMPLE_RATE
+        requested = request.headers.get('X-Profile') == '1' and request.user.is_staff
+        if requested or (rate and random.random() < rate):
+            stats.profile = Profile(request, threading.get_ident(), requested)
+            get_profiler().start(stats.profile)
+        return None
+
+    def record(self, request, response, stats, duration):
+        match = request.resolver_match
+        view = match.view_name if match is not None else 'unmatched'
+        http_requests.labels(view, request.method, response.status_code).inc()
+        http_request_duration.labels(view, request.method).observe(duration)
+        if match is not None:
+            db_queries_per_request.labels(view).observe(stats.queries)
+            db_query_duration.labels(view).inc(stats.query_time)
+
+        slow = duration >= settings.METRICS_SLOW_REQUEST_SECONDS
+        if slow:
+            http_slow_requests.labels(view).inc()
+            logger.info(
+                f"Slow request: {request.method} {request.path} ({view}) took {duration * 1000:.0f}ms, "
+                f"{stats.queries} queries in {stats.query_time * 1000:.0f}ms"
+            )
+        profile = stats.profile
+        if profile is not None:
+            profiler = get_profiler()
+            profiler.stop(profile)
+            if slow or profile.requested:
+                profile.view = view
+                profile.duration = duration
+                profiler.kept.append(profile)
+
+# WebSockets
+
+class ConsumerMetricsMixin:
+    """Counts connections and frames of a WebSocket consumer, labelled with its class name."""
+    _metered = False
+
+    async def accept(self, subprotocol=None, headers=None):
+        await super().accept(subprotocol, headers)
+        name = type(self).__name__
+        websocket_connections_accepted.labels(name).inc()
+        websocket_connections.labels(name).inc()
+        self._metered = True
+
+    async def websocket_receive(self, message):
+        websocket_frames_received.labels(type(self).__name__).inc()
+        await super().websocket_receive(message)
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        if text_data is not None or bytes_data is not None:
+            websocket_frames_sent.labels(type(self).__name__).inc()
+        await super().send(text_data, bytes_data, close)
+
+    async def websocket_disconnect(self, message):
+        if self._metered:
+            self._metered = False
+            websocket_connections.labels(type(self).__name__).dec()
+        await super().websocket_disconnect(message)
+
+# Views
+
+def _authorized(request) -> bool:
+    token = settings.METRICS_TOKEN
+    if token and request.headers.get('Authorization') == f'Bearer {token}':
+        return True
+    return request.user.is_staff
+
+def metrics_view(request):
+    """The metrics of this process, for Prometheus."""
+    if not _authorized(request):
+        return HttpResponseForbidden()
+    return HttpResponse(REGISTRY.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+def profiles_view(request):
+    """
+    The kept request profiles, newest first, each headed by a comment line.
+    `?n=<index>` returns just one of them, ready for a flame graph tool.
+    """
+    if not _authorized(request):
+        return HttpResponseForbidden()
+    kept = list(reversed(get_profiler().kept))
+    index = request.GET.get('n')
+    if index is not None:
+        try:
+            return HttpResponse(kept[int(index)].collapsed(), content_type='text/plain; charset=utf-8')
+        except (ValueError, IndexError):
+            return HttpResponse("No such profile.\n", status=404, content_type='text/plain; charset=utf-8')
+    body = []
+    for index, profile in enumerate(kept):
+        body.append(
+            f"# {index}: {profile.method} {profile.path} ({profile.view}) {profile.duration * 1000:.0f}ms, "
+            f"{sum(profile.stacks.values())} samples, "
+            f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(profile.started_at))}\n"
+        )
+        body.append(profile.collapsed())
+    return HttpResponse(''.join(body), content_type='text/plain; charset=utf-8')
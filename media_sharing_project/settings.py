@@ -46,6 +46,10 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, so request timings include the other middleware.
+    "media_sharing_project.metrics.MetricsMiddleware",
+    # Before the session middleware, so session writes pin reads to the primary.
+    "media_sharing_project.db_router.ReplicaRoutingMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -142,14 +146,231 @@ MEDIA_ROOT = BASE_DIR / 'mediafiles'
 # Channels
 CHANNEL_LAYERS = {
     "default": {
-        "BACKEND": "channels.layers.InMemoryChannelLayer"
-        # For production, use channels_redis:
-        # "BACKEND": "channels_redis.core.RedisChannelLayer",
-        # "CONFIG": { "hosts": [("127.0.0.1", 6379)], },
+        "BACKEND": "channels.layers.InMemoryChannelLayer",
+        # Messages beyond `capacity` per channel are dropped for group sends;
+        # undelivered messages expire after `expiry` seconds.
+        "CONFIG": {"capacity": 100, "expiry": 60},
     },
 }
 
+# To run chat across several worker processes, point CHANNEL_REDIS_HOSTS at
+# one or more Redis servers (comma-separated URLs); groups and channels are
+# sharded over them (see chat/channel_layer.py). For local testing, start
+# `python manage.py run_fake_redis` and use redis://127.0.0.1:6379.
+CHANNEL_REDIS_HOSTS = [host for host in os.environ.get('CHANNEL_REDIS_HOSTS', '').split(',') if host]
+if CHANNEL_REDIS_HOSTS:
+    CHANNEL_LAYERS["default"] = {
+        "BACKEND": "chat.channel_layer.RedisChannelLayer",
+        "CONFIG": {
+            "hosts": CHANNEL_REDIS_HOSTS,
+            "capacity": 100,
+            "expiry": 60,
+            "group_expiry": 86400,
+            "presence_ttl": 30,
+        },
+    }
+
+# Caches
+# The local-memory cache is per process. For several workers, point the
+# default cache at a shared backend so they share e.g. the Ollama model list:
+# "BACKEND": "django.core.cache.backends.redis.RedisCache",
+# "LOCATION": "redis://127.0.0.1:6379",
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+}
+
+# JSON implementation for chat WebSocket frames: "json" or the faster "orjson"
+# (optional dependency; see chat/codec.py).
+CHAT_JSON_CODEC = os.environ.get('CHAT_JSON_CODEC', 'json')
+
 # Ollama Integration Settings
-OLLAMA_HOST = "http://127.0.0.1:11434"
 OLLAMA_HOST = os.environ.get('OLLAMA_HOST', 'http://127.0.0.1:11434')
-OLLAMA_MODEL = {"llama3", "mistral"} # Change this to your preferred model (e.g., 'mistral', 'gemma')
+OLLAMA_MODEL = os.environ.get('OLLAMA_MODEL', 'llama3') # Change this to your preferred model (e.g., 'mistral', 'gemma')
+
+# Shared, pooled HTTP client used for every Ollama call (see chat/ollama_client.py).
+# Timeouts are in seconds; OLLAMA_TIMEOUT bounds reads, so it must cover the
+# longest gap between two streamed chunks.
+OLLAMA_TIMEOUT = float(os.environ.get('OLLAMA_TIMEOUT', 30.0))
+OLLAMA_CONNECT_TIMEOUT = float(os.environ.get('OLLAMA_CONNECT_TIMEOUT', 5.0))
+OLLAMA_MAX_CONNECTIONS = int(os.environ.get('OLLAMA_MAX_CONNECTIONS', 20))
+OLLAMA_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get('OLLAMA_MAX_KEEPALIVE_CONNECTIONS', 10))
+OLLAMA_KEEPALIVE_EXPIRY = 60.0
+# Connection failures and 502/503/504 answers are retried with jittered exponential backoff.
+OLLAMA_MAX_RETRIES = int(os.environ.get('OLLAMA_MAX_RETRIES', 2))
+OLLAMA_RETRY_BACKOFF = 0.25
+OLLAMA_RETRY_MAX_DELAY = 2.0
+
+# The list of available models is cached for OLLAMA_MODELS_CACHE_TTL seconds,
+# then served stale for up to OLLAMA_MODELS_CACHE_STALE_TTL more seconds while
+# it is refreshed in the background. A failed lookup is retried after
+# OLLAMA_MODELS_CACHE_RETRY_TTL seconds.
+OLLAMA_MODELS_CACHE_TTL = 60
+OLLAMA_MODELS_CACHE_STALE_TTL = 60 * 60
+OLLAMA_MODELS_CACHE_RETRY_TTL = 10
+
+# LLM completion cache (see chat/completion_cache.py). Identical prompts are
+# answered from an in-process LRU of up to LLM_CACHE_MAX_ENTRIES completions,
+# each kept for LLM_CACHE_TTL seconds. Clients can bypass it per request by
+# sending "cache": false.
+LLM_CACHE_ENABLED = True
+LLM_CACHE_MAX_ENTRIES = 1000
+LLM_CACHE_TTL = 60 * 60
+
+# AI assistant conversation memory (see chat/memory.py). Only the newest turns
+# that fit in CHAT_MEMORY_TOKEN_BUDGET (estimated) tokens are sent with each
+# prompt, reading at most CHAT_MEMORY_MAX_MESSAGES stored turns. Older turns
+# are folded into a running summary when CHAT_MEMORY_SUMMARIZE is on.
+CHAT_MEMORY_TOKEN_BUDGET = 2000
+CHAT_MEMORY_MAX_MESSAGES = 50
+CHAT_MEMORY_SUMMARIZE = True
+
+# LLM request scheduler (see chat/scheduler.py). At most LLM_MAX_CONCURRENCY
+# generations run at once per model (override per model in
+# LLM_MODEL_CONCURRENCY). Up to LLM_MAX_QUEUE further requests may wait, no
+# more than LLM_MAX_QUEUE_PER_USER of them from one user, and each for at most
+# LLM_QUEUE_TIMEOUT seconds. Anything beyond that is rejected immediately.
+LLM_MAX_CONCURRENCY = 2
+LLM_MODEL_CONCURRENCY = {}
+LLM_MAX_QUEUE = 50
+LLM_MAX_QUEUE_PER_USER = 2
+LLM_QUEUE_TIMEOUT = 30
+
+# Chat WebSocket flood control (see chat/throttling.py). Each connection may
+# send CHAT_RATE_LIMIT frames per second (bursts of CHAT_RATE_BURST), and each
+# user CHAT_USER_RATE_LIMIT per second across all of their connections.
+# Frames over the limit are dropped; a connection is closed after
+# CHAT_FLOOD_MAX_STRIKES rejected frames in a row, or at once for a frame
+# larger than CHAT_MAX_FRAME_BYTES. Up to CHAT_OUTBOUND_QUEUE_SIZE frames wait
+# for a slow reader; beyond that, CHAT_SLOW_CONSUMER_POLICY either drops the
+# oldest frame ("drop_oldest") or closes the connection ("disconnect").
+CHAT_RATE_LIMIT = 5
+CHAT_RATE_BURST = 10
+CHAT_USER_RATE_LIMIT = 10
+CHAT_USER_RATE_BURST = 20
+CHAT_FLOOD_MAX_STRIKES = 50
+CHAT_MAX_FRAME_BYTES = 16 * 1024
+CHAT_OUTBOUND_QUEUE_SIZE = 100
+CHAT_SLOW_CONSUMER_POLICY = 'drop_oldest'
+
+# Private chat inbox (see chat/inbox.py): conversations listed per page.
+CHAT_INBOX_PAGE_SIZE = 20
+
+# Private message search (see chat/search.py): results per page, and how many
+# neighbouring messages are shown before and after each result. Users in up
+# to CHAT_SEARCH_MAX_THREAD_TERMS threads are searched by thread inside the
+# full-text index; beyond that, matches are filtered by thread membership.
+CHAT_SEARCH_PAGE_SIZE = 20
+CHAT_SEARCH_CONTEXT = 1
+CHAT_SEARCH_MAX_THREAD_TERMS = 50
+
+# Live media activity (see media/activity.py): likes, comments and public
+# uploads are pushed to open pages in one batch per group at most every
+# MEDIA_ACTIVITY_INTERVAL seconds, with up to MEDIA_ACTIVITY_MAX_ITEMS of the
+# newest comments or uploads in full.
+MEDIA_ACTIVITY_INTERVAL = 1.0
+MEDIA_ACTIVITY_MAX_ITEMS = 5
+
+# Site content retrieval for the AI assistant (see chat/retrieval.py). Media
+# titles, category names and comments are embedded into an index in
+# CHAT_RAG_INDEX_DIR, and up to CHAT_RAG_TOP_K items scoring at least
+# CHAT_RAG_MIN_SCORE (cosine similarity) are added to each prompt.
+# CHAT_RAG_EMBEDDER is 'hashing' (deterministic, no model needed) or 'ollama'
+# (CHAT_RAG_EMBEDDING_MODEL, which must produce CHAT_RAG_DIM dimensions).
+# Rebuild the index with `manage.py build_rag_index` after changing these.
+CHAT_RAG_ENABLED = True
+CHAT_RAG_INDEX_DIR = BASE_DIR / 'rag_index'
+CHAT_RAG_EMBEDDER = os.environ.get('CHAT_RAG_EMBEDDER', 'hashing')
+CHAT_RAG_EMBEDDING_MODEL = os.environ.get('CHAT_RAG_EMBEDDING_MODEL', 'nomic-embed-text')
+CHAT_RAG_DIM = int(os.environ.get('CHAT_RAG_DIM', 256))
+CHAT_RAG_TOP_K = 4
+CHAT_RAG_MIN_SCORE = 0.3
+
+# "Related media" panel (see media/related.py). MEDIA_RELATED_STORED
+# neighbours per item are precomputed by `manage.py build_related_media`,
+# scored by co-likes, shared categories and title embeddings with the given
+# weights (embeddings only when the assistant's content index exists; each
+# item's MEDIA_RELATED_EMBEDDING_CANDIDATES nearest titles are considered).
+# MEDIA_RELATED_COUNT of them are shown.
+MEDIA_RELATED_COUNT = 6
+MEDIA_RELATED_STORED = 12
+MEDIA_RELATED_WEIGHTS = {'likes': 1.0, 'categories': 0.5, 'embeddings': 0.5}
+MEDIA_RELATED_EMBEDDING_CANDIDATES = 20
+
+# Metrics (see media_sharing_project/metrics.py), served at /metrics/ to staff
+# users and to scrapers sending "Authorization: Bearer <METRICS_TOKEN>".
+# Requests slower than METRICS_SLOW_REQUEST_SECONDS are counted and logged.
+# A METRICS_PROFILE_SAMPLE_RATE fraction of requests, and staff requests with
+# an "X-Profile: 1" header, are profiled by sampling their stack every
+# METRICS_PROFILE_INTERVAL seconds; the METRICS_PROFILE_KEEP latest profiles
+# of slow (or explicitly profiled) requests are listed at /metrics/profiles/.
+METRICS_ENABLED = True
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+METRICS_SLOW_REQUEST_SECONDS = 1.0
+METRICS_PROFILE_SAMPLE_RATE = float(os.environ.get('METRICS_PROFILE_SAMPLE_RATE', 0.0))
+METRICS_PROFILE_INTERVAL = 0.005
+METRICS_PROFILE_KEEP = 20
+
+# "Download my data" archives (see media/export.py) are streamed in blocks of
+# DATA_EXPORT_CHUNK_SIZE bytes, reading DATA_EXPORT_QUERY_CHUNK_SIZE rows per
+# database fetch. The layout of each measured archive is cached for
+# DATA_EXPORT_LAYOUT_TIMEOUT seconds, so a resumed download can seek.
+DATA_EXPORT_CHUNK_SIZE = 64 * 1024
+DATA_EXPORT_QUERY_CHUNK_SIZE = 2000
+DATA_EXPORT_LAYOUT_TIMEOUT = 24 * 60 * 60
+
+# Private chat history (see chat/archive.py). Rooms show CHAT_HISTORY_PAGE_SIZE
+# messages at a time. `manage.py archive_messages` moves messages older than
+# CHAT_ARCHIVE_AFTER_DAYS days out of the message table, CHAT_ARCHIVE_BATCH_SIZE
+# per transaction; archived messages are still shown, searched and exported.
+CHAT_HISTORY_PAGE_SIZE = 50
+CHAT_ARCHIVE_AFTER_DAYS = 90
+CHAT_ARCHIVE_BATCH_SIZE = 1000
+
+# Read replicas (see media_sharing_project/db_router.py). Requests read from
+# the DATABASE_REPLICAS aliases, except right after a write: a browser that
+# wrote something reads from the primary for DATABASE_REPLICA_STICKY_SECONDS.
+# WebSocket consumers, commands and background work read from the primary.
+# Replicas more than DATABASE_REPLICA_MAX_LAG seconds behind (checked every
+# DATABASE_REPLICA_LAG_CHECK_INTERVAL seconds) are skipped. To try it locally,
+# set DATABASE_REPLICA_PATH to a second SQLite file: it is kept in sync by
+# copying the primary after every write, DATABASE_REPLICA_SQLITE_DELAY
+# seconds later.
+DATABASE_ROUTERS = ['media_sharing_project.db_router.ReplicaRouter']
+DATABASE_REPLICAS = []
+DATABASE_REPLICA_PATH = os.environ.get('DATABASE_REPLICA_PATH')
+if DATABASE_REPLICA_PATH:
+    DATABASES['replica'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': DATABASE_REPLICA_PATH,
+        'TEST': {'MIRROR': 'default'},
+    }
+    DATABASE_REPLICAS = ['replica']
+DATABASE_REPLICA_SQLITE_SYNC = bool(DATABASE_REPLICA_PATH)
+DATABASE_REPLICA_SQLITE_DELAY = float(os.environ.get('DATABASE_REPLICA_SQLITE_DELAY', 0.0))
+DATABASE_REPLICA_MAX_LAG = 5.0
+DATABASE_REPLICA_LAG_CHECK_INTERVAL = 1.0
+DATABASE_REPLICA_STICKY_SECONDS = 10
+
+# LangChain is imported only when the AI assistant is first used (see
+# chat/conversation.py). With CHAT_LANGCHAIN_WARMUP on, ASGI startup preloads
+# it in the background so the first conversation does not wait for it; turn it
+# off for workers that only serve media pages. `manage.py bench_startup`
+# measures both.
+CHAT_LANGCHAIN_WARMUP = os.environ.get('CHAT_LANGCHAIN_WARMUP', '1') == '1'
+
+# Deleting users and media items (see media/deletion.py). They are hidden at
+# once and removed in the background, DELETION_BATCH_SIZE rows per
+# transaction, deleting DELETION_FILE_WORKERS files at a time.
+# `manage.py purge_deletions` finishes deletions interrupted by a restart.
+DELETION_BATCH_SIZE = 500
+DELETION_FILE_WORKERS = 8
+
+# Per-user storage quotas (see media/quota.py). Uploads that would take a user
+# past STORAGE_QUOTA_BYTES, or past their own quota set in the admin, are
+# refused. `manage.py reconcile_storage` measures every file again,
+# STORAGE_RECONCILE_WORKERS at a time, and corrects the totals; run it once
+# to count uploads made before quotas existed.
+STORAGE_QUOTA_BYTES = 1024 ** 3
+STORAGE_RECONCILE_WORKERS = 16
@@ -19,8 +19,12 @@ from django.urls import path, include
 from django.conf import settings
 from django.conf.urls.static import static
 
+from .metrics import metrics_view, profiles_view
+
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('metrics/', metrics_view, name='metrics'),
+    path('metrics/profiles/', profiles_view, name='metrics_profiles'),
     path('accounts/', include('django.contrib.auth.urls')), # For login, logout, etc.
     path('', include('chat.urls')),
     path('', include('media.urls')),